@@ -0,0 +1,188 @@
+""" This module contains the compact encoding of the shopping bag """
+
+import json
+
+# The version is the first field of every encoded bag,
+# so the format can change without breaking existing sessions.
+VERSION = '1'
+LINE_SEPARATOR = '|'
+FIELD_SEPARATOR = ':'
+
+# Limits keep the session row small.
+# The bag is kept with the checkout data in our own database
+# (see checkout/models.py), so it isn't bound by stripe's metadata limits.
+MAX_LINES = 50
+MAX_QUANTITY = 99
+MAX_SIZE_LENGTH = 2  # XS, S, M, L, XL, see OrderLineItem.product_size
+MAX_ENCODED_LENGTH = 1000
+
+
+class BagError(ValueError):
+    """ Raised for a bag that can't be decoded or would break a limit """
+
+
+class Bag:
+    """
+    The shopping bag, a line for each product and size with its quantity.
+
+    Encoded as the version followed by a product_id:size:quantity
+    field for each line, e.g. '1|12::3|15:m:2' is three of product 12
+    and two of product 15 in size M.
+    Bags saved in the old nested dictionary format,
+    {'12': 3, '15': {'items_by_size': {'m': 2}}},
+    are read as well, so existing sessions and orders keep working.
+    """
+
+    def __init__(self, lines=None):
+        self._lines = {}
+        for product_id, size, quantity in lines or ():
+            self.set(product_id, size, quantity)
+
+    @classmethod
+    def decode(cls, data):
+        """
+        Return the bag from its encoded form,
+        a legacy dictionary, or the legacy dictionary as JSON.
+        Nothing at all is an empty bag.
+        Raises BagError if the data isn't a valid bag.
+        """
+        if not data:
+            return cls()
+        if isinstance(data, str) and data.startswith('{'):
+            try:
+                data = json.loads(data)
+            except ValueError as e:
+                raise BagError(f'Invalid bag: {e}') from e
+        if isinstance(data, dict):
+            return cls._decode_legacy(data)
+        if not isinstance(data, str):
+            raise BagError('Invalid bag')
+
+        version, *lines = data.split(LINE_SEPARATOR)
+        if version != VERSION:
+            raise BagError(f'Unknown bag version {version}')
+        bag = cls()
+        for line in lines:
+            try:
+                product_id, size, quantity = line.split(FIELD_SEPARATOR)
+                bag.set(int(product_id), size or None, int(quantity))
+            except ValueError as e:
+                raise BagError(f'Invalid bag line {line}: {e}') from e
+        return bag
+
+    @classmethod
+    def _decode_legacy(cls, data):
+        """ Return the bag from the old nested dictionary format """
+        bag = cls()
+        try:
+            for item_id, item_data in data.items():
+                if isinstance(item_data, int):
+                    bag.set(int(item_id), None, item_data)
+                else:
+                    for size, quantity in item_data['items_by_size'].items():
+                        bag.set(int(item_id), size, quantity)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise BagError(f'Invalid bag: {e}') from e
+        return bag
+
+    def encode(self):
+        """ Return the compact encoded form of the bag """
+        lines = [
+            f'{product_id}{FIELD_SEPARATOR}{size or ""}{FIELD_SEPARATOR}{quantity}'  # noqa
+            for (product_id, size), quantity in self._lines.items()
+        ]
+        return LINE_SEPARATOR.join([VERSION] + lines)
+
+    def get(self, product_id, size=None):
+        """ Return the quantity of a product and size in the bag """
+        return self._lines.get((int(product_id), size or None), 0)
+
+    def set(self, product_id, size, quantity):
+        """
+        Set the quantity of a product and size,
+        removing the line if the quantity is zero.
+        Raises BagError if that would break one of the limits.
+        """
+        key = (int(product_id), size or None)
+        if quantity <= 0:
+            self._lines.pop(key, None)
+            return 0
+        if quantity > MAX_QUANTITY:
+            raise BagError(f'You can only have up to {MAX_QUANTITY} of each item')  # noqa
+        if size and (len(size) > MAX_SIZE_LENGTH or not size.isalpha()):
+            raise BagError(f'Invalid size {size}')
+        previous = self._lines.get(key)
+        self._lines[key] = quantity
+        if len(self._lines) > MAX_LINES or len(self.encode()) > MAX_ENCODED_LENGTH:  # noqa
+            if previous is None:
+                del self._lines[key]
+            else:
+                self._lines[key] = previous
+            raise BagError('Your bag is full')
+        return quantity
+
+    def add(self, product_id, size, quantity):
+        """
+        Add to the quantity of a product and size, returning the new one
+        """
+        return self.set(product_id, size, self.get(product_id, size) + quantity)  # noqa
+
+    def remove(self, product_id, size=None):
+        """ Remove a product and size from the bag """
+        self._lines.pop((int(product_id), size or None), None)
+
+    def product_ids(self):
+        """ Return the ids of every product in the bag, without repeats """
+        return list(dict.fromkeys(product_id for product_id, _size in self._lines))  # noqa
+
+    def __contains__(self, key):
+        product_id, size = key
+        return (int(product_id), size or None) in self._lines
+
+    def __iter__(self):
+        """ Yield a (product_id, size, quantity) tuple for each line """
+        for (product_id, size), quantity in self._lines.items():
+            yield product_id, size, quantity
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __eq__(self, other):
+        return isinstance(other, Bag) and self._lines == other._lines
+
+    def __repr__(self):
+        return f'<Bag {self.encode()}>'
+
+
+def get_bag(request):
+    """
+    Return the bag from the session.
+
+    Sessions still holding the old dictionary format
+    are converted to the compact format straight away.
+    A bag that can't be read at all is treated as empty.
+    """
+    data = request.session.get('bag')
+    try:
+        bag = Bag.decode(data)
+    except BagError:
+        bag = Bag()
+    if data and data != bag.encode():
+        save_bag(request, bag)
+    return bag
+
+
+def save_bag(request, bag):
+    """
+    Store the bag in the session in its compact format.
+    Only if it has actually changed,
+    as any change means writing the whole session again.
+    An empty bag is removed from the session altogether.
+    """
+    data = bag.encode() if bag else None
+    if request.session.get('bag') == data:
+        return
+    if data is None:
+        del request.session['bag']
+    else:
+        request.session['bag'] = data
@@ -1,16 +1,36 @@
 """ This module contants a context processor for the shopping bag """
 
 from decimal import Decimal
-from django.shortcuts import get_object_or_404
 from django.conf import settings
-from products.models import Product
+from django.core.cache import cache as shared_cache
+from products.catalog import catalog_cache_key, get_catalog_version
+from products.product_cache import get_products
+from .codec import get_bag
 
 
-def bag_contents(request):
+def _get_bag_products(request, bag):
     """
-    returns the context processor for the shopping bag,
-    making the dict available for all templates across the application.
+    Collect every product in the bag, read through the product cache
+    (see products/product_cache.py), with a single query for any misses.
+
+    Returns a dictionary of the products keyed by their id,
+    any product that has since been deleted simply won't be in it.
+    """
+    if not bag:
+        return {}
+    return get_products(request, bag.product_ids())
+
 
+def _get_bag_prices(request, bag):
+    """ Collect the price of every product in the bag """
+    return {
+        pk: product.price
+        for pk, product in _get_bag_products(request, bag).items()
+    }
+
+
+def _calculate_totals(total, product_count):
+    """
     Free delivery if they spend more than the amount specified
     in the free delivery threshold in settings.py.
     Check whether it's less than that threshold.
@@ -25,82 +45,217 @@ def bag_contents(request):
     set delivery and the free_delivery_delta to zero.
 
     calculate the grand total. add the delivery charge to the total.
+    """
+    if total < settings.FREE_DELIVERY_THRESHOLD:
+        delivery = total * Decimal(settings.STANDARD_DELIVERY_PERCENTAGE / 100)
+        free_delivery_delta = settings.FREE_DELIVERY_THRESHOLD - total
+    else:
+        delivery = 0
+        free_delivery_delta = 0
 
-    In order to populate bag_items, total and product_count.
-    Create a variable called bag. Which accesses the requests session.
-    Trying to get this variable if it already exists,
-    and initializing it to an empty dictionary if it doesn't.
+    grand_total = delivery + total
+
+    return {
+        'total': total,
+        'product_count': product_count,
+        'delivery': delivery,
+        'free_delivery_delta': free_delivery_delta,
+        'free_delivery_threshold': settings.FREE_DELIVERY_THRESHOLD,
+        'grand_total': grand_total,
+    }
 
-    In the case of an item with no sizes.
-    The item data will just be the quantity.
-    But in the case of an item that has sizes the
-    item data will be a dictionary of all the items by size.
 
-    If the item has no sizes.
-    Evident by checking whether or not the item data is an integer.
-    If it's an integer the item data is just the quantity.
+def _price_bag(request, bag):
+    """
+    Build the full priced bag, including the bag items list.
 
     Iterate through all the items in the shopping bag.
     And along the way, tally up the total cost and product count.
     Add the products and their data to the bag items list.
-
-    If it's a dictionary need to iterate through
-    the inner dictionary of items_by_size
-    incrementing the product count and total accordingly.
-    For each of these items, add the size to the bag items
-    returned to the template as well.
+    Items whose product no longer exists are dropped from the bag.
 
     Add a dictionary to the list of bag items containing the id & quantity,
     But also the product object itself.
     Allowing access to all the other fields,
     when iterating through the bag items in our templates.
+    For sized items, add the size to the bag items as well.
     """
-
     bag_items = []
     total = 0
     product_count = 0
-    bag = request.session.get('bag', {})
-
-    for item_id, item_data in bag.items():  # bag from session
-        if isinstance(item_data, int):
-            product = get_object_or_404(Product, pk=item_id)  # get product
-            total += item_data * product.price  # add quantity x price to total
-            product_count += item_data  # increment product count by quantity
-            bag_items.append({  # add list of bag items
-                'item_id': item_id,
-                'quantity': item_data,
-                'product': product,
-            })
+    products = _get_bag_products(request, bag)
+
+    for item_id, size, quantity in bag:
+        product = products.get(item_id)
+        if product is None:  # product deleted or invalid id
+            continue
+        total += quantity * product.price  # add quantity x price to total
+        product_count += quantity  # increment product count by quantity
+        bag_item = {  # add list of bag items
+            'item_id': item_id,
+            'quantity': quantity,
+            'product': product,
+        }
+        if size:
+            bag_item['size'] = size
+        bag_items.append(bag_item)
+
+    context = _calculate_totals(total, product_count)
+    context['bag_items'] = bag_items
+
+    return context
+
+
+def get_bag_summary(request, bag):
+    """
+    Tally up the totals and product count without building bag items.
+    Along with the totals, lines lists each item's size,
+    quantity and subtotal, for the bag API (see views.py).
+    """
+    lines = []
+    total = 0
+    product_count = 0
+    prices = _get_bag_prices(request, bag)
+
+    for item_id, size, quantity in bag:
+        price = prices.get(item_id)
+        if price is None:  # product deleted or invalid id
+            continue
+        subtotal = quantity * price
+        total += subtotal
+        product_count += quantity
+        lines.append({
+            'item_id': item_id,
+            'size': size,
+            'quantity': quantity,
+            'subtotal': subtotal,
+        })
+
+    context = _calculate_totals(total, product_count)
+    context['lines'] = lines
+    return context
+
+
+def _total_bag(request, bag):
+    """ The bag totals without the lines, see get_bag_summary """
+    context = get_bag_summary(request, bag)
+    del context['lines']
+    return context
+
+
+def _get_bag_cache(request):
+    """
+    Return the per request bag cache.
+
+    The bag is read from the session with get_bag (see codec.py),
+    which returns an empty bag if there isn't one yet.
+
+    Anything priced from the bag is memoized on the request,
+    alongside a snapshot of the bag it was priced from.
+    If the bag changes later in the same request
+    the snapshot won't match and the cache is started afresh.
+    """
+    bag = get_bag(request)
+    snapshot = bag.encode()
+
+    cache = getattr(request, '_bag_cache', None)
+    if cache is None or cache['snapshot'] != snapshot:
+        cache = {'snapshot': snapshot, 'bag': bag}
+        request._bag_cache = cache  # pylint: disable=protected-access
+    return cache
+
+
+def get_bag_fingerprint(request):
+    """
+    Returns a fingerprint of the bag and the catalog version it's priced at.
+    Any change to the bag, a product's price or the delivery settings
+    changes it.
+    Also used as the key of the priced bag snapshot in the cache.
+    """
+    cache = _get_bag_cache(request)
+    if 'fingerprint' not in cache:
+        cache['fingerprint'] = catalog_cache_key(
+            'bag-totals', get_catalog_version(request), bag=cache['snapshot'],
+            threshold=settings.FREE_DELIVERY_THRESHOLD,
+            delivery=settings.STANDARD_DELIVERY_PERCENTAGE)
+    return cache['fingerprint']
+
+
+def get_bag_contents(request):
+    """
+    Returns the full priced bag for the request,
+    including the bag items list and all the totals.
+    """
+    cache = _get_bag_cache(request)
+    if 'contents' not in cache:
+        cache['contents'] = _price_bag(request, cache['bag'])
+    return cache['contents']
+
+
+def get_bag_totals(request):
+    """
+    Returns the bag totals and product count for the request.
+    Reuses the full priced bag if it has already been built,
+    otherwise takes the cheaper prices only path.
+
+    The totals are also kept in the cache between requests,
+    keyed by the bag fingerprint, so the page views in between
+    bag changes are served from this snapshot.
+    It's never stale, a change to the bag or the catalog
+    changes the fingerprint.
+    """
+    cache = _get_bag_cache(request)
+    if 'contents' in cache:
+        return cache['contents']
+    if 'totals' not in cache:
+        if not cache['bag']:
+            cache['totals'] = _calculate_totals(0, 0)
         else:
-            product = get_object_or_404(Product, pk=item_id)
-            # item_data as a dict
-            for size, quantity in item_data['items_by_size'].items():
-                total += quantity * product.price
-                product_count += quantity
-                bag_items.append({
-                    'item_id': item_id,
-                    'quantity': quantity,  # quantity from inner dict
-                    'product': product,
-                    'size': size,
-                })
+            key = get_bag_fingerprint(request)
+            totals = shared_cache.get(key)
+            if totals is None:
+                totals = _total_bag(request, cache['bag'])
+                shared_cache.set(key, totals, settings.BAG_CACHE_TIMEOUT)
+            cache['totals'] = totals
+    return cache['totals']
 
-    if total < settings.FREE_DELIVERY_THRESHOLD:
-        delivery = total * Decimal(settings.STANDARD_DELIVERY_PERCENTAGE / 100)
-        free_delivery_delta = settings.FREE_DELIVERY_THRESHOLD - total
-    else:
-        delivery = 0
-        free_delivery_delta = 0
 
-    grand_total = delivery + total
+class _LazyBagValue:
+    """
+    A callable standing in for a single bag context value.
 
-    context = {
-        'bag_items': bag_items,
-        'total': total,
-        'product_count': product_count,
-        'delivery': delivery,
-        'free_delivery_delta': free_delivery_delta,
-        'free_delivery_threshold': settings.FREE_DELIVERY_THRESHOLD,
-        'grand_total': grand_total,
-    }
+    The template engine calls any callable it finds in the context
+    when the variable is actually used, so nothing is read from the
+    session or the database until then.
+    bag_items needs the full priced bag,
+    every other value comes from the totals fast path.
+    """
+
+    def __init__(self, request, key):
+        self.request = request
+        self.key = key
+
+    def __call__(self):
+        if self.key == 'bag_items':
+            return get_bag_contents(self.request)['bag_items']
+        return get_bag_totals(self.request)[self.key]
+
+
+def bag_contents(request):
+    """
+    returns the context processor for the shopping bag,
+    making the dict available for all templates across the application.
+
+    Most pages only show the nav badge, or don't touch the bag at all.
+    So each value is lazy and only priced when a template reads it.
+    Views that need the values themselves should call
+    get_bag_contents or get_bag_totals instead.
+    """
+    keys = (
+        'bag_items', 'total', 'product_count', 'delivery',
+        'free_delivery_delta', 'grand_total',
+    )
+    context = {key: _LazyBagValue(request, key) for key in keys}
+    context['free_delivery_threshold'] = settings.FREE_DELIVERY_THRESHOLD
 
     return context
@@ -0,0 +1,117 @@
+""" This module contains the benchmark of session writes by the bag """
+
+from importlib import import_module
+from unittest import mock
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext, override_settings, setup_test_environment,
+    teardown_test_environment)
+from django.urls import reverse
+
+from products.models import Product
+
+SESSION_MESSAGES = 'django.contrib.messages.storage.session.SessionStorage'
+COOKIE_MESSAGES = 'django.contrib.messages.storage.cookie.CookieStorage'
+# the benchmark runs in one process, so a local sessions cache will do
+LOCAL_SESSION_CACHE = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'sessions',
+}
+
+# the session engine and message storage for each configuration,
+# the first is the original setup of database sessions holding messages.
+CONFIGURATIONS = [
+    ('db + session messages', 'db', SESSION_MESSAGES),
+    ('db', 'db', COOKIE_MESSAGES),
+    ('cache', 'cache', COOKIE_MESSAGES),
+    ('cookie', 'cookie', COOKIE_MESSAGES),
+]
+
+
+def _shopper_requests(shirt, mug):
+    """
+    The requests of a typical anonymous shopper,
+    including some that leave the bag unchanged.
+    """
+    return [
+        ('get', reverse('products'), {}),
+        ('get', reverse('product_detail', args=[shirt.id]), {}),
+        ('post', reverse('add_to_bag', args=[shirt.id]),
+         {'quantity': 1, 'product_size': 'm', 'redirect_url': '/'}),
+        ('post', reverse('add_to_bag', args=[mug.id]),
+         {'quantity': 2, 'redirect_url': '/'}),
+        ('get', reverse('view_bag'), {}),
+        # setting a quantity to what it already is
+        ('post', reverse('adjust_bag', args=[mug.id]), {'quantity': 2}),
+        ('get', reverse('view_bag'), {}),
+        # over the limit, the bag is left as it was
+        ('post', reverse('add_to_bag', args=[mug.id]),
+         {'quantity': 500, 'redirect_url': '/'}),
+        ('get', reverse('view_bag'), {}),
+        ('post', reverse('remove_from_bag', args=[shirt.id]),
+         {'product_size': 'm'}),
+        ('get', reverse('products'), {}),
+        ('get', reverse('product_detail', args=[mug.id]), {}),
+    ]
+
+
+class Command(BaseCommand):
+    """
+    Count the session writes made by a scripted shopper
+    browsing, filling and changing their bag,
+    under each session mode (see SESSION_MODE in settings.py).
+
+    Session writes are the requests that saved the session,
+    a row update for database sessions, a set cookie for signed cookies.
+    Database writes are inserts and updates of the session table.
+    Runs in a throwaway test database, leaving the real one untouched.
+    """
+    help = 'Count session writes per request for each session mode'
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            shirt = Product.objects.create(
+                name='Shirt', description='A shirt', price=20, has_sizes=True)
+            mug = Product.objects.create(
+                name='Mug', description='A mug', price=8)
+            self.stdout.write(
+                f'{"configuration":<24}{"requests":>10}'
+                f'{"session writes":>16}{"db writes":>12}')
+            for label, mode, message_storage in CONFIGURATIONS:
+                with override_settings(
+                        SESSION_ENGINE=settings.SESSION_ENGINES[mode],
+                        MESSAGE_STORAGE=message_storage,
+                        CACHES={
+                            **settings.CACHES,
+                            settings.SESSION_CACHE_ALIAS: LOCAL_SESSION_CACHE,
+                        }):
+                    requests, saves, db_writes = self._run(shirt, mug)
+                self.stdout.write(
+                    f'{label:<24}{requests:>10}{saves:>16}{db_writes:>12}')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def _run(self, shirt, mug):
+        """ Run the shopper's requests, counting the session writes """
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        requests = _shopper_requests(shirt, mug)
+        client = Client()
+        writes = 0
+        with mock.patch.object(store, 'save', autospec=True, side_effect=store.save) as save:  # noqa
+            with CaptureQueriesContext(connection) as queries:
+                for method, url, data in requests:
+                    saves = save.call_count
+                    getattr(client, method)(url, data)
+                    writes += save.call_count > saves
+        db_writes = sum(
+            1 for q in queries.captured_queries
+            if 'django_session' in q['sql']
+            and q['sql'].lstrip().startswith(('INSERT', 'UPDATE')))
+        return len(requests), writes, db_writes
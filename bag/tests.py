@@ -1,3 +1,267 @@
-from django.test import TestCase
+""" This module contains the tests for the bag app """
 
-# Create your tests here.
+import json
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from products.models import Product
+from .codec import MAX_ENCODED_LENGTH, MAX_QUANTITY, Bag, BagError
+from .contexts import bag_contents
+
+
+class BagCodecTest(TestCase):
+    """
+    The bag is stored in its compact encoding,
+    and bags in the old nested dictionary format still decode.
+    """
+
+    def test_round_trip(self):
+        bag = Bag([(12, None, 3), (15, 'm', 2), (15, 'l', 1)])
+        self.assertEqual(bag.encode(), '1|12::3|15:m:2|15:l:1')
+        self.assertEqual(Bag.decode(bag.encode()), bag)
+        self.assertEqual(bag.product_ids(), [12, 15])
+
+    def test_decode_legacy(self):
+        legacy = {'12': 3, '15': {'items_by_size': {'m': 2, 'l': 1}}}
+        expected = Bag([(12, None, 3), (15, 'm', 2), (15, 'l', 1)])
+        self.assertEqual(Bag.decode(legacy), expected)
+        self.assertEqual(Bag.decode('{"12": 3, "15": {"items_by_size": {"m": 2, "l": 1}}}'), expected)  # noqa
+        self.assertEqual(list(Bag.decode(None)), [])
+
+    def test_invalid_bags(self):
+        for data in ('2|12::3', '1|12:3', '1|x::1', '{"12": "x"}', 42):
+            with self.subTest(data=data), self.assertRaises(BagError):
+                Bag.decode(data)
+
+    def test_limits(self):
+        bag = Bag()
+        with self.assertRaises(BagError):
+            bag.add(1, None, MAX_QUANTITY + 1)
+        with self.assertRaises(BagError):
+            bag.add(1, 'xxl', 1)
+        with self.assertRaises(BagError):
+            for product_id in range(1, 1000):
+                bag.add(product_id, None, 1)
+        # the line that didn't fit isn't left behind
+        self.assertNotIn((product_id, None), bag)
+        self.assertLessEqual(len(bag.encode()), MAX_ENCODED_LENGTH)
+
+
+class BagContentsQueryTest(TestCase):
+    """
+    Every product in the bag is loaded with one query,
+    however many lines the bag has,
+    and lines whose product has since been deleted are dropped.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.products = [
+            Product.objects.create(
+                name=f'Product {n}', description='A product', price=10 + n,
+                has_sizes=bool(n % 2))
+            for n in range(5)
+        ]
+        session = self.client.session
+        session['bag'] = Bag(
+            [(p.id, 'm' if p.has_sizes else None, 1) for p in self.products]
+            + [(self.products[1].id, 'l', 2)]).encode()
+        session.save()
+
+    def _product_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('view_bag'))
+        return response, [
+            q for q in queries.captured_queries
+            if 'FROM "products_product"' in q['sql']]
+
+    def test_one_query_for_every_product(self):
+        response, queries = self._product_queries()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(response.context['bag_items']), 6)
+        self.assertEqual(response.context['total'], Decimal('82'))
+        self.assertEqual(response.context['product_count'], 7)
+
+    def test_deleted_product_dropped(self):
+        self.products[0].delete()
+        response, queries = self._product_queries()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(
+            [item['item_id'] for item in response.context['bag_items']],
+            [p.id for p in self.products[1:]] + [self.products[1].id])
+
+
+class LazyBagContextTest(TestCase):
+    """
+    The bag context values are only priced when a template reads them,
+    so building the context reads neither the session nor the database.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.mug = Product.objects.create(
+            name='Mug', description='A mug', price=8)
+        session = SessionStore()
+        session['bag'] = Bag([(self.mug.id, None, 2)]).encode()
+        session.save()
+        self.session_key = session.session_key
+
+    def _request(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore(self.session_key)
+        return request
+
+    def test_context_costs_nothing_until_read(self):
+        request = self._request()
+        with self.assertNumQueries(0):
+            context = bag_contents(request)
+        self.assertFalse(request.session.accessed)
+        self.assertTrue(callable(context['grand_total']))
+
+        # the session, catalog version and product, once for every value
+        with self.assertNumQueries(3):
+            self.assertEqual(context['product_count'](), 2)
+            self.assertEqual(round(context['grand_total'](), 2), Decimal('17.60'))  # noqa
+            self.assertEqual(context['total'](), 16)
+        self.assertTrue(request.session.accessed)
+
+    def test_bag_items_read_from_compact_session(self):
+        context = bag_contents(self._request())
+        bag_items = context['bag_items']()
+        self.assertEqual(
+            [(item['item_id'], item['quantity']) for item in bag_items],
+            [(self.mug.id, 2)])
+        self.assertEqual(bag_items[0]['product'], self.mug)
+
+
+class BagViewTest(TestCase):
+    """
+    The bag views read and write the compact encoding,
+    and only write the session when the bag actually changes.
+    """
+
+    def setUp(self):
+        self.product = Product.objects.create(
+            name='Shirt', description='A shirt', price=10, has_sizes=True)
+
+    def test_add_adjust_remove(self):
+        add_url = reverse('add_to_bag', args=[self.product.id])
+        self.client.post(add_url, {'quantity': 2, 'product_size': 'm', 'redirect_url': '/'})  # noqa
+        self.client.post(add_url, {'quantity': 1, 'product_size': 'm', 'redirect_url': '/'})  # noqa
+        self.client.post(add_url, {'quantity': 1, 'product_size': 'l', 'redirect_url': '/'})  # noqa
+        self.assertEqual(self.client.session['bag'], f'1|{self.product.id}:m:3|{self.product.id}:l:1')  # noqa
+
+        self.client.post(reverse('adjust_bag', args=[self.product.id]), {'quantity': 0, 'product_size': 'm'})  # noqa
+        self.client.post(reverse('remove_from_bag', args=[self.product.id]), {'product_size': 'l'})  # noqa
+        self.assertNotIn('bag', self.client.session)
+
+    def test_legacy_session_is_migrated(self):
+        session = self.client.session
+        session['bag'] = {str(self.product.id): {'items_by_size': {'s': 2}}}
+        session.save()
+        response = self.client.get(reverse('view_bag'))
+        self.assertEqual(response.context['total'], 20)
+        self.assertEqual(self.client.session['bag'], f'1|{self.product.id}:s:2')  # noqa
+
+    def test_unchanged_bag_does_not_write_session(self):
+        add_url = reverse('add_to_bag', args=[self.product.id])
+        self.client.post(add_url, {'quantity': 2, 'product_size': 'm', 'redirect_url': '/'})  # noqa
+        requests = [
+            (reverse('adjust_bag', args=[self.product.id]), {'quantity': 2, 'product_size': 'm'}),  # noqa
+            (add_url, {'quantity': 500, 'product_size': 'm', 'redirect_url': '/'}),  # noqa
+            (reverse('remove_from_bag', args=[self.product.id]), {'product_size': 'l'}),  # noqa
+        ]
+        for url, data in requests:
+            with self.subTest(url=url), CaptureQueriesContext(connection) as queries:  # noqa
+                self.client.post(url, data)
+            self.assertFalse([
+                q for q in queries.captured_queries
+                if q['sql'].startswith('UPDATE "django_session"')])
+
+
+class BagApiTest(TestCase):
+    """
+    The bag api applies several operations in one request,
+    all of them or none, and returns the new totals.
+    """
+
+    def setUp(self):
+        self.shirt = Product.objects.create(
+            name='Shirt', description='A shirt', price=20, has_sizes=True)
+        self.mug = Product.objects.create(
+            name='Mug', description='A mug', price=8)
+        self.url = reverse('update_bag')
+
+    def _post(self, *operations):
+        return self.client.post(
+            self.url, json.dumps({'operations': operations}),
+            content_type='application/json')
+
+    def test_batched_operations(self):
+        self._post(
+            {'op': 'add', 'item_id': self.shirt.id, 'size': 'm', 'quantity': 1},  # noqa
+            {'op': 'add', 'item_id': self.shirt.id, 'size': 'l', 'quantity': 1},  # noqa
+            {'op': 'add', 'item_id': self.mug.id, 'quantity': 1})
+        with self.assertNumQueries(5):  # session, prices, savepoint, save, release  # noqa
+            response = self._post(
+                {'op': 'adjust', 'item_id': self.shirt.id, 'size': 'm', 'quantity': 2},  # noqa
+                {'op': 'remove', 'item_id': self.shirt.id, 'size': 'l'},
+                {'op': 'adjust', 'item_id': self.mug.id, 'quantity': 0})
+        self.assertEqual(response.json(), {
+            'lines': [{'item_id': self.shirt.id, 'size': 'm', 'quantity': 2, 'subtotal': '40.00'}],  # noqa
+            'product_count': 2,
+            'total': '40.00',
+            'delivery': '4.00',
+            'free_delivery_delta': '10.00',
+            'grand_total': '44.00',
+        })
+        self.assertEqual(self.client.session['bag'], f'1|{self.shirt.id}:m:2')  # noqa
+
+    def test_invalid_batch_changes_nothing(self):
+        self._post({'op': 'add', 'item_id': self.mug.id, 'quantity': 1})
+        for operations in [
+                [{'op': 'add', 'item_id': self.mug.id, 'quantity': 1},
+                 {'op': 'add', 'item_id': 999, 'quantity': 1}],
+                [{'op': 'adjust', 'item_id': self.mug.id, 'quantity': 2},
+                 {'op': 'adjust', 'item_id': self.shirt.id, 'quantity': 100}],
+                [{'op': 'empty'}]]:
+            with self.subTest(operations=operations):
+                response = self._post(*operations)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.json())
+                self.assertEqual(self.client.session['bag'], f'1|{self.mug.id}::1')  # noqa
+
+
+class BagTotalsSnapshotTest(TestCase):
+    """
+    The priced bag totals are reused between requests
+    until the bag or the catalog changes.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.mug = Product.objects.create(
+            name='Mug', description='A mug', price=8)
+        self.client.post(
+            reverse('add_to_bag', args=[self.mug.id]),
+            {'quantity': 2, 'redirect_url': '/'})
+
+    def _badge_total(self):
+        response = self.client.get(reverse('home'))
+        return response.context['grand_total']()
+
+    def test_totals_reused_until_catalog_changes(self):
+        self.assertEqual(round(self._badge_total(), 2), Decimal('17.60'))
+        with mock.patch('bag.contexts._total_bag') as total_bag:
+            self._badge_total()
+        total_bag.assert_not_called()
+        self.mug.price = 10
+        self.mug.save()
+        self.assertEqual(round(self._badge_total(), 2), Decimal('22.00'))
@@ -1,15 +1,30 @@
 """ This module contains the views for the bag app """
 
-from django.shortcuts import render, redirect, reverse, HttpResponse, get_object_or_404  # noqa
+import json
+
+from django.shortcuts import render, redirect, reverse, HttpResponse
 from django.contrib import messages
+from django.http import JsonResponse
+from django.views.decorators.http import require_POST
+
+from products.product_cache import get_product_or_404
+from .codec import BagError, get_bag, save_bag
+from .contexts import get_bag_contents, get_bag_summary
 
-from products.models import Product
+BAG_OPERATIONS = ('add', 'adjust', 'remove')
 
 
 def view_bag(request):
-    """ A view that renders the bag contents page """
+    """
+    A view that renders the bag contents page
 
-    return render(request, 'bag/bag.html')
+    The bag page always lists the bag items,
+    so price the full bag up front rather than relying on
+    the lazy values from the context processor.
+    """
+    context = get_bag_contents(request)
+
+    return render(request, 'bag/bag.html', context)
 
 
 def add_to_bag(request, item_id):
@@ -22,54 +37,46 @@ def add_to_bag(request, item_id):
 
     Set size to none, check if product has size field and update accordingly.
 
-    Create a variable called bag. Which accesses the requests session.
-    Trying to get this variable if it already exists,
-    and initializing it to an empty dictionary if it doesn't.
-
-    If the item has a size field
-    add as dictionary with a key of items_by_size to bag.
-
+    Get the bag from the session with get_bag (see codec.py).
+    Which holds a line for each product and size, with its quantity.
     As may have multiple items with this item id. But different sizes.
-    This allows us to structure the bags such that
-    Can have a single item id for each item. But still track multiple sizes.
 
-    If the item is already in the bag.
-    Check if another item of the same id and same size already exists.
-    If so increment the quantity for that size,
-    otherwise just set it equal to the quantity.
+    If the item is already in the bag in the same size
+    increment the quantity for that size,
+    otherwise just add it with the quantity.
+    If that would break one of the bag's limits
+    the bag is left as it was, with an error message.
 
-    Then put the bag variable into the session.
-    Which itself is just a python dictionary.
+    Then put the bag back into the session with save_bag.
     """
     # collects the product for use in messages
-    product = get_object_or_404(Product, pk=item_id)
+    product = get_product_or_404(request, item_id)
     quantity = int(request.POST.get('quantity'))
     redirect_url = request.POST.get('redirect_url')
     size = None
     if 'product_size' in request.POST:
         size = request.POST['product_size']
-    bag = request.session.get('bag', {})  # get or create
+    bag = get_bag(request)
+
+    in_bag = (product.id, size) in bag
+    try:
+        quantity = bag.add(product.id, size, quantity)
+    except BagError as e:
+        messages.error(request, str(e))
+        return redirect(redirect_url)
 
     if size:
-        if item_id in list(bag.keys()):
-            if size in bag[item_id]['items_by_size'].keys():
-                bag[item_id]['items_by_size'][size] += quantity
-                messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}')  # noqa
-            else:
-                bag[item_id]['items_by_size'][size] = quantity
-                messages.success(request, f'Added size {size.upper()} {product.name} to your bag')  # noqa
+        if in_bag:
+            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {quantity}')  # noqa
         else:
-            bag[item_id] = {'items_by_size': {size: quantity}}
             messages.success(request, f'Added size {size.upper()} {product.name} to your bag')  # noqa
     else:
-        if item_id in list(bag.keys()):
-            bag[item_id] += quantity
-            messages.success(request, f'Updated {product.name} quantity to {bag[item_id]}')  # noqa
+        if in_bag:
+            messages.success(request, f'Updated {product.name} quantity to {quantity}')  # noqa
         else:
-            bag[item_id] = quantity
             messages.success(request, f'Added {product.name} to your bag')
 
-    request.session['bag'] = bag
+    save_bag(request, bag)
     return redirect(redirect_url)
 
 
@@ -80,36 +87,35 @@ def adjust_bag(request, item_id):
     If quantity is greater than zero set the items quantity
     accordingly otherwise just remove the item.
 
-    If there's a size, drill into the
-    items by size dictionary, find that specific size and either set its
-    quantity to the updated one or remove it if the quantity submitted is zero.
+    If there's a size, only the line for that size
+    is set to the updated quantity or removed if the quantity is zero.
     """
     # collects the product for use in messages
-    product = get_object_or_404(Product, pk=item_id)
+    product = get_product_or_404(request, item_id)
     quantity = int(request.POST.get('quantity'))
     size = None
     if 'product_size' in request.POST:
         size = request.POST['product_size']
-    bag = request.session.get('bag', {})  # get or create
+    bag = get_bag(request)
+
+    try:
+        bag.set(product.id, size, quantity)
+    except BagError as e:
+        messages.error(request, str(e))
+        return redirect(reverse('view_bag'))
 
     if size:
         if quantity > 0:
-            bag[item_id]['items_by_size'][size] = quantity
-            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}')  # noqa
+            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {quantity}')  # noqa
         else:
-            del bag[item_id]['items_by_size'][size]
-            if not bag[item_id]['items_by_size']:  # Items by size dict false
-                bag.pop(item_id)
             messages.success(request, f'Removed size {size.upper()} {product.name} from your bag')  # noqa
     else:
         if quantity > 0:
-            bag[item_id] = quantity
-            messages.success(request, f'Updated {product.name} quantity to {bag[item_id]}')  # noqa
+            messages.success(request, f'Updated {product.name} quantity to {quantity}')  # noqa
         else:
-            bag.pop(item_id)
             messages.success(request, f'Removed {product.name} from your bag')
 
-    request.session['bag'] = bag
+    save_bag(request, bag)
     return redirect(reverse('view_bag'))
 
 
@@ -118,15 +124,8 @@ def remove_from_bag(request, item_id):
     Removes items from the shopping bag.
 
     If size is in request.post.
-    Delete that size key in the items by size dictionary.
-
-    If that's the only size in the bag.
-    i.e. if the items by size dictionary is now empty,
-    which will evaluate to false.
-    Remove the entire item id so theres not an empty items
-    by size dictionary hanging around.
-
-    If there is no size. 'pop' item out of the bag.
+    Remove the line for that size only.
+    If there is no size remove the product's line.
 
     View will be posted to from a JavaScript function.
     Return an actual 200 HTTP response.
@@ -134,24 +133,106 @@ def remove_from_bag(request, item_id):
     """
     try:
         # collects the product for use in messages
-        product = get_object_or_404(Product, pk=item_id)
+        product = get_product_or_404(request, item_id)
         size = None
         if 'product_size' in request.POST:
             size = request.POST['product_size']
-        bag = request.session.get('bag', {})  # get or create
+        bag = get_bag(request)
 
+        bag.remove(product.id, size)
         if size:
-            del bag[item_id]['items_by_size'][size]
-            if not bag[item_id]['items_by_size']:
-                bag.pop(item_id)
             messages.success(request, f'Removed size {size.upper()} {product.name} from your bag')  # noqa
         else:
-            bag.pop(item_id)
             messages.success(request, f'Removed {product.name} from your bag')
 
-        request.session['bag'] = bag
+        save_bag(request, bag)
         return HttpResponse(status=200)
 
     except Exception as e:
         messages.error(request, f'Error removing item: {e}')
         return HttpResponse(status=500)
+
+
+def _apply_operation(bag, operation):
+    """
+    Apply a single add, adjust or remove operation to the bag.
+    Raises BagError if the operation isn't valid.
+    """
+    if not isinstance(operation, dict) or operation.get('op') not in BAG_OPERATIONS:  # noqa
+        raise BagError('Unknown operation')
+    try:
+        item_id = int(operation['item_id'])
+        size = operation.get('size') or None
+        quantity = int(operation.get('quantity', 0))
+    except (KeyError, TypeError, ValueError) as e:
+        raise BagError(f'Invalid operation: {e}') from e
+    if size is not None and not isinstance(size, str):
+        raise BagError('Invalid size')
+
+    if operation['op'] == 'add':
+        if quantity < 1:
+            raise BagError('Quantity must be at least 1')
+        bag.add(item_id, size, quantity)
+    elif operation['op'] == 'adjust':
+        bag.set(item_id, size, quantity)
+    else:
+        bag.remove(item_id, size)
+
+
+def _format_money(value):
+    """ Money as a string with two decimal places for the bag API """
+    return f'{value:.2f}'
+
+
+@require_POST
+def update_bag(request):
+    """
+    Apply several changes to the bag in one request, returning JSON.
+
+    The request body is JSON with a list of operations, e.g.
+    {"operations": [
+        {"op": "add", "item_id": 12, "quantity": 1},
+        {"op": "adjust", "item_id": 15, "size": "m", "quantity": 3},
+        {"op": "remove", "item_id": 15, "size": "l"}
+    ]}
+    adjust sets the quantity, a quantity of zero removes the item.
+
+    The operations are applied together, if any of them is invalid
+    or refers to a product that doesn't exist,
+    none are applied and a 400 is returned with the error.
+    Otherwise the bag is saved and the new totals returned,
+    along with the quantity and subtotal of every item,
+    so the page can be updated in place without reloading.
+    No messages are added, the page shows the changes itself.
+    """
+    try:
+        operations = json.loads(request.body)['operations']
+        if not isinstance(operations, list):
+            raise BagError('operations must be a list')
+        bag = get_bag(request)
+        for operation in operations:
+            _apply_operation(bag, operation)
+        # the prices are fetched in one query for the new totals,
+        # any product changed that's still in the bag must have one.
+        summary = get_bag_summary(request, bag)
+        missing = (
+            {int(operation['item_id']) for operation in operations}
+            & set(bag.product_ids())
+        ) - {line['item_id'] for line in summary['lines']}
+        if missing:
+            raise BagError(f'Product {min(missing)} not found')
+    except (BagError, KeyError, TypeError, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    save_bag(request, bag)
+    return JsonResponse({
+        'lines': [
+            {**line, 'subtotal': _format_money(line['subtotal'])}
+            for line in summary['lines']
+        ],
+        'product_count': summary['product_count'],
+        'total': _format_money(summary['total']),
+        'delivery': _format_money(summary['delivery']),
+        'free_delivery_delta': _format_money(summary['free_delivery_delta']),
+        'grand_total': _format_money(summary['grand_total']),
+    })
@@ -0,0 +1,88 @@
+""" This module contains the work queues kept in database tables """
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+
+class TableQueue:
+    """
+    A queue of rows worked on in the background, with the claiming,
+    retrying and giving up shared by the outbox (see outbox/sender.py)
+    and the stripe webhook events (see checkout/webhook_queue.py).
+
+    The model needs status, attempts, next_attempt_at, locked_at
+    and last_error fields.
+    A row waits as pending until next_attempt_at,
+    is working while a worker has it claimed,
+    and is failed once it can't be done.
+    The settings are read by prefix, e.g. WEBHOOK_RETRY_DELAY:
+    RETRY_DELAY and RETRY_MAX_DELAY for the delay between attempts,
+    MAX_ATTEMPTS, and LOCK_TIMEOUT for when a claim is abandoned.
+    """
+
+    def __init__(self, model, pending, working, failed, settings_prefix):
+        self.model = model
+        self.pending = pending
+        self.working = working
+        self.failed = failed
+        self.settings_prefix = settings_prefix
+
+    def setting(self, name):
+        """ Return the queue's setting, e.g. setting('MAX_ATTEMPTS') """
+        return getattr(settings, f'{self.settings_prefix}_{name}')
+
+    def retry_delay(self, attempts):
+        """
+        Return how long to wait before the next attempt,
+        doubling after each failed attempt up to a limit.
+        """
+        delay = self.setting('RETRY_DELAY') * 2 ** (attempts - 1)
+        return timedelta(seconds=min(delay, self.setting('RETRY_MAX_DELAY')))
+
+    def due(self):
+        """
+        The rows ready to be worked on, pending rows whose time has come,
+        and rows a worker claimed but never finished, i.e. it crashed.
+        """
+        now = timezone.now()
+        stale = now - timedelta(seconds=self.setting('LOCK_TIMEOUT'))
+        return (Q(status=self.pending, next_attempt_at__lte=now)
+                | Q(status=self.working, locked_at__lt=stale))
+
+    def claim(self, limit):
+        """
+        Claim up to limit due rows, oldest first.
+        Each is claimed with a conditional update,
+        so when several workers run at once a row is only claimed by one.
+        Returns the ids of the claimed rows.
+        """
+        due = self.due()
+        candidates = self.model.objects.filter(due).order_by(
+            'next_attempt_at', 'pk').values_list('pk', flat=True)[:limit]
+        claimed = []
+        for pk in candidates:
+            if self.model.objects.filter(due, pk=pk).update(
+                    status=self.working, locked_at=timezone.now(),
+                    attempts=F('attempts') + 1):
+                claimed.append(pk)
+        return claimed
+
+    def fail(self, row, error, permanent=False):
+        """
+        Record a failed attempt at a claimed row, to be retried
+        after retry_delay, or failed for good if the error is permanent
+        or the row has had MAX_ATTEMPTS.
+        Returns the new status of the row.
+        """
+        if permanent or row.attempts >= self.setting('MAX_ATTEMPTS'):
+            status, next_attempt_at = self.failed, row.next_attempt_at
+        else:
+            status = self.pending
+            next_attempt_at = timezone.now() + self.retry_delay(row.attempts)
+        self.model.objects.filter(pk=row.pk).update(
+            status=status, next_attempt_at=next_attempt_at, locked_at=None,
+            last_error=f'{type(error).__name__}: {error}')
+        return status
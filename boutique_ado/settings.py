@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 from pathlib import Path
 import os
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 
 if os.path.isfile('env.py'):
     import env
@@ -54,6 +55,7 @@ INSTALLED_APPS = [
     'bag',
     'checkout',
     'profiles',
+    'outbox',
 
     # Other
     'crispy_forms',
@@ -100,9 +102,46 @@ TEMPLATES = [
     },
 ]
 
-# Allows messages to be stored in the session
+# Sessions
+# SESSION_MODE picks where sessions are kept
+# db: in the database, every change to the session is a row update.
+# cache: cached_db, read from the sessions cache and written through
+# to the database, SESSION_CACHE_BACKEND and SESSION_CACHE_LOCATION
+# must name a cache every process shares, such as memcached.
+# cookie: signed cookies, nothing is stored on the server,
+# the compact bag (see bag/codec.py) is small enough to fit.
+# see bag/management/commands/benchmark_session_writes.py
+
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cache': 'django.contrib.sessions.backends.cached_db',
+    'cookie': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_MODE = os.environ.get('SESSION_MODE', 'db')
+SESSION_ENGINE = SESSION_ENGINES[SESSION_MODE]
+SESSION_CACHE_ALIAS = 'sessions'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# a cache local to each process would lose sessions between processes
+if SESSION_MODE == 'cache':
+    if not os.environ.get('SESSION_CACHE_BACKEND'):
+        raise ImproperlyConfigured(
+            'SESSION_MODE=cache needs SESSION_CACHE_BACKEND set '
+            'to a cache every process shares, such as memcached')
+    CACHES[SESSION_CACHE_ALIAS] = {
+        'BACKEND': os.environ['SESSION_CACHE_BACKEND'],
+        'LOCATION': os.environ.get('SESSION_CACHE_LOCATION', ''),
+    }
 
-MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
+# Messages are kept in a cookie, not the session
+# so flashing a message never writes the session.
+
+MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
 
 AUTHENTICATION_BACKENDS = [
     # Needed to login by username in Django admin, regardless of `allauth`
@@ -230,15 +269,70 @@ if 'USE_AWS' in os.environ:
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Product search
+# the backend is picked from the database in use unless named here.
+# see products/search.py
+# limit is the most results a single search will return
+
+PRODUCT_SEARCH_BACKEND = os.environ.get('PRODUCT_SEARCH_BACKEND')
+PRODUCT_SEARCH_LIMIT = 500
+
+# Product listing pages
+# keep the page size a multiple of 12 so the row dividers in
+# products.html line up when more products are loaded onto the page.
+# pages of the listing and the product counts are cached for this many
+# seconds, any change to the catalog invalidates them straight away.
+
+PRODUCTS_PER_PAGE = 24
+PRODUCTS_CACHE_TIMEOUT = 60 * 60
+
+# Products read by the bag, product and checkout pages are kept
+# in each worker process, up to this many (see products/product_cache.py)
+
+PRODUCT_CACHE_SIZE = 1000
+
+# Product image derivatives
+# see products/images.py
+# each product image is resized to these widths in webp and jpeg,
+# widths wider than the original image are skipped.
+
+PRODUCT_IMAGE_WIDTHS = (320, 640, 960)
+PRODUCT_IMAGE_QUALITY = 80
+
 # Stripe, inc Delivery cost variables
 
 FREE_DELIVERY_THRESHOLD = 50
 STANDARD_DELIVERY_PERCENTAGE = 10
+# priced bag totals are cached for this many seconds, see bag/contexts.py
+BAG_CACHE_TIMEOUT = 60 * 60
 STRIPE_CURRENCY = 'usd'
 STRIPE_PUBLIC_KEY = os.environ.get('STRIPE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
 STRIPE_WH_SECRET = os.environ.get('STRIPE_WH_SECRET')
 
+# The payment gateway, see checkout/gateways.py
+# checkout.gateways.FakeGateway runs checkout without stripe,
+# e.g. for load testing, never set it in production.
+# Stripe is called over a pool of STRIPE_POOL_SIZE kept alive connections,
+# giving up after the connect and read timeouts in seconds.
+PAYMENT_GATEWAY = os.environ.get(
+    'PAYMENT_GATEWAY', 'checkout.gateways.StripeGateway')
+STRIPE_CONNECT_TIMEOUT = 5
+STRIPE_READ_TIMEOUT = 20
+STRIPE_POOL_SIZE = 10
+
+# Webhook queue, see checkout/webhook_queue.py
+# a failed event is retried after WEBHOOK_RETRY_DELAY seconds,
+# doubling each time up to WEBHOOK_RETRY_MAX_DELAY,
+# and is dead after WEBHOOK_MAX_ATTEMPTS.
+# An event claimed by a worker for longer than WEBHOOK_LOCK_TIMEOUT
+# is assumed to have been abandoned and is claimed again.
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_RETRY_DELAY = 30
+WEBHOOK_RETRY_MAX_DELAY = 60 * 60
+WEBHOOK_LOCK_TIMEOUT = 5 * 60
+WEBHOOK_WORKERS = 4
+
 # Email Settings
 
 # check if development is in os.environ.
@@ -251,14 +345,29 @@ STRIPE_WH_SECRET = os.environ.get('STRIPE_WH_SECRET')
 # then the email username and password and default from
 # these are set in the heroku config vars
 
+# Every email is saved to the outbox and sent later
+# by the send_outbox command, with the backend above (see outbox/sender.py)
+# a failed email is retried after OUTBOX_RETRY_DELAY seconds,
+# doubling each time up to OUTBOX_RETRY_MAX_DELAY,
+# and has failed for good after OUTBOX_MAX_ATTEMPTS.
+# At most OUTBOX_RATE_LIMIT emails are sent each second.
+
 if 'DEVELOPMENT' in os.environ:
-    EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+    OUTBOX_EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
     DEFAULT_FROM_EMAIL = 'boutiqueado@example.com'
 else:
-    EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    OUTBOX_EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    EMAIL_TIMEOUT = 30
     EMAIL_USE_TLS = True
     EMAIL_PORT = 587
     EMAIL_HOST = 'smtp.gmail.com'
     EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
     EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASS')
     DEFAULT_FROM_EMAIL = os.environ.get('EMAIL_HOST_USER')
+
+EMAIL_BACKEND = 'outbox.backends.OutboxEmailBackend'
+OUTBOX_MAX_ATTEMPTS = 6
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_RETRY_MAX_DELAY = 60 * 60
+OUTBOX_LOCK_TIMEOUT = 10 * 60
+OUTBOX_RATE_LIMIT = 5
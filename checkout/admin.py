@@ -1,7 +1,9 @@
 """ This module contains the admin logic for the checkout app """
 
 from django.contrib import admin
-from .models import Order, OrderLineItem
+from django.utils import timezone
+from .models import Order, OrderLineItem, WebhookEvent
+from .signals import deferred_order_totals
 
 
 class OrderLineItemAdminInline(admin.TabularInline):
@@ -29,6 +31,9 @@ class OrderAdmin(admin.ModelAdmin):
     stays the same as it appears in the model.
 
     Ordered by date in reverse chronological order
+
+    The inline line items are saved inside deferred_order_totals,
+    so the order total is recalculated once however many rows changed.
     """
     inlines = (OrderLineItemAdminInline,)
 
@@ -49,3 +54,35 @@ class OrderAdmin(admin.ModelAdmin):
                     'grand_total',)
 
     ordering = ('-date',)
+
+    def save_related(self, request, form, formsets, change):
+        with deferred_order_totals():
+            super().save_related(request, form, formsets, change)
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    """
+    The admin class for the queued stripe webhook events.
+
+    Read only, as the events are exactly what stripe sent.
+    Dead events can be queued again with the retry action
+    once whatever made them fail is fixed.
+    """
+    list_display = ('event_id', 'event_type', 'status',
+                    'attempts', 'next_attempt_at', 'created_at',)
+    list_filter = ('status', 'event_type',)
+    search_fields = ('event_id',)
+    readonly_fields = ('event_id', 'event_type', 'payload', 'status',
+                       'attempts', 'next_attempt_at', 'locked_at',
+                       'last_error', 'created_at', 'processed_at',)
+    ordering = ('-created_at',)
+    actions = ('retry_events',)
+
+    @admin.action(description='Retry selected events')
+    def retry_events(self, request, queryset):
+        """ Queue the events again, with a fresh set of attempts """
+        count = queryset.exclude(status=WebhookEvent.PROCESSING).update(
+            status=WebhookEvent.PENDING, attempts=0,
+            next_attempt_at=timezone.now(), locked_at=None)
+        self.message_user(request, f'{count} events queued again')
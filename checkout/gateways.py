@@ -0,0 +1,247 @@
+""" This module contains the payment gateways used by checkout """
+
+import abc
+import functools
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from urllib.parse import quote
+
+import requests
+import stripe
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+from stripe.api_requestor import APIRequestor
+from stripe.http_client import RequestsClient
+from stripe.util import convert_to_stripe_object
+
+
+class GatewayError(Exception):
+    """ Raised when the payment gateway can't do what was asked """
+
+
+class InvalidRequestError(GatewayError):
+    """
+    Raised when the gateway refuses a request outright,
+    e.g. modifying an intent that has already been paid.
+    """
+
+
+class WebhookSignatureError(GatewayError):
+    """ Raised for a webhook event that isn't signed by the gateway """
+
+
+class PaymentGateway(abc.ABC):
+    """
+    The payment gateway interface, what checkout needs from stripe.
+    Each gateway implements the intent methods.
+
+    Intents and events are returned as stripe objects,
+    so they can be read the same way whichever gateway made them.
+    Amounts are in the smallest currency unit, as stripe takes them.
+
+    Webhook events are signed the way stripe signs them,
+    with the webhook secret, so verifying them is the same for every gateway.
+    """
+
+    def __init__(self, secret_key=None, webhook_secret=None):
+        self.secret_key = secret_key
+        self.webhook_secret = webhook_secret
+
+    @abc.abstractmethod
+    def create_intent(self, amount, currency):
+        """ Create a payment intent for an amount """
+
+    @abc.abstractmethod
+    def modify_intent(self, intent_id, **params):
+        """
+        Change a payment intent, e.g. its amount.
+        Raises InvalidRequestError if it can't be changed any more.
+        """
+
+    @abc.abstractmethod
+    def retrieve_intent(self, intent_id):
+        """ Return a payment intent by its id """
+
+    def construct_event(self, payload, signature):
+        """
+        Return the webhook event a payload is, after checking its signature.
+        Raises WebhookSignatureError if the signature doesn't match,
+        or ValueError if the payload isn't an event at all.
+        """
+        try:
+            return stripe.Webhook.construct_event(
+                payload, signature, self.webhook_secret)
+        except stripe.error.SignatureVerificationError as e:
+            raise WebhookSignatureError(str(e)) from e
+
+    def parse_event(self, payload):
+        """ Return the event a payload already verified is """
+        return stripe.Event.construct_from(
+            json.loads(payload), self.secret_key)
+
+
+class StripeGateway(PaymentGateway):
+    """
+    The stripe API.
+
+    Requests go through one pooled HTTP session per process,
+    so connections to stripe are kept alive and reused
+    rather than opened for each request,
+    with explicit connect and read timeouts
+    so a slow stripe can't hold a web worker for long.
+    """
+
+    def __init__(self, secret_key=None, webhook_secret=None):
+        super().__init__(secret_key, webhook_secret)
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=settings.STRIPE_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.client = RequestsClient(
+            timeout=(settings.STRIPE_CONNECT_TIMEOUT,
+                     settings.STRIPE_READ_TIMEOUT),
+            session=session)
+
+    def _request(self, method, url, **params):
+        """
+        Make a request to the stripe API with the pooled client,
+        returning the response as a stripe object.
+        """
+        requestor = APIRequestor(key=self.secret_key, client=self.client)
+        try:
+            response, api_key = requestor.request(method, url, params)
+        except stripe.error.InvalidRequestError as e:
+            raise InvalidRequestError(str(e)) from e
+        except stripe.error.StripeError as e:
+            raise GatewayError(str(e)) from e
+        return convert_to_stripe_object(response, api_key)
+
+    def create_intent(self, amount, currency):
+        return self._request(
+            'post', '/v1/payment_intents', amount=amount, currency=currency)
+
+    def modify_intent(self, intent_id, **params):
+        return self._request(
+            'post', f'/v1/payment_intents/{quote(intent_id)}', **params)
+
+    def retrieve_intent(self, intent_id):
+        return self._request('get', f'/v1/payment_intents/{quote(intent_id)}')
+
+
+class FakeGateway(PaymentGateway):
+    """
+    An in-process stand-in for stripe, for tests and load testing
+    checkout without the network.
+
+    Intents are kept in memory. confirm_intent pays one
+    and returns its payment_intent.succeeded event, signed with
+    the webhook secret exactly as stripe would sign it,
+    ready to post to the webhook.
+    """
+
+    def __init__(self, secret_key=None, webhook_secret=None):
+        super().__init__(secret_key, webhook_secret or 'whsec_fake')
+        self.intents = {}
+        self._lock = threading.Lock()
+
+    def _intent(self, intent_id):
+        """ Return an intent as a stripe object """
+        return stripe.PaymentIntent.construct_from(
+            self.intents[intent_id], self.secret_key)
+
+    def create_intent(self, amount, currency):
+        intent_id = f'pi_fake_{uuid.uuid4().hex[:24]}'
+        with self._lock:
+            self.intents[intent_id] = {
+                'id': intent_id,
+                'object': 'payment_intent',
+                'amount': amount,
+                'currency': currency,
+                'client_secret': f'{intent_id}_secret_{uuid.uuid4().hex[:24]}',  # noqa
+                'status': 'requires_payment_method',
+                'metadata': {},
+            }
+            return self._intent(intent_id)
+
+    def modify_intent(self, intent_id, **params):
+        with self._lock:
+            intent = self.intents.get(intent_id)
+            if intent is None:
+                raise InvalidRequestError(f'No such payment_intent: {intent_id}')  # noqa
+            if intent['status'] in ('succeeded', 'canceled'):
+                raise InvalidRequestError(
+                    f'This PaymentIntent could not be updated '
+                    f'because it has a status of {intent["status"]}')
+            intent.update(params)
+            return self._intent(intent_id)
+
+    def retrieve_intent(self, intent_id):
+        with self._lock:
+            if intent_id not in self.intents:
+                raise InvalidRequestError(f'No such payment_intent: {intent_id}')  # noqa
+            return self._intent(intent_id)
+
+    def sign(self, payload, timestamp=None):
+        """
+        Return the stripe signature header for a payload,
+        an HMAC-SHA256 of the timestamp and payload with the webhook secret.
+        """
+        timestamp = int(timestamp or time.time())
+        signature = hmac.new(
+            self.webhook_secret.encode(), f'{timestamp}.'.encode() + payload,
+            hashlib.sha256).hexdigest()
+        return f't={timestamp},v1={signature}'
+
+    def confirm_intent(self, intent_id, email, shipping):
+        """
+        Pay an intent, as the card payment in the checkout page does.
+        shipping is the name, phone and address as stripe.js sends it.
+        Returns the signed payment_intent.succeeded event
+        as the payload and signature header stripe would post.
+        """
+        with self._lock:
+            intent = self.intents[intent_id]
+            intent['status'] = 'succeeded'
+            intent['shipping'] = shipping
+            intent['charges'] = {'object': 'list', 'data': [{
+                'object': 'charge',
+                'amount': intent['amount'],
+                'billing_details': {
+                    'email': email, 'address': shipping['address']},
+            }]}
+            event = {
+                'id': f'evt_fake_{uuid.uuid4().hex[:24]}',
+                'object': 'event',
+                'type': 'payment_intent.succeeded',
+                'created': int(time.time()),
+                'data': {'object': intent},
+            }
+            payload = json.dumps(event).encode()
+        return payload, self.sign(payload)
+
+
+@functools.lru_cache(maxsize=None)
+def get_gateway():
+    """
+    Return the payment gateway named by PAYMENT_GATEWAY,
+    one per process so its connections are reused.
+    """
+    gateway_class = import_string(settings.PAYMENT_GATEWAY)
+    return gateway_class(
+        secret_key=settings.STRIPE_SECRET_KEY,
+        webhook_secret=settings.STRIPE_WH_SECRET)
+
+
+@receiver(setting_changed)
+def reset_gateway(setting, **kwargs):
+    """ Make the gateway again when tests change its settings """
+    if setting.startswith(('PAYMENT_GATEWAY', 'STRIPE_')):
+        get_gateway.cache_clear()
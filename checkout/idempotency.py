@@ -0,0 +1,62 @@
+""" This module contains the idempotency records for payments """
+
+import hashlib
+
+from django.db import IntegrityError, transaction
+
+from .models import IdempotencyRecord
+
+
+def event_key(event_id):
+    """ The key for a handled stripe webhook event """
+    return f'event:{event_id}'
+
+
+def payment_intent_key(pid):
+    """ The key for the confirmation of a stripe payment intent """
+    return f'payment_intent:{pid}'
+
+
+def client_secret_key(client_secret):
+    """
+    The key for a checkout form submitted with a payment intent's
+    client secret. Hashed, as the secret itself shouldn't be stored.
+    """
+    digest = hashlib.sha256(client_secret.encode()).hexdigest()
+    return f'client_secret:{digest}'
+
+
+def get_record(key):
+    """ Return the record stored for a key with its order, or None """
+    return IdempotencyRecord.objects.select_related('order').filter(
+        key=key).first()
+
+
+def save_record(key, order=None, response=None):
+    """
+    Store the outcome for a key, the order and or response it produced.
+    If an outcome was already stored, e.g. by a request at the same time,
+    that one is kept and returned.
+    """
+    try:
+        with transaction.atomic():
+            return IdempotencyRecord.objects.create(
+                key=key, order=order,
+                status_code=response.status_code if response else 200,
+                content=response.content.decode() if response else '')
+    except IntegrityError:
+        return IdempotencyRecord.objects.get(key=key)
+
+
+def claim(key, order=None):
+    """
+    Record a key the first time, returning whether this was it.
+    Used as, with transaction.atomic(): if claim(key): do_it(),
+    so if doing it fails the claim is rolled back too.
+    """
+    try:
+        with transaction.atomic():
+            IdempotencyRecord.objects.create(key=key, order=order)
+    except IntegrityError:
+        return False
+    return True
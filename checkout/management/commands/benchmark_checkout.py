@@ -0,0 +1,139 @@
+""" This module contains the load test of checkout with the fake gateway """
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.test import Client
+from django.test.utils import (
+    override_settings, setup_test_environment, teardown_test_environment)
+from django.urls import reverse
+
+from checkout.gateways import get_gateway
+from checkout.models import Order
+from checkout.webhook_queue import process_due_events
+from products.models import Product
+
+ORDER_DETAILS = {
+    'full_name': 'Ada Lovelace',
+    'email': 'ada@example.com',
+    'phone_number': '0123456789',
+    'country': 'GB',
+    'postcode': 'N1 1AA',
+    'town_or_city': 'London',
+    'street_address1': '1 Analytical Street',
+    'street_address2': '',
+    'county': '',
+}
+
+SHIPPING = {
+    'name': ORDER_DETAILS['full_name'],
+    'phone': ORDER_DETAILS['phone_number'],
+    'address': {
+        'line1': ORDER_DETAILS['street_address1'], 'line2': '',
+        'city': ORDER_DETAILS['town_or_city'], 'state': '',
+        'postal_code': ORDER_DETAILS['postcode'],
+        'country': ORDER_DETAILS['country'],
+    },
+}
+
+
+def checkout(client, gateway, products):
+    """
+    Check out as a shopper would, with the requests the browser makes.
+    Fill the bag, visit the checkout page, cache the checkout data,
+    pay with the fake gateway and post its signed event to the webhook,
+    then submit the checkout form.
+    Returns the response to the form.
+    """
+    for product in products:
+        client.post(reverse('add_to_bag', args=[product.id]), {
+            'quantity': 1, 'product_size': 'm' if product.has_sizes else '',
+            'redirect_url': '/'})
+    client_secret = client.get(reverse('checkout')).context['client_secret']
+    client.post(reverse('cache_checkout_data'), {
+        'client_secret': client_secret, 'save_info': 'false'})
+    payload, signature = gateway.confirm_intent(
+        client_secret.split('_secret')[0], ORDER_DETAILS['email'], SHIPPING)
+    client.post(
+        reverse('webhook'), payload, content_type='application/json',
+        HTTP_STRIPE_SIGNATURE=signature)
+    return client.post(reverse('checkout'), {
+        **ORDER_DETAILS, 'client_secret': client_secret})
+
+
+class Command(BaseCommand):
+    """
+    Time complete checkouts against the fake payment gateway
+    (see gateways.py), so checkout can be load tested without stripe.
+    Each checkout is a new shopper making every request of the flow,
+    the queued webhook events are then handled as process_webhooks would.
+    Runs in a throwaway test database, leaving the real one untouched.
+
+    SQLite locks the whole database for each write,
+    so the webhook events are handled by one worker there by default.
+    More workers need Postgres.
+    """
+    help = 'Time complete checkouts against the fake payment gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--checkouts', type=int, default=500,
+            help='Number of checkouts to run')
+        parser.add_argument(
+            '--workers', type=int,
+            help='Number of threads handling the webhook events, '
+                 'default 1 on SQLite and 4 otherwise')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers is None:
+            workers = 1 if connection.vendor == 'sqlite' else 4
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            with override_settings(
+                    PAYMENT_GATEWAY='checkout.gateways.FakeGateway'):
+                self._run(options['checkouts'], workers)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def _run(self, checkouts, workers):
+        """ Run the checkouts and report how long they took """
+        products = [
+            Product.objects.create(
+                name='Shirt', description='A shirt', price=20, has_sizes=True),
+            Product.objects.create(
+                name='Mug', description='A mug', price=8),
+        ]
+        gateway = get_gateway()
+
+        started = time.perf_counter()
+        failed = sum(
+            checkout(Client(), gateway, products).status_code != 302
+            for _ in range(checkouts))
+        checked_out = time.perf_counter()
+        handled = {}
+        while True:
+            try:
+                results = process_due_events(workers=workers)
+            except OperationalError as e:
+                raise CommandError(
+                    f'Handling webhook events failed with {workers} workers: '
+                    f'{e}. Use --workers 1 on SQLite, or Postgres.') from e
+            if not results:
+                break
+            handled.update(results)
+        finished = time.perf_counter()
+
+        elapsed = checked_out - started
+        self.stdout.write(
+            f'{checkouts} checkouts in {elapsed:.1f}s, '
+            f'{checkouts / elapsed * 60:.0f} per minute, {failed} failed')
+        self.stdout.write(
+            f'{len(handled)} webhook events handled '
+            f'in {finished - checked_out:.1f}s')
+        self.stdout.write(
+            f'{Order.objects.count()} orders, '
+            f'{len(gateway.intents)} payment intents')
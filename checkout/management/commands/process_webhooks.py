@@ -0,0 +1,61 @@
+""" This module contains the command to handle queued webhook events """
+
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from checkout.models import WebhookEvent
+from checkout.webhook_queue import process_due_events
+
+
+class Command(BaseCommand):
+    """
+    Handle the stripe webhook events saved by the webhook view
+    (see webhook_queue.py), in a pool of threads.
+    Runs until stopped, checking for due events every poll interval,
+    or with --once handles every event that is due and exits,
+    e.g. to run from a scheduler.
+    Failed events are retried later with a growing delay,
+    events that keep failing are marked dead and reported.
+    """
+    help = 'Handle queued stripe webhook events'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=settings.WEBHOOK_WORKERS,
+            help='Number of worker threads')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of events to claim at a time')
+        parser.add_argument(
+            '--poll-interval', type=float, default=2,
+            help='Seconds to wait when no events are due')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Handle the events that are due, then exit')
+
+    def handle(self, *args, **options):
+        totals = Counter()
+        try:
+            while True:
+                results = process_due_events(
+                    workers=options['workers'],
+                    batch_size=options['batch_size'])
+                totals.update(results.values())
+                for pk, status in results.items():
+                    if status == WebhookEvent.DEAD:
+                        self.stderr.write(f'Webhook event {pk} is dead')
+                if not results:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(
+            'Handled webhook events: ' + ', '.join(
+                f'{totals[status]} {status}'
+                for status in (
+                    WebhookEvent.DONE, WebhookEvent.PENDING,
+                    WebhookEvent.DEAD))))
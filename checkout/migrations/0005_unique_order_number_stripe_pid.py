@@ -0,0 +1,41 @@
+# Generated by Django 3.2.12 on 2026-10-18 03:09
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def mark_duplicate_stripe_pids(apps, schema_editor):
+    """
+    Orders created twice for the same payment, by the view and the webhook,
+    keep their stripe_pid on the first and have it marked on the rest,
+    so the unique constraint can be added without losing any orders.
+    """
+    Order = apps.get_model('checkout', 'Order')
+    duplicates = (
+        Order.objects.exclude(stripe_pid='').values('stripe_pid')
+        .annotate(count=Count('id')).filter(count__gt=1)
+        .values_list('stripe_pid', flat=True))
+    for pid in list(duplicates):
+        for order in Order.objects.filter(stripe_pid=pid).order_by('id')[1:]:
+            order.stripe_pid = f'{pid}-duplicate-{order.id}'
+            order.save(update_fields=['stripe_pid'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0004_order_user_profile'),
+    ]
+
+    operations = [
+        migrations.RunPython(mark_duplicate_stripe_pids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='order_number',
+            field=models.CharField(editable=False, max_length=32, unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('stripe_pid', ''), _negated=True), fields=('stripe_pid',), name='unique_order_stripe_pid'),
+        ),
+    ]
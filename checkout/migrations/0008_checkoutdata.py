@@ -0,0 +1,24 @@
+# Generated by Django 3.2.12 on 2026-10-18 03:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0007_idempotencyrecord'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckoutData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe_pid', models.CharField(max_length=254, unique=True)),
+                ('bag', models.TextField()),
+                ('save_info', models.BooleanField(default=False)),
+                ('username', models.CharField(blank=True, default='', max_length=150)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
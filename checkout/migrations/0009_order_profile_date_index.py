@@ -0,0 +1,25 @@
+# Generated by Django 3.2.12 on 2026-10-18 03:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('profiles', '0001_initial'),
+        ('checkout', '0008_checkoutdata'),
+    ]
+
+    operations = [
+        # the new index replaces the one on user_profile alone
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user_profile', '-date'], name='order_profile_date'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='user_profile',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='orders', to='profiles.userprofile'),
+        ),
+    ]
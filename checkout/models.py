@@ -4,6 +4,7 @@ import uuid
 
 from django.db import models
 from django.db.models import Sum
+from django.utils import timezone
 from django.conf import settings
 from django_countries.fields import CountryField
 
@@ -11,6 +12,18 @@ from products.models import Product
 from profiles.models import UserProfile
 
 
+class OrderQuerySet(models.QuerySet):
+    """ Lookups for orders """
+
+    def for_payment_intent(self, pid):
+        """
+        The order for a stripe payment intent id.
+        Excluding blank ids, as the unique index on stripe_pid does,
+        lets the database use that index for the lookup.
+        """
+        return self.filter(stripe_pid=pid).exclude(stripe_pid='')
+
+
 class Order(models.Model):
     """
     when a user checks out.
@@ -38,9 +51,34 @@ class Order(models.Model):
     account can still make purchases.
     related name of orders so we can access
     the users orders by calling something like user.userprofile.orders
+
+    order_number is unique, and so is stripe_pid for the orders that have one,
+    each with an index so orders can be looked up by either.
+    The checkout view and the webhook rely on stripe_pid being unique
+    to never create the same order twice (see webhook_handler.py).
     """
-    order_number = models.CharField(max_length=32, null=False, editable=False)
-    user_profile = models.ForeignKey(UserProfile, on_delete=models.SET_NULL, null=True, blank=True, related_name='orders')  # noqa
+    class Meta:
+        """
+        stripe_pid is blank for orders added in the admin,
+        so only the orders with one have to be unique.
+        A profile's orders are listed newest first from one index,
+        which also serves lookups by user_profile alone.
+        """
+        constraints = [
+            models.UniqueConstraint(
+                fields=['stripe_pid'], condition=~models.Q(stripe_pid=''),
+                name='unique_order_stripe_pid'),
+        ]
+        indexes = [
+            models.Index(
+                fields=['user_profile', '-date'],
+                name='order_profile_date'),
+        ]
+
+    objects = OrderQuerySet.as_manager()
+
+    order_number = models.CharField(max_length=32, null=False, editable=False, unique=True)  # noqa
+    user_profile = models.ForeignKey(UserProfile, on_delete=models.SET_NULL, null=True, blank=True, related_name='orders', db_index=False)  # noqa
     full_name = models.CharField(max_length=50, null=False, blank=False)
     email = models.EmailField(max_length=254, null=False, blank=False)
     phone_number = models.CharField(max_length=20, null=False, blank=False)
@@ -98,13 +136,23 @@ class Order(models.Model):
         then calculate the delivery cost using the free delivery threshold
         and the standard delivery percentage from settings file.
         """
-        self.order_total = self.lineitems.aggregate(Sum('lineitem_total'))['lineitem_total__sum'] or 0  # noqa
+        order_total = self.lineitems.aggregate(Sum('lineitem_total'))['lineitem_total__sum'] or 0  # noqa
+        self.set_totals(order_total)
+        self.save()
+
+    def set_totals(self, order_total):
+        """
+        Set the order total, delivery cost and grand total
+        from the total of the line items, without saving.
+        Used by update_total, and by the order builder (see orders.py)
+        which adds up the line items itself.
+        """
+        self.order_total = order_total
         if self.order_total < settings.FREE_DELIVERY_THRESHOLD:
             self.delivery_cost = self.order_total * settings.STANDARD_DELIVERY_PERCENTAGE / 100  # noqa
         else:
             self.delivery_cost = 0
         self.grand_total = self.order_total + self.delivery_cost
-        self.save()
 
     def save(self, *args, **kwargs):
         """
@@ -146,3 +194,99 @@ class OrderLineItem(models.Model):
     # pylint: disable=no-member
     def __str__(self):
         return f'SKU {self.product.sku} on order {self.order.order_number}'
+
+
+class WebhookEvent(models.Model):
+    """
+    A verified stripe webhook event waiting to be handled.
+
+    The webhook view only checks the signature and saves the event here,
+    so stripe gets its response straight away however busy the site is.
+    The process_webhooks command then handles the events in the background
+    with the webhook handler (see webhook_queue.py).
+
+    event_id is stripe's id for the event, unique so an event
+    stripe sends more than once is only queued once.
+    An event that fails is retried after a growing delay, next_attempt_at,
+    until it has failed WEBHOOK_MAX_ATTEMPTS times and is marked dead,
+    to be looked at in the admin.
+    """
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    DEAD = 'dead'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (DEAD, 'Dead'),
+    ]
+
+    class Meta:
+        """ The worker looks for pending events that are due """
+        indexes = [
+            models.Index(
+                fields=['status', 'next_attempt_at'],
+                name='webhook_event_due'),
+        ]
+
+    event_id = models.CharField(max_length=254, unique=True)
+    event_type = models.CharField(max_length=254)
+    payload = models.TextField()
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.event_type} {self.event_id} ({self.status})'
+
+
+class IdempotencyRecord(models.Model):
+    """
+    The outcome of something that must only happen once,
+    so a repeat of it returns the stored outcome instead (see idempotency.py).
+
+    key says what it was, e.g. 'event:evt_123' for a handled webhook event,
+    'payment_intent:pi_123' for the confirmation email of a payment,
+    or 'client_secret:<hash>' for a submitted checkout form.
+    It is unique, so the outcome is found with a single indexed lookup,
+    and two attempts at the same time can't both record one.
+    """
+    key = models.CharField(max_length=254, unique=True)
+    order = models.ForeignKey(
+        Order, null=True, blank=True, on_delete=models.SET_NULL,
+        related_name='+')
+    status_code = models.PositiveSmallIntegerField(default=200)
+    content = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key
+
+
+class CheckoutData(models.Model):
+    """
+    What the webhook needs to know about a checkout
+    that stripe doesn't, saved when the checkout form is submitted
+    (see cache_checkout_data in views.py).
+    The shopping bag in its compact encoding (see bag/codec.py),
+    whether the user wanted their info saved, and their username,
+    blank for a user who isn't logged in.
+
+    Kept here by payment intent id, stripe_pid, rather than
+    in the payment intent's metadata, so submitting the form
+    doesn't wait on stripe and the bag isn't limited by stripe's metadata.
+    """
+    stripe_pid = models.CharField(max_length=254, unique=True)
+    bag = models.TextField()
+    save_info = models.BooleanField(default=False)
+    username = models.CharField(max_length=150, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.stripe_pid
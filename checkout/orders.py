@@ -0,0 +1,57 @@
+""" This module contains the service that creates orders from a bag """
+
+from django.db import transaction
+
+from .models import OrderLineItem
+
+
+class MissingProductError(Exception):
+    """ Raised when a product in the bag no longer exists """
+
+    def __init__(self, item_id):
+        super().__init__(f'Product {item_id} not found')
+        self.item_id = item_id
+
+
+def build_line_items(order, bag, products):
+    """
+    Return an unsaved line item for every line in the bag,
+    priced in memory from the products, a dictionary keyed by id.
+    Raises MissingProductError if a product isn't there.
+    """
+    line_items = []
+    for item_id, size, quantity in bag:
+        product = products.get(item_id)
+        if product is None:
+            raise MissingProductError(item_id)
+        line_items.append(OrderLineItem(
+            order=order,
+            product=product,
+            quantity=quantity,
+            product_size=size,
+            lineitem_total=product.price * quantity,
+        ))
+    return line_items
+
+
+def create_order(order, bag, products):
+    """
+    Save an order and a line item for every line in the bag.
+
+    order is an unsaved Order with the customer details filled in.
+    The line items are priced in memory and the order totals
+    are worked out once from them, before anything is saved.
+    Then the order is saved and the line items inserted in bulk,
+    in one transaction, so either the whole order is created or nothing.
+    bulk_create doesn't send signals, so the order total
+    isn't recalculated for each line item (see signals.py).
+
+    Raises MissingProductError, before saving anything,
+    if a product in the bag no longer exists.
+    """
+    line_items = build_line_items(order, bag, products)
+    order.set_totals(sum(item.lineitem_total for item in line_items))
+    with transaction.atomic():
+        order.save()
+        OrderLineItem.objects.bulk_create(line_items)
+    return order
@@ -0,0 +1,67 @@
+""" This module contains the reuse of stripe payment intents at checkout """
+
+from django.conf import settings
+
+from bag.contexts import get_bag_fingerprint
+from .gateways import InvalidRequestError, get_gateway
+from .models import Order
+
+SESSION_KEY = 'payment_intent'
+
+
+def _remember(request, intent_id, client_secret, amount, fingerprint):
+    """ Store the intent in the session, only writing it if it changed """
+    data = {
+        'id': intent_id,
+        'client_secret': client_secret,
+        'amount': amount,
+        'fingerprint': fingerprint,
+    }
+    if request.session.get(SESSION_KEY) != data:
+        request.session[SESSION_KEY] = data
+
+
+def get_client_secret(request, amount):
+    """
+    Return the client secret of a payment intent for the amount,
+    in the smallest currency unit, reusing the session's intent.
+
+    Each visit to the checkout page used to create a new intent,
+    waiting on stripe every time and leaving the unused ones behind.
+    Instead the intent is kept in the session with the bag fingerprint
+    (see bag/contexts.py) and amount it was made for.
+    If either still matches, the page uses it without calling stripe at all.
+    If the amount has changed only the amount of the intent is updated.
+    A new intent is only created the first time,
+    or when the old one has been paid or can't be updated any more.
+    Stripe is called through the payment gateway (see gateways.py).
+    """
+    fingerprint = get_bag_fingerprint(request)
+    cached = request.session.get(SESSION_KEY)
+    if cached and Order.objects.for_payment_intent(cached['id']).exists():
+        # already paid for, e.g. the user came back with a new bag
+        cached = None
+
+    if cached:
+        if cached['fingerprint'] == fingerprint or cached['amount'] == amount:
+            _remember(request, cached['id'], cached['client_secret'],
+                      cached['amount'], fingerprint)
+            return cached['client_secret']
+        try:
+            intent = get_gateway().modify_intent(cached['id'], amount=amount)
+        except InvalidRequestError:
+            # e.g. it has been paid or cancelled since
+            intent = None
+        if intent is not None:
+            _remember(request, intent.id, intent.client_secret, amount,
+                      fingerprint)
+            return intent.client_secret
+
+    intent = get_gateway().create_intent(amount, settings.STRIPE_CURRENCY)
+    _remember(request, intent.id, intent.client_secret, amount, fingerprint)
+    return intent.client_secret
+
+
+def forget_payment_intent(request):
+    """ Remove the intent from the session once it has been paid """
+    request.session.pop(SESSION_KEY, None)
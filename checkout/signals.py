@@ -1,14 +1,57 @@
 """ This module contains signals used in the order app (SEE init.py) """
 
+import threading
+from contextlib import contextmanager
+
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from .models import OrderLineItem
+from .models import Order, OrderLineItem
 
 # The receiver decorator, receives post saved signals.
 # From the OrderLineItem model.
 # See apps.py for how these signals are implimented.
 
+# The orders waiting for their totals inside deferred_order_totals,
+# kept per thread so concurrent requests don't share them.
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_order_totals():
+    """
+    Recalculate order totals once, rather than for every line item.
+
+    Inside this scope line item saves and deletes only note their order,
+    and each noted order has update_total called exactly once
+    when the scope exits. Used wherever many line items change together,
+    such as the order admin saving its inline line items.
+    Scopes can be nested, the totals are updated when the outermost exits.
+    Orders deleted in the meantime are skipped.
+    If the scope exits with an exception nothing is recalculated,
+    as the changes are expected to be rolled back.
+    """
+    outermost = not hasattr(_deferred, 'order_ids')
+    if outermost:
+        _deferred.order_ids = set()
+    try:
+        yield
+        if outermost and _deferred.order_ids:
+            for order in Order.objects.filter(pk__in=_deferred.order_ids):
+                order.update_total()
+    finally:
+        if outermost:
+            del _deferred.order_ids
+
+
+def _update_order_total(order):
+    """ Update the order's total now, or note it if totals are deferred """
+    order_ids = getattr(_deferred, 'order_ids', None)
+    if order_ids is None:
+        order.update_total()
+    else:
+        order_ids.add(order.pk)
+
 
 @receiver(post_save, sender=OrderLineItem)
 def update_on_save(sender, instance, created, **kwargs):
@@ -25,9 +68,10 @@ def update_on_save(sender, instance, created, **kwargs):
 
     Access instance.order which refers to the order
     this specific line item is related to.
-    Then call the update_total method on it.
+    Then call the update_total method on it,
+    unless inside deferred_order_totals.
     """
-    instance.order.update_total()
+    _update_order_total(instance.order)
 
 
 @receiver(post_delete, sender=OrderLineItem)
@@ -35,4 +79,4 @@ def update_on_delete(sender, instance, **kwargs):
     """
     Update order total on lineitem delete
     """
-    instance.order.update_total()
+    _update_order_total(instance.order)
@@ -1,3 +1,875 @@
-from django.test import TestCase
+""" This module contains the tests for the checkout app """
 
-# Create your tests here.
+import hashlib
+import hmac
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs
+
+import stripe
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from bag.codec import Bag
+from products.models import Product
+from profiles.models import UserProfile
+from .gateways import (
+    FakeGateway, InvalidRequestError, PaymentGateway, StripeGateway,
+    WebhookSignatureError, get_gateway)
+from .idempotency import client_secret_key
+from .management.commands.benchmark_checkout import checkout
+from .models import (
+    CheckoutData, IdempotencyRecord, Order, OrderLineItem, WebhookEvent)
+from .payments import SESSION_KEY as INTENT_SESSION_KEY
+from .orders import MissingProductError, create_order
+from .signals import deferred_order_totals
+from .webhook_handler import StripeWH_Handler
+from .webhook_queue import QUEUE, process_due_events
+
+WH_SECRET = 'whsec_test'
+
+ORDER_DETAILS = {
+    'full_name': 'Ada Lovelace',
+    'email': 'ada@example.com',
+    'phone_number': '0123456789',
+    'country': 'GB',
+    'postcode': 'N1 1AA',
+    'town_or_city': 'London',
+    'street_address1': '1 Analytical Street',
+    'street_address2': '',
+    'county': '',
+}
+
+
+def payment_intent_event(pid, bag, amount=6000):
+    """
+    A payment_intent.succeeded event as stripe sends it,
+    for the order details above and an encoded bag.
+    """
+    return stripe.Event.construct_from(
+        payment_intent_payload(pid, bag, amount), 'sk_test')
+
+
+def payment_intent_payload(pid, bag, amount=6000):
+    """ The body of the event above """
+    address = {
+        'line1': ORDER_DETAILS['street_address1'], 'line2': '',
+        'city': ORDER_DETAILS['town_or_city'], 'state': '',
+        'postal_code': ORDER_DETAILS['postcode'],
+        'country': ORDER_DETAILS['country'],
+    }
+    return {
+        'id': f'evt_{pid}',
+        'type': 'payment_intent.succeeded',
+        'data': {'object': {
+            'id': pid,
+            'object': 'payment_intent',
+            'metadata': {
+                'bag': bag, 'save_info': '', 'username': 'AnonymousUser'},
+            'shipping': {
+                'name': ORDER_DETAILS['full_name'],
+                'phone': ORDER_DETAILS['phone_number'],
+                'address': address,
+            },
+            'charges': {'data': [{
+                'amount': amount,
+                'billing_details': {
+                    'email': ORDER_DETAILS['email'], 'address': address},
+            }]},
+        }},
+    }
+
+
+def post_signed_webhook(client, payload, secret=WH_SECRET):
+    """
+    Post an event to the webhook signed as stripe signs it,
+    an HMAC-SHA256 of the timestamp and body with the webhook secret.
+    """
+    body = json.dumps(payload)
+    timestamp = int(time.time())
+    signature = hmac.new(
+        secret.encode(), f'{timestamp}.{body}'.encode(),
+        hashlib.sha256).hexdigest()
+    return client.post(
+        reverse('webhook'), body, content_type='application/json',
+        HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+
+
+class LocalStripeServer(ThreadingHTTPServer):
+    """
+    A stand-in for the stripe API on a free local port,
+    with just the payment intent calls checkout makes.
+    Records every request as (method, path, params).
+    Intents in paid can't be modified, as stripe refuses to.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), LocalStripeHandler)
+        self.requests = []
+        self.intents = {}
+        self.paid = set()
+        self.connections = 0
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(
+            target=self.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class LocalStripeHandler(BaseHTTPRequestHandler):
+    """ Handles one connection to the stand-in stripe API """
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the real API
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Retrieve a payment intent """
+        self.server.requests.append(('GET', self.path, {}))
+        pid = self.path.rsplit('/', 1)[-1]
+        if pid in self.server.intents:
+            self._respond(200, self.server.intents[pid])
+        else:
+            self._respond(404, {'error': {
+                'type': 'invalid_request_error',
+                'message': f'No such payment_intent: {pid}'}})
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Create, or modify, a payment intent """
+        length = int(self.headers.get('Content-Length') or 0)
+        params = {key: values[0] for key, values in parse_qs(
+            self.rfile.read(length).decode()).items()}
+        self.server.requests.append(('POST', self.path, params))
+        intents = self.server.intents
+        if self.path == '/v1/payment_intents':
+            pid = f'pi_local_{len(intents) + 1}'
+            intents[pid] = {
+                'id': pid, 'object': 'payment_intent',
+                'client_secret': f'{pid}_secret_local', 'metadata': {},
+                'currency': params['currency'], 'status': 'requires_payment_method'}  # noqa
+        else:
+            pid = self.path.rsplit('/', 1)[-1]
+            if pid not in intents or pid in self.server.paid:
+                self._respond(400, {'error': {
+                    'type': 'invalid_request_error',
+                    'message': f'PaymentIntent {pid} cannot be updated'}})
+                return
+        intents[pid]['amount'] = int(params.get('amount', intents[pid].get('amount', 0)))  # noqa
+        self._respond(200, intents[pid])
+
+
+class CreateOrderTest(TestCase):
+    """
+    Orders are created with all their line items in one transaction,
+    with the totals worked out once rather than per line item.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = {
+            product.pk: product for product in (
+                Product.objects.create(
+                    name=f'Mug {i}', description='A mug', price=2 + i)
+                for i in range(20))
+        }
+
+    def test_bulk_order_query_count(self):
+        bag = Bag([(pk, None, 1) for pk in self.products])
+        with self.assertNumQueries(4):  # savepoint, order, line items, release  # noqa
+            order = create_order(
+                Order(**ORDER_DETAILS), bag, self.products)
+        order.refresh_from_db()
+        self.assertEqual(order.lineitems.count(), 20)
+        self.assertEqual(order.order_total, Decimal('230.00'))
+        self.assertEqual(order.delivery_cost, 0)
+        self.assertEqual(order.grand_total, Decimal('230.00'))
+
+    def test_delivery_below_threshold(self):
+        pk = next(iter(self.products))
+        order = create_order(
+            Order(**ORDER_DETAILS), Bag([(pk, 'm', 2)]), self.products)
+        order.refresh_from_db()
+        self.assertEqual(
+            (order.order_total, order.delivery_cost, order.grand_total),
+            (Decimal('4.00'), Decimal('0.40'), Decimal('4.40')))
+        # the totals match what recalculating from the line items gives
+        order.update_total()
+        order.refresh_from_db()
+        self.assertEqual(order.grand_total, Decimal('4.40'))
+
+    def test_missing_product_saves_nothing(self):
+        bag = Bag([(next(iter(self.products)), None, 1), (999, None, 1)])
+        with self.assertRaises(MissingProductError):
+            create_order(Order(**ORDER_DETAILS), bag, self.products)
+        self.assertFalse(Order.objects.exists())
+
+
+class CheckoutViewTest(TestCase):
+    """ Posting the checkout form creates the order from the bag """
+
+    def setUp(self):
+        self.product = Product.objects.create(
+            name='Shirt', description='A shirt', price=30, has_sizes=True)
+        session = self.client.session
+        session['bag'] = Bag([(self.product.pk, 'm', 2)]).encode()
+        session.save()
+
+    def test_checkout_creates_order(self):
+        response = self.client.post(reverse('checkout'), {
+            **ORDER_DETAILS, 'client_secret': 'pi_123_secret_456'})
+        order = Order.objects.get()
+        self.assertRedirects(
+            response, reverse('checkout_success', args=[order.order_number]),
+            fetch_redirect_response=False)
+        self.assertEqual(order.stripe_pid, 'pi_123')
+        self.assertEqual(order.grand_total, Decimal('60.00'))
+        line_item = order.lineitems.get()
+        self.assertEqual(
+            (line_item.product_size, line_item.quantity, line_item.lineitem_total),  # noqa
+            ('m', 2, Decimal('60.00')))
+
+    def test_missing_product(self):
+        self.product.delete()
+        response = self.client.post(reverse('checkout'), {
+            **ORDER_DETAILS, 'client_secret': 'pi_123_secret_456'})
+        self.assertRedirects(response, reverse('view_bag'), fetch_redirect_response=False)  # noqa
+        self.assertFalse(Order.objects.exists())
+
+
+class DeferredOrderTotalsTest(TestCase):
+    """
+    Inside deferred_order_totals each changed order
+    is recalculated once, when the scope exits.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(
+            name='Mug', description='A mug', price=5)
+        cls.order = create_order(
+            Order(**ORDER_DETAILS),
+            Bag([(cls.product.pk, 'm', 1)]), {cls.product.pk: cls.product})
+
+    def test_totals_updated_once(self):
+        with mock.patch.object(Order, 'update_total', autospec=True, side_effect=Order.update_total) as update_total:  # noqa
+            with deferred_order_totals():
+                for size in ('xs', 's', 'l', 'xl'):
+                    OrderLineItem.objects.create(
+                        order=self.order, product=self.product,
+                        quantity=2, product_size=size)
+                self.order.lineitems.filter(product_size='m').delete()
+                with deferred_order_totals():
+                    OrderLineItem.objects.create(
+                        order=self.order, product=self.product, quantity=1)
+                update_total.assert_not_called()
+        update_total.assert_called_once()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.order_total, Decimal('45.00'))
+
+    def test_admin_inline_save(self):
+        from django.contrib.auth.models import User  # pylint: disable=import-outside-toplevel  # noqa
+        User.objects.create_superuser('owner', 'owner@example.com', 'password')  # noqa
+        self.client.login(username='owner', password='password')
+        line_item = self.order.lineitems.get()
+        data = {
+            **ORDER_DETAILS,
+            'lineitems-TOTAL_FORMS': 4,
+            'lineitems-INITIAL_FORMS': 1,
+            'lineitems-MIN_NUM_FORMS': 0,
+            'lineitems-MAX_NUM_FORMS': 1000,
+            'lineitems-0-id': line_item.pk,
+            'lineitems-0-order': self.order.pk,
+            'lineitems-0-product': self.product.pk,
+            'lineitems-0-product_size': 'm',
+            'lineitems-0-quantity': 3,
+        }
+        for i in range(1, 4):
+            data.update({
+                f'lineitems-{i}-order': self.order.pk,
+                f'lineitems-{i}-product': self.product.pk,
+                f'lineitems-{i}-quantity': 1,
+            })
+        with mock.patch.object(Order, 'update_total', autospec=True, side_effect=Order.update_total) as update_total:  # noqa
+            response = self.client.post(reverse(
+                'admin:checkout_order_change', args=[self.order.pk]), data)
+        self.assertEqual(response.status_code, 302)
+        update_total.assert_called_once()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.order_total, Decimal('30.00'))
+
+
+class WebhookOrderMatchingTest(TestCase):
+    """
+    The webhook finds the order by its unique stripe_pid without waiting,
+    and whichever of the webhook and the checkout view comes second
+    uses the order the other created.
+    """
+
+    def setUp(self):
+        self.product = Product.objects.create(
+            name='Shirt', description='A shirt', price=30, has_sizes=True)
+        self.bag = Bag([(self.product.pk, 'm', 2)]).encode()
+        self.handler = StripeWH_Handler(RequestFactory().post('/checkout/wh/'))  # noqa
+
+    def _checkout(self):
+        session = self.client.session
+        session['bag'] = self.bag
+        session.save()
+        return self.client.post(reverse('checkout'), {
+            **ORDER_DETAILS, 'client_secret': 'pi_123_secret_456'})
+
+    def test_webhook_after_checkout(self):
+        self._checkout()
+        # the checkout data and order lookups,
+        # and claiming the email, 2 savepoints and an insert
+        with self.assertNumQueries(7):
+            response = self.handler.handle_payment_intent_succeeded(
+                payment_intent_event('pi_123', self.bag))
+        self.assertContains(response, 'Verified order already in database')
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_checkout_after_webhook(self):
+        response = self.handler.handle_payment_intent_succeeded(
+            payment_intent_event('pi_123', self.bag))
+        self.assertContains(response, 'Created order in webhook')
+        order = Order.objects.get()
+        self.assertEqual(order.grand_total, Decimal('60.00'))
+        response = self._checkout()
+        self.assertRedirects(
+            response, reverse('checkout_success', args=[order.order_number]),
+            fetch_redirect_response=False)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_concurrent_create_in_webhook(self):
+        """ The view saves the order between the webhook's lookup and save """
+        self._checkout()
+        with mock.patch.object(Order.objects, 'for_payment_intent', side_effect=[Order.objects.none(), Order.objects.all()]):  # noqa
+            response = self.handler.handle_payment_intent_succeeded(
+                payment_intent_event('pi_123', self.bag))
+        self.assertContains(response, 'Verified order already in database')
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_blank_stripe_pids_are_not_unique(self):
+        for _ in range(2):
+            create_order(Order(**ORDER_DETAILS), Bag(), {})
+        self.assertEqual(Order.objects.filter(stripe_pid='').count(), 2)
+
+
+@override_settings(
+    STRIPE_WH_SECRET=WH_SECRET, WEBHOOK_MAX_ATTEMPTS=2,
+    WEBHOOK_RETRY_DELAY=30, WEBHOOK_RETRY_MAX_DELAY=100)
+class WebhookQueueTest(TestCase):
+    """
+    The webhook only verifies and queues events,
+    process_webhooks handles them, retrying any that fail.
+    """
+
+    def setUp(self):
+        self.product = Product.objects.create(
+            name='Shirt', description='A shirt', price=30, has_sizes=True)
+        self.payload = payment_intent_payload(
+            'pi_123', Bag([(self.product.pk, 'm', 2)]).encode())
+
+    def test_signed_event_is_queued_not_handled(self):
+        response = post_signed_webhook(self.client, self.payload)
+        self.assertEqual(response.status_code, 200)
+        queued = WebhookEvent.objects.get()
+        self.assertEqual(queued.event_id, 'evt_pi_123')
+        self.assertEqual(queued.event_type, 'payment_intent.succeeded')
+        self.assertEqual(queued.status, WebhookEvent.PENDING)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_invalid_signature_is_rejected(self):
+        response = post_signed_webhook(
+            self.client, self.payload, secret='whsec_wrong')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_resent_event_is_queued_once(self):
+        post_signed_webhook(self.client, self.payload)
+        response = post_signed_webhook(self.client, self.payload)
+        self.assertContains(response, 'Already queued')
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_command_handles_queued_events(self):
+        post_signed_webhook(self.client, self.payload)
+        out = StringIO()
+        call_command('process_webhooks', '--once', stdout=out)
+        self.assertIn('1 done', out.getvalue())
+        queued = WebhookEvent.objects.get()
+        self.assertEqual(queued.status, WebhookEvent.DONE)
+        self.assertEqual(queued.attempts, 1)
+        self.assertIsNotNone(queued.processed_at)
+        order = Order.objects.get()
+        self.assertEqual(order.stripe_pid, 'pi_123')
+        self.assertEqual(order.grand_total, Decimal('60.00'))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_failed_event_is_retried_then_dead(self):
+        post_signed_webhook(self.client, self.payload)
+        with mock.patch.object(
+                StripeWH_Handler, 'handle', side_effect=RuntimeError('down')):
+            self.assertEqual(
+                list(process_due_events().values()), [WebhookEvent.PENDING])
+            queued = WebhookEvent.objects.get()
+            self.assertEqual(queued.attempts, 1)
+            self.assertEqual(queued.last_error, 'RuntimeError: down')
+            self.assertGreater(queued.next_attempt_at, timezone.now())
+
+            # not due again until the retry delay has passed
+            self.assertEqual(process_due_events(), {})
+            WebhookEvent.objects.update(next_attempt_at=timezone.now())
+            self.assertEqual(
+                list(process_due_events().values()), [WebhookEvent.DEAD])
+        self.assertEqual(WebhookEvent.objects.get().attempts, 2)
+        self.assertFalse(Order.objects.exists())
+
+    def test_error_response_is_retried(self):
+        post_signed_webhook(self.client, self.payload)
+        Product.objects.all().delete()
+        process_due_events()
+        queued = WebhookEvent.objects.get()
+        self.assertEqual(queued.status, WebhookEvent.PENDING)
+        self.assertIn('ERROR', queued.last_error)
+
+    def test_abandoned_claim_is_claimed_again(self):
+        post_signed_webhook(self.client, self.payload)
+        WebhookEvent.objects.update(
+            status=WebhookEvent.PROCESSING, attempts=1,
+            locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(
+            list(process_due_events().values()), [WebhookEvent.DONE])
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_retry_delay_doubles_up_to_limit(self):
+        self.assertEqual(
+            [QUEUE.retry_delay(n).total_seconds() for n in range(1, 5)],
+            [30, 60, 100, 100])
+
+
+class IdempotencyTest(TestCase):
+    """
+    Events stripe sends again, and checkout forms submitted again,
+    return what happened the first time without doing it again.
+    """
+
+    def setUp(self):
+        self.product = Product.objects.create(
+            name='Shirt', description='A shirt', price=30, has_sizes=True)
+        self.bag = Bag([(self.product.pk, 'm', 2)]).encode()
+        self.handler = StripeWH_Handler(None)
+
+    def test_handled_event_returns_stored_response(self):
+        event = payment_intent_event('pi_123', self.bag)
+        first = self.handler.handle(event)
+        self.assertContains(first, 'Created order in webhook')
+        with self.assertNumQueries(1):
+            again = self.handler.handle(event)
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.content, first.content)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_error_response_is_not_stored(self):
+        event = payment_intent_event('pi_123', Bag([(999, None, 1)]).encode())
+        self.assertEqual(self.handler.handle(event).status_code, 500)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+    def test_one_email_per_payment_intent(self):
+        """ Another event for the same payment doesn't email again """
+        self.handler.handle(payment_intent_event('pi_123', self.bag))
+        event = payment_intent_event('pi_123', self.bag)
+        event['id'] = 'evt_other'
+        self.assertContains(
+            self.handler.handle(event), 'Verified order already in database')
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_failed_email_is_sent_on_retry(self):
+        event = payment_intent_event('pi_123', self.bag)
+        with mock.patch(
+                'checkout.webhook_handler.send_mail',
+                side_effect=ConnectionError('smtp down')):
+            with self.assertRaises(ConnectionError):
+                self.handler.handle(event)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+        self.handler.handle(event)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_checkout_without_client_secret_is_rejected(self):
+        session = self.client.session
+        session['bag'] = self.bag
+        session.save()
+        for client_secret in (None, '', 'pi_123'):
+            data = dict(ORDER_DETAILS)
+            if client_secret is not None:
+                data['client_secret'] = client_secret
+            with self.subTest(client_secret=client_secret):
+                response = self.client.post(reverse('checkout'), data)
+                self.assertRedirects(
+                    response, reverse('checkout'),
+                    fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+    def test_resubmitted_checkout_goes_to_same_order(self):
+        session = self.client.session
+        session['bag'] = self.bag
+        session.save()
+        data = {**ORDER_DETAILS, 'client_secret': 'pi_123_secret_456'}
+        first = self.client.post(reverse('checkout'), data)
+        order = Order.objects.get()
+        with self.assertNumQueries(1):
+            again = self.client.post(reverse('checkout'), data)
+        self.assertEqual(again.url, first.url)
+        self.assertEqual(
+            first.url, reverse('checkout_success', args=[order.order_number]))
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertTrue(IdempotencyRecord.objects.filter(
+            key=client_secret_key('pi_123_secret_456'), order=order).exists())
+
+
+@override_settings(STRIPE_SECRET_KEY='sk_test_local')
+class PaymentIntentReuseTest(TestCase):
+    """
+    The checkout page reuses the payment intent in the session,
+    only calling the stripe API when it has to.
+    """
+
+    def setUp(self):
+        self.stripe = LocalStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__)
+        patcher = mock.patch.object(stripe, 'api_base', self.stripe.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.shirt = Product.objects.create(
+            name='Shirt', description='A shirt', price=30, has_sizes=True)
+        self.mug = Product.objects.create(
+            name='Mug', description='A mug', price=10)
+        self._set_bag(Bag([(self.shirt.pk, 'm', 1)]))
+
+    def _set_bag(self, bag):
+        session = self.client.session
+        session['bag'] = bag.encode()
+        session.save()
+
+    def _client_secret(self):
+        response = self.client.get(reverse('checkout'))
+        self.assertEqual(response.status_code, 200)
+        return response.context['client_secret']
+
+    def test_first_visit_creates_intent(self):
+        self.assertEqual(self._client_secret(), 'pi_local_1_secret_local')
+        self.assertEqual(self.stripe.requests, [(
+            'POST', '/v1/payment_intents',
+            {'amount': '3300', 'currency': 'usd'})])
+        self.assertEqual(
+            self.client.session[INTENT_SESSION_KEY]['amount'], 3300)
+
+    def test_reload_reuses_intent_without_stripe(self):
+        first = self._client_secret()
+        self.assertEqual(self._client_secret(), first)
+        self.assertEqual(len(self.stripe.requests), 1)
+
+    def test_same_amount_reuses_intent_without_stripe(self):
+        """ A different bag at the same price needs no change """
+        first = self._client_secret()
+        self._set_bag(Bag([(self.mug.pk, None, 3)]))
+        self.assertEqual(self._client_secret(), first)
+        self.assertEqual(len(self.stripe.requests), 1)
+
+    def test_changed_amount_modifies_intent(self):
+        first = self._client_secret()
+        self._set_bag(Bag([(self.shirt.pk, 'm', 1), (self.mug.pk, None, 1)]))
+        self.assertEqual(self._client_secret(), first)
+        self.assertEqual(self.stripe.requests[1], (
+            'POST', '/v1/payment_intents/pi_local_1', {'amount': '4400'}))
+        self.assertEqual(self.stripe.intents['pi_local_1']['amount'], 4400)
+        # and the new amount is remembered
+        self._client_secret()
+        self.assertEqual(len(self.stripe.requests), 2)
+
+    def test_unmodifiable_intent_is_replaced(self):
+        self._client_secret()
+        self.stripe.paid.add('pi_local_1')
+        self._set_bag(Bag([(self.mug.pk, None, 1)]))
+        self.assertEqual(self._client_secret(), 'pi_local_2_secret_local')
+        self.assertEqual(
+            [path for _method, path, _params in self.stripe.requests],
+            ['/v1/payment_intents', '/v1/payment_intents/pi_local_1',
+             '/v1/payment_intents'])
+
+    def test_paid_intent_is_not_reused(self):
+        self._client_secret()
+        create_order(Order(**ORDER_DETAILS, stripe_pid='pi_local_1'), Bag(), {})  # noqa
+        self.assertEqual(self._client_secret(), 'pi_local_2_secret_local')
+
+    def test_checkout_success_forgets_intent(self):
+        self._client_secret()
+        order = create_order(
+            Order(**ORDER_DETAILS, stripe_pid='pi_local_1'), Bag(), {})
+        self.client.get(reverse('checkout_success', args=[order.order_number]))  # noqa
+        self.assertNotIn(INTENT_SESSION_KEY, self.client.session)
+
+
+@override_settings(STRIPE_SECRET_KEY='sk_test_local')
+class CheckoutDataTest(TestCase):
+    """
+    Submitting the checkout form keeps what the webhook needs locally,
+    without a call to stripe, and the webhook reads it from there.
+    """
+
+    def setUp(self):
+        self.stripe = LocalStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__)
+        patcher = mock.patch.object(stripe, 'api_base', self.stripe.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.product = Product.objects.create(
+            name='Shirt', description='A shirt', price=30, has_sizes=True)
+        self.bag = Bag([(self.product.pk, 'm', 2)]).encode()
+        self.user = User.objects.create_user('ada', 'ada@example.com', 'pw')
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['bag'] = self.bag
+        session.save()
+
+    def _cache_checkout_data(self, save_info):
+        return self.client.post(reverse('cache_checkout_data'), {
+            'client_secret': 'pi_123_secret_456', 'save_info': save_info})
+
+    def test_saved_locally_without_stripe(self):
+        response = self._cache_checkout_data('true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stripe.requests, [])
+        data = CheckoutData.objects.get(stripe_pid='pi_123')
+        self.assertEqual(
+            (data.bag, data.save_info, data.username),
+            (self.bag, True, 'ada'))
+
+    def test_resubmit_replaces(self):
+        self._cache_checkout_data('true')
+        self._cache_checkout_data('false')
+        self.assertFalse(CheckoutData.objects.get().save_info)
+
+    def test_webhook_reads_checkout_data(self):
+        self._cache_checkout_data('true')
+        # the intent's metadata is empty, as nothing was sent to stripe
+        payload = payment_intent_payload('pi_123', '')
+        payload['data']['object']['metadata'] = {}
+        event = stripe.Event.construct_from(payload, 'sk_test')
+        response = StripeWH_Handler(None).handle(event)
+        self.assertContains(response, 'Created order in webhook')
+        order = Order.objects.get()
+        self.assertEqual(order.original_bag, self.bag)
+        self.assertEqual(order.grand_total, Decimal('60.00'))
+        self.user.userprofile.refresh_from_db()
+        self.assertEqual(
+            self.user.userprofile.default_postcode, ORDER_DETAILS['postcode'])
+
+    def test_unchecked_save_info_leaves_profile(self):
+        self._cache_checkout_data('false')
+        StripeWH_Handler(None).handle(payment_intent_event('pi_123', ''))
+        self.user.userprofile.refresh_from_db()
+        self.assertIsNone(self.user.userprofile.default_postcode)
+
+
+@override_settings(
+    STRIPE_SECRET_KEY='sk_test_local',
+    PAYMENT_GATEWAY='checkout.gateways.StripeGateway',
+    STRIPE_CONNECT_TIMEOUT=2, STRIPE_READ_TIMEOUT=3)
+class StripeGatewayTest(TestCase):
+    """ The stripe gateway against a local stand-in for the API """
+
+    def setUp(self):
+        self.stripe = LocalStripeServer().__enter__()
+        self.addCleanup(self.stripe.__exit__)
+        patcher = mock.patch.object(stripe, 'api_base', self.stripe.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.gateway = get_gateway()
+
+    def test_one_gateway_per_process(self):
+        self.assertIsInstance(self.gateway, StripeGateway)
+        self.assertIs(get_gateway(), self.gateway)
+
+    def test_explicit_timeouts(self):
+        self.assertEqual(self.gateway.client._timeout, (2, 3))  # pylint: disable=protected-access  # noqa
+
+    def test_requests_reuse_one_connection(self):
+        intent = self.gateway.create_intent(1000, 'usd')
+        self.assertEqual(
+            (intent.id, intent.amount, intent.client_secret),
+            ('pi_local_1', 1000, 'pi_local_1_secret_local'))
+        self.assertEqual(
+            self.gateway.modify_intent(intent.id, amount=2000).amount, 2000)
+        self.assertEqual(self.gateway.retrieve_intent(intent.id).amount, 2000)
+        self.assertEqual(len(self.stripe.requests), 3)
+        self.assertEqual(self.stripe.connections, 1)
+
+    def test_refused_request(self):
+        intent = self.gateway.create_intent(1000, 'usd')
+        self.stripe.paid.add(intent.id)
+        with self.assertRaises(InvalidRequestError):
+            self.gateway.modify_intent(intent.id, amount=2000)
+
+
+@override_settings(
+    PAYMENT_GATEWAY='checkout.gateways.FakeGateway',
+    STRIPE_WH_SECRET='whsec_fake_test')
+class FakeGatewayTest(TestCase):
+    """ Checkout runs end to end against the in-process fake gateway """
+
+    def setUp(self):
+        self.gateway = get_gateway()
+        self.products = [
+            Product.objects.create(
+                name='Shirt', description='A shirt', price=30, has_sizes=True),
+            Product.objects.create(
+                name='Mug', description='A mug', price=10),
+        ]
+
+    def test_gateways_implement_the_intent_methods(self):
+        with self.assertRaises(TypeError):
+            PaymentGateway()  # pylint: disable=abstract-class-instantiated
+
+    def test_intents(self):
+        self.assertIsInstance(self.gateway, FakeGateway)
+        intent = self.gateway.create_intent(1000, 'usd')
+        self.assertTrue(intent.client_secret.startswith(f'{intent.id}_secret_'))  # noqa
+        self.gateway.modify_intent(intent.id, amount=2000)
+        self.assertEqual(self.gateway.retrieve_intent(intent.id).amount, 2000)
+        self.gateway.confirm_intent(intent.id, 'ada@example.com', {
+            'name': 'Ada', 'phone': '1', 'address': {}})
+        with self.assertRaises(InvalidRequestError):
+            self.gateway.modify_intent(intent.id, amount=3000)
+
+    def test_signed_events_verify(self):
+        intent = self.gateway.create_intent(1000, 'usd')
+        payload, signature = self.gateway.confirm_intent(
+            intent.id, 'ada@example.com', {
+                'name': 'Ada', 'phone': '1', 'address': {}})
+        event = self.gateway.construct_event(payload, signature)
+        self.assertEqual(event.data.object.id, intent.id)
+        with self.assertRaises(WebhookSignatureError):
+            self.gateway.construct_event(payload + b' ', signature)
+        with self.assertRaises(WebhookSignatureError):
+            FakeGateway(webhook_secret='whsec_other').construct_event(
+                payload, signature)
+
+    def test_checkout_end_to_end(self):
+        response = checkout(self.client, self.gateway, self.products)
+        order = Order.objects.get()
+        self.assertRedirects(
+            response, reverse('checkout_success', args=[order.order_number]),
+            fetch_redirect_response=False)
+        self.assertEqual(order.grand_total, Decimal('44.00'))
+        self.assertEqual(
+            self.gateway.intents[order.stripe_pid]['amount'], 4400)
+        self.assertEqual(
+            list(process_due_events().values()), [WebhookEvent.DONE])
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+
+# a line of a query plan that reads a whole table, e.g. 'SCAN checkout_order'
+# in SQLite, 'Seq Scan on checkout_order' in Postgres
+TABLE_SCAN = re.compile(r'\bSCAN (TABLE )?\w+$|\bSCAN (TABLE )?\w+ (?!USING)|Seq Scan')  # noqa
+# a line of a query plan that sorts the rows rather than reading them in order
+SORT = re.compile(r'USE TEMP B-TREE FOR ORDER BY|\bSort\b')
+
+
+class QueryPlanTest(TestCase):
+    """
+    The hot lookups of checkout and the profile are served by an index,
+    checked with EXPLAIN against whichever database the tests run on,
+    SQLite here and Postgres in production.
+    Postgres is told to avoid table scans if it possibly can,
+    as it would rightly scan the tiny tables of a test database anyway,
+    so it only scans a table when there is no index it could use.
+    """
+
+    def assertUsesIndex(self, queryset, index=None, ordered=False):  # pylint: disable=invalid-name  # noqa
+        """
+        Check the query reads no table in full, uses the named index
+        if there is one, and if ordered doesn't sort the rows itself.
+        """
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+        self.assertFalse(
+            [line for line in plan.splitlines() if TABLE_SCAN.search(line)],
+            f'Table scan in query plan:\n{plan}')
+        if index:
+            self.assertIn(index, plan)
+        if ordered:
+            self.assertIsNone(SORT.search(plan), f'Sort in query plan:\n{plan}')  # noqa
+
+    def test_table_scan_is_caught(self):
+        plan = Order.objects.filter(full_name='Ada').explain()
+        self.assertTrue(
+            any(TABLE_SCAN.search(line) for line in plan.splitlines()), plan)
+
+    def test_order_by_number(self):
+        """ checkout_success and order_history """
+        self.assertUsesIndex(Order.objects.filter(order_number='ABC'))
+
+    def test_order_by_payment_intent(self):
+        """ The webhook and checkout view """
+        self.assertUsesIndex(
+            Order.objects.for_payment_intent('pi_123'),
+            index='unique_order_stripe_pid')
+
+    def test_profile_order_history(self):
+        """ The profile lists its orders newest first """
+        profile = UserProfile(pk=1)
+        self.assertUsesIndex(
+            profile.orders.order_by('-date'), index='order_profile_date',
+            ordered=True)
+
+    def test_order_line_items(self):
+        self.assertUsesIndex(OrderLineItem.objects.filter(order_id=1))
+
+    def test_idempotency_record(self):
+        self.assertUsesIndex(IdempotencyRecord.objects.select_related(
+            'order').filter(key=client_secret_key('pi_123_secret_456')))
+
+    def test_checkout_data(self):
+        self.assertUsesIndex(CheckoutData.objects.filter(stripe_pid='pi_123'))
+
+    def test_due_webhook_events(self):
+        self.assertUsesIndex(
+            WebhookEvent.objects.filter(QUEUE.due()),
+            index='webhook_event_due')
@@ -1,19 +1,21 @@
 """ This module contains the views for the checkout app """
 
-import json
 from django.shortcuts import render, redirect, reverse, get_object_or_404, HttpResponse  # noqa
+from django.db import IntegrityError
 from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django.conf import settings
 
-import stripe
-
-from products.models import Product
+from products.product_cache import get_products
 from profiles.models import UserProfile
 from profiles.forms import UserProfileForm
-from bag.contexts import bag_contents
+from bag.codec import get_bag
+from bag.contexts import get_bag_totals
 from .forms import OrderForm
-from .models import Order, OrderLineItem
+from .idempotency import client_secret_key, get_record, save_record
+from .payments import forget_payment_intent, get_client_secret
+from .models import CheckoutData, Order
+from .orders import MissingProductError, create_order
 
 
 @require_POST
@@ -27,20 +29,21 @@ def cache_checkout_data(request):
     split that at the word secret
     the first part of it will be the payment intent ID,
     stored in a variable called pid.
-    Then set up stripe with the secret key so we can modify the payment intent.
-    To do that, call stripe.PaymentIntent.modify
-    give it the pid, and tell it what we want to modify:
-    add the user who's placing the order.
-    add whether or not they wanted to save their information.
-    add a JSON dump of their shopping bag.
+    Then save what the webhook needs to create the order by that pid,
+    in the CheckoutData model (see models.py),
+    rather than in the payment intent's metadata at stripe,
+    so the payment doesn't wait for a call to stripe first:
+    the user who's placing the order.
+    whether or not they wanted to save their information.
+    their shopping bag in its compact encoding (see bag/codec.py).
+    Submitting again, e.g. after a declined card, replaces it.
     """
     try:
         pid = request.POST.get('client_secret').split('_secret')[0]
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        stripe.PaymentIntent.modify(pid, metadata={
-            'bag': json.dumps(request.session.get('bag', {})),
-            'save_info': request.POST.get('save_info'),
-            'username': request.user,
+        CheckoutData.objects.update_or_create(stripe_pid=pid, defaults={
+            'bag': get_bag(request).encode(),
+            'save_info': request.POST.get('save_info') == 'true',
+            'username': request.user.get_username(),
         })
         return HttpResponse(status=200)
     except Exception as e:
@@ -61,14 +64,21 @@ def checkout(request):
     Defines the template to be used.
 
     on POST request, creates an instance of the bag & order form in form_data
-    checks form is valid, if so saves. Then iterates through the bag items
-    and creates a line item (see order model in checkout view).
-    First get the Product ID out of the bag.
-    Then if its value is an integer the item that doesn't have sizes.
-    So the quantity will just be the item data.
-    If the item has sizes. iterate through each size and create a line item
+    checks form is valid, if so creates the order with create_order
+    (see orders.py). Which creates a line item for each line of the bag,
+    a product ID, size and quantity, and saves them with the order
+    in one transaction.
+    If the order for the payment intent already exists,
+    as stripe_pid is unique, that order is used instead.
+    A form without the payment intent's client secret is turned away,
+    before anything is looked up or saved.
+    The order is recorded against the client secret (see idempotency.py),
+    so when the form is submitted again, e.g. a double click,
+    the user goes straight to the same order after a single lookup.
+    The products are read through the product cache all at once
+    (see products/product_cache.py).
     in case a product isn't found add an error message.
-    Delete the empty order and return the user to the shopping bag page.
+    Nothing is saved and the user is returned to the shopping bag page.
 
     If the user wants to save their profile information to the session.
     redirect them to checkout_success.html template.
@@ -79,8 +89,11 @@ def checkout(request):
     with the form errors shown.
 
     Collects the bag total for use with strip:
-    Uses context processor in the bag app. In checkouts.view.py.
-    This function returns a Python dictionary.
+    Uses get_bag_totals from the bag app's contexts module.
+    The context processor itself only returns lazy values.
+    This function returns a Python dictionary,
+    the same priced bag snapshot the context processor reuses,
+    memoized on the request and cached by the bag fingerprint.
     Pass it the request and get the same dictionary here in the view.
     Store that in a variable called current bag.
     So not to overwrite the bag variable that already exists.
@@ -89,15 +102,24 @@ def checkout(request):
     Then multiply that by a hundred.
     Then round it to zero decimal places using the round function.
     Stripe requires the amount to charge as an integer.
-    uses the stripe keys from settings.py to setup the payment.
-    Stores this payment in the intent object.
-    This object can then have it's dict keys referenced. (see client_secret)
+    Gets the client secret of a payment intent for that amount
+    with get_client_secret (see payments.py), which reuses the intent
+    kept in the session rather than creating one on every visit.
     """
     stripe_public_key = settings.STRIPE_PUBLIC_KEY
-    stripe_secret_key = settings.STRIPE_SECRET_KEY
 
     if request.method == 'POST':
-        bag = request.session.get('bag', {})
+        client_secret = request.POST.get('client_secret', '')
+        if '_secret' not in client_secret:
+            messages.error(request, 'Sorry, your payment cannot be \
+                processed right now. Please try again later.')
+            return redirect(reverse('checkout'))
+        submitted = get_record(client_secret_key(client_secret))
+        if submitted and submitted.order:
+            return redirect(reverse(
+                'checkout_success', args=[submitted.order.order_number]))
+
+        bag = get_bag(request)
 
         form_data = {
             'full_name': request.POST['full_name'],
@@ -115,63 +137,48 @@ def checkout(request):
             # from the hidden input on the form
             # in the check out page containing the client secret.
             # if the order form is valid. split it to get the payment intent id
-            # get the shopping bag here by dumping it to a JSON string.
-            # Set it on the order, and then save the order.
+            # get the shopping bag here in its compact encoding.
+            # Set it on the order, and then create the order.
             # prevent multiple save events from being executed on the database.
             # By adding commit equals false to prevent the first one saving
             # this logic is needed for the event_handler to allow multiple
             # orders by the same person for the same items
             order = order_form.save(commit=False)
-            pid = request.POST.get('client_secret').split('_secret')[0]
+            pid = client_secret.split('_secret')[0]
             order.stripe_pid = pid
-            order.original_bag = json.dumps(bag)
-            order.save()
-            for item_id, item_data in bag.items():
-                try:
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:
-                        for size, quantity in item_data['items_by_size'].items():  # noqa
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-                except Product.DoesNotExist:
-                    messages.error(request, (
-                        "One of the products in your bag wasn't found in our database. "  # noqa
-                        "Please call us for assistance!")
-                    )
-                    order.delete()
-                    return redirect(reverse('view_bag'))
-
+            order.original_bag = bag.encode()
+            try:
+                create_order(
+                    order, bag, get_products(request, bag.product_ids()))
+            except IntegrityError:
+                # the webhook, or an earlier submit of this form,
+                # already created the order for this payment
+                order = Order.objects.for_payment_intent(pid).first()
+                if order is None:
+                    raise
+            except MissingProductError:
+                messages.error(request, (
+                    "One of the products in your bag wasn't found in our database. "  # noqa
+                    "Please call us for assistance!")
+                )
+                return redirect(reverse('view_bag'))
+
+            save_record(client_secret_key(client_secret), order=order)
             request.session['save_info'] = 'save-info' in request.POST
             return redirect(reverse('checkout_success', args=[order.order_number]))  # noqa
         else:
             messages.error(request, 'There was an error with your form. \
                 Please double check your information.')
     else:
-        bag = request.session.get('bag', {})
+        bag = get_bag(request)
         if not bag:
             messages.error(request, "There's nothing in your bag at the moment")  # noqa
             return redirect(reverse('products'))
 
-        current_bag = bag_contents(request)
+        current_bag = get_bag_totals(request)
         total = current_bag['grand_total']
         stripe_total = round(total * 100)
-        stripe.api_key = stripe_secret_key
-        intent = stripe.PaymentIntent.create(
-            amount=stripe_total,
-            currency=settings.STRIPE_CURRENCY,
-        )
+        client_secret = get_client_secret(request, stripe_total)
 
         # prefills the form with the users saved delivery info if stored.
         if request.user.is_authenticated:
@@ -201,7 +208,7 @@ def checkout(request):
     context = {
         'order_form': order_form,
         'stripe_public_key': stripe_public_key,
-        'client_secret': intent.client_secret,
+        'client_secret': client_secret,
     }
 
     return render(request, template, context)
@@ -219,7 +226,8 @@ def checkout_success(request, order_number):
     Then attach a success message
     letting the user know what their order number is.
     And that a confirmation email will be sent to the email in the form.
-    Finally delete the user shopping bag from the session
+    Finally delete the user shopping bag from the session,
+    and the payment intent that paid for it.
     Set the template and the context. And render the template.
 
     add the user profile to order:
@@ -266,6 +274,7 @@ def checkout_success(request, order_number):
 
     if 'bag' in request.session:
         del request.session['bag']
+    forget_payment_intent(request)
 
     template = 'checkout/checkout_success.html'
     context = {
@@ -1,16 +1,18 @@
 """ This module handles stripes webhooks """
 
-import json
-import time
-
+from django.db import IntegrityError, transaction
 from django.http import HttpResponse
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.conf import settings
 
-from products.models import Product
+from bag.codec import Bag
+from products.product_cache import get_products
 from profiles.models import UserProfile
-from .models import Order, OrderLineItem
+from .idempotency import (
+    claim, event_key, get_record, payment_intent_key, save_record)
+from .models import CheckoutData, Order
+from .orders import create_order
 
 
 # pylint: disable=invalid-name
@@ -24,9 +26,43 @@ class StripeWH_Handler:
         that's called every time an instance of the class is created.
         It is used to assign the request as an attribute of the class
         Allowing access to any attributes of the request coming from stripe.
+        The request is None when events are handled from the queue
+        by the process_webhooks command (see webhook_queue.py).
         """
         self.request = request
 
+    def handle(self, event):
+        """
+        Handle any webhook event.
+        Create a dictionary called event map
+        the dictionaries keys will be the names of the webhooks from stripe.
+        While its values will be the actual methods of this handler.
+        Get the type of the event from stripe
+        and look up its method in the dictionary,
+        using the generic handle_event by default.
+        Call it with the event and return its response.
+
+        The response to each event is stored by its id (see idempotency.py).
+        An event that was already handled, i.e. stripe sent it again,
+        returns the stored response with one lookup and isn't handled again.
+        Error responses aren't stored, so the event can be retried.
+        """
+        key = event_key(event['id'])
+        stored = get_record(key)
+        if stored:
+            return HttpResponse(
+                content=stored.content, status=stored.status_code)
+
+        event_map = {
+            'payment_intent.succeeded': self.handle_payment_intent_succeeded,
+            'payment_intent.payment_failed': self.handle_payment_intent_payment_failed,  # noqa
+        }
+        event_handler = event_map.get(event['type'], self.handle_event)
+        response = event_handler(event)
+        if response.status_code < 400:
+            save_record(key, response=response)
+        return response
+
     def _send_confirmation_email(self, order):
         """
         Send the user a confirmation email
@@ -41,8 +77,15 @@ class StripeWH_Handler:
         to send the email use the send mail function.
         Giving it the subject the body the email to send from (SEE SETTINGS).
         And a list of emails sending to, i.e. the customer's email.
+        send_mail only saves it to the outbox (see outbox/backends.py),
+        the send_outbox command sends it, so nothing waits on the mail server.
         it's just expecting to be passed an order to run. see webhook success
         handler for its call, this is where the order is passed.
+
+        The email is only sent once for each payment intent,
+        however many times stripe sends its events (see idempotency.py).
+        The payment intent is claimed in the same transaction,
+        so if sending fails the claim is undone and a retry sends it.
         """
         customer_email = order.email
         subject = render_to_string(
@@ -52,12 +95,14 @@ class StripeWH_Handler:
             'checkout/confirmation_emails/confirmation_email_body.txt',
             {'order': order, 'contact_email': settings.DEFAULT_FROM_EMAIL})
 
-        send_mail(
-            subject,
-            body,
-            settings.DEFAULT_FROM_EMAIL,
-            [customer_email]
-        )
+        with transaction.atomic():
+            if claim(payment_intent_key(order.stripe_pid), order):
+                send_mail(
+                    subject,
+                    body,
+                    settings.DEFAULT_FROM_EMAIL,
+                    [customer_email]
+                )
 
     def handle_event(self, event):
         """
@@ -76,9 +121,10 @@ class StripeWH_Handler:
         in case the form isn't submitted for some reason
         i.e. the user closes the page on the loading screen.
         collect the payment intent id, as well as the shopping bag
-        and the users save info preference from the metadata
-        added in the view and stripe JS file.
-        also store the billing details, shipping details, and grand_total
+        and the users save info preference from the checkout data
+        saved by the cache_checkout_data view (see models.py),
+        or the metadata of intents paid before there was checkout data.
+        also store the billing details and shipping details
 
         to ensure the data is in the form for the database.
         replace any empty strings in the shipping details with none.
@@ -90,51 +136,46 @@ class StripeWH_Handler:
         when this webhook is received.
 
         first check if the order exists already.
-        try to get the order using all the information from the payment intent.
-        using the iexact lookup field
-        to make it an exact match but case-insensitive.
-        If the order is found set order_exists to true,
-        and return a 200 HTTP response to stripe,
+        look it up by the payment intent id, stripe_pid,
+        which is unique to each order and indexed (see models.py).
+        If the order is found
+        return a 200 HTTP response to stripe,
         with the message that we verified the order already exists.
 
-        if it doesn't create it here in the webhook.
-        assume the order doesn't exist. with order_exists set to false.
-        iterate through the bag items.
-        the bag is loaded from the JSON version in the payment intent
+        if it doesn't create it here in the webhook, straight away.
+        the bag is decoded from the checkout data (see bag/codec.py)
         there is no form to save in this webhook to create the order
-        it is created with order.objects.create
-        using all the data from the payment intent, which is from the form.
-        if anything goes wrong the order is deleted if it was created.
+        it is built from all the data from the payment intent,
+        which is from the form, and created with its line items
+        by create_order (see orders.py), in one transaction.
+        if anything goes wrong nothing is saved.
         And a 500 server error response is returned to stripe.
         This will cause stripe to automatically try the webhook again later.
 
         What if our view is just slow for some reason
         and hasn't created the order by the time the webhook from stripe does.
-        in this instance the order will be created late.
-        so the WH handler won't find the order when it first gets the webhook
-        and will create the order itself resulting in the
-        same order being added to the database twice, once the view finishes.
-        This is a downfall of asynchronous applications
-        i.e. when multiple processes are happening at once and some
-        might depend on things we can't control.
-        to handle this to some extent, a bit of delay is introduced.
-        with the variable called attempt that is set to 1.
-        using this a while loop is constructed that will execute 5 times.
-        instead of creating the order if it's not found.
-        it will increment attempt by 1
-        And using pythons time module to sleep for one second.
-        will cause the webhook handler to try to find the order five times
-        over five seconds. if the order is found, break out of the loop.
-        else create the order itself. returning a response to stripe detailing.
+        Rather than waiting for it, whichever of the two comes second
+        finds it can't save a second order with the same stripe_pid,
+        as it's unique in the database.
+        If the webhook comes second the order the view created is used,
+        if the view comes second it uses the order the webhook created.
+        So the order is never added twice, and neither has to wait.
         """
         intent = event.data.object
         pid = intent.id
-        bag = intent.metadata.bag
-        save_info = intent.metadata.save_info
+        checkout_data = CheckoutData.objects.filter(stripe_pid=pid).first()
+        if checkout_data:
+            bag = checkout_data.bag
+            save_info = checkout_data.save_info
+            username = checkout_data.username
+        else:
+            # paid before checkout data was kept locally
+            bag = intent.metadata.bag
+            save_info = intent.metadata.save_info == 'true'
+            username = intent.metadata.username
 
         billing_details = intent.charges.data[0].billing_details
         shipping_details = intent.shipping
-        grand_total = round(intent.charges.data[0].amount / 100, 2)
 
         # Clean data in the shipping details
         for field, value in shipping_details.address.items():
@@ -143,8 +184,7 @@ class StripeWH_Handler:
 
         # Update profile information if save_info was checked
         profile = None
-        username = intent.metadata.username
-        if username != 'AnonymousUser':
+        if username and username != 'AnonymousUser':
             profile = UserProfile.objects.get(user__username=username)
             # only update info if save_info box was checked
             if save_info:
@@ -157,39 +197,15 @@ class StripeWH_Handler:
                 profile.default_county = shipping_details.address.state
                 profile.save()
 
-        order_exists = False
-        attempt = 1
-        while attempt <= 5:
-            try:
-                order = Order.objects.get(
-                    full_name__iexact=shipping_details.name,
-                    email__iexact=billing_details.email,
-                    phone_number__iexact=shipping_details.phone,
-                    country__iexact=shipping_details.address.country,
-                    postcode__iexact=shipping_details.address.postal_code,
-                    town_or_city__iexact=shipping_details.address.city,
-                    street_address1__iexact=shipping_details.address.line1,
-                    street_address2__iexact=shipping_details.address.line2,
-                    county__iexact=shipping_details.address.state,
-                    grand_total=grand_total,
-                    # allows user to make 2 differant orders for the same items
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                order_exists = True
-                break
-            except Order.DoesNotExist:
-                attempt += 1
-                time.sleep(1)
-        if order_exists:
+        order = Order.objects.for_payment_intent(pid).first()
+        if order:
             self._send_confirmation_email(order)
             return HttpResponse(
                 content=f'Webhook received: {event["type"]} | SUCCESS: Verified order already in database',  # noqa
                 status=200)
         else:
-            order = None
             try:
-                order = Order.objects.create(
+                order = Order(
                     full_name=shipping_details.name,
                     user_profile=profile,
                     email=billing_details.email,
@@ -204,27 +220,18 @@ class StripeWH_Handler:
                     original_bag=bag,
                     stripe_pid=pid,
                 )
-                for item_id, item_data in json.loads(bag).items():
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:
-                        for size, quantity in item_data['items_by_size'].items():  # noqa
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
+                bag_lines = Bag.decode(bag)
+                create_order(
+                    order, bag_lines,
+                    get_products(self.request, bag_lines.product_ids()))
+            except IntegrityError:
+                # the checkout view created it in the meantime
+                order = Order.objects.for_payment_intent(pid).get()
+                self._send_confirmation_email(order)
+                return HttpResponse(
+                    content=f'Webhook received: {event["type"]} | SUCCESS: Verified order already in database',  # noqa
+                    status=200)
             except Exception as e:
-                if order:
-                    order.delete()
                 return HttpResponse(
                     content=f'Webhook received: {event["type"]} | ERROR: {e}',
                     status=500)
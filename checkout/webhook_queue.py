@@ -0,0 +1,85 @@
+""" This module contains the queue of verified stripe webhook events """
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+from django.utils import timezone
+
+from boutique_ado.queues import TableQueue
+from .gateways import get_gateway
+from .models import WebhookEvent
+from .webhook_handler import StripeWH_Handler
+
+
+# Claimed and retried like the outbox (see boutique_ado/queues.py)
+QUEUE = TableQueue(
+    WebhookEvent, pending=WebhookEvent.PENDING,
+    working=WebhookEvent.PROCESSING, failed=WebhookEvent.DEAD,
+    settings_prefix='WEBHOOK')
+
+
+class WebhookEventError(Exception):
+    """ Raised when the handler responds to an event with an error """
+
+
+def enqueue_event(event, payload):
+    """
+    Save a verified event to be handled later by process_webhooks.
+    payload is the body stripe sent, exactly as it was verified.
+    An event already in the queue is left as it is,
+    as stripe sends the same event again if it isn't sure we got it.
+    Returns the queued event and whether it is new.
+    """
+    return WebhookEvent.objects.get_or_create(
+        event_id=event['id'],
+        defaults={'event_type': event['type'], 'payload': payload})
+
+
+def process_event(pk):
+    """
+    Handle one claimed event with the webhook handler.
+    The event is rebuilt from the payload stripe sent,
+    and handled exactly as the webhook view used to handle it.
+    An error, raised or as the response, is retried after QUEUE.retry_delay,
+    until the event has had WEBHOOK_MAX_ATTEMPTS and is marked dead.
+    Returns the new status of the event.
+    """
+    queued = WebhookEvent.objects.get(pk=pk)
+    try:
+        event = get_gateway().parse_event(queued.payload)
+        response = StripeWH_Handler(None).handle(event)
+        if response.status_code >= 400:
+            raise WebhookEventError(response.content.decode())
+    except Exception as e:  # pylint: disable=broad-except
+        return QUEUE.fail(queued, e)
+
+    WebhookEvent.objects.filter(pk=pk).update(
+        status=WebhookEvent.DONE, locked_at=None, last_error='',
+        processed_at=timezone.now())
+    return WebhookEvent.DONE
+
+
+def _process_in_thread(pk):
+    """
+    Handle an event in a worker thread,
+    closing the thread's database connection afterwards.
+    """
+    try:
+        return process_event(pk)
+    finally:
+        connections.close_all()
+
+
+def process_due_events(workers=1, batch_size=100):
+    """
+    Claim a batch of due events and handle them,
+    in a pool of threads when there is more than one worker.
+    Returns the claimed event ids with their new status.
+    """
+    claimed = QUEUE.claim(batch_size)
+    if workers > 1 and len(claimed) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            statuses = list(pool.map(_process_in_thread, claimed))
+    else:
+        statuses = [process_event(pk) for pk in claimed]
+    return dict(zip(claimed, statuses))
@@ -0,0 +1,34 @@
+""" This module contains the admin logic for the outbox app """
+
+from django.contrib import admin
+from django.utils import timezone
+from .models import OutboxMessage
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    """
+    The admin class for the outbox.
+
+    Read only, as the messages are exactly as they'll be sent.
+    Failed messages can be queued again with the retry action
+    once whatever made them fail is fixed.
+    """
+    list_display = ('subject', 'recipients', 'status',
+                    'attempts', 'next_attempt_at', 'created_at',)
+    list_filter = ('status',)
+    search_fields = ('recipients', 'subject',)
+    readonly_fields = ('subject', 'from_email', 'recipients', 'status',
+                       'attempts', 'next_attempt_at', 'locked_at',
+                       'last_error', 'created_at', 'sent_at',)
+    exclude = ('message',)
+    ordering = ('-created_at',)
+    actions = ('retry_messages',)
+
+    @admin.action(description='Retry selected messages')
+    def retry_messages(self, request, queryset):
+        """ Queue the messages again, with a fresh set of attempts """
+        count = queryset.exclude(status=OutboxMessage.SENDING).update(
+            status=OutboxMessage.PENDING, attempts=0,
+            next_attempt_at=timezone.now(), locked_at=None)
+        self.message_user(request, f'{count} messages queued again')
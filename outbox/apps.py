@@ -0,0 +1,9 @@
+""" This module configures the outbox app """
+
+from django.apps import AppConfig
+
+
+class OutboxConfig(AppConfig):
+    """ configuration settings for the outbox app."""
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'outbox'
@@ -0,0 +1,49 @@
+""" This module contains the outbox email backend """
+
+from django.conf import settings
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.message import sanitize_address
+
+from .models import OutboxMessage
+
+
+class OutboxEmailBackend(BaseEmailBackend):
+    """
+    An email backend that saves messages to the outbox
+    rather than sending them, and returns straight away.
+    Set as EMAIL_BACKEND, so everything that sends mail,
+    the order confirmations and allauth's verification emails,
+    goes through the outbox.
+    The send_outbox command sends them with OUTBOX_EMAIL_BACKEND.
+
+    Saved in the current transaction, if there is one,
+    so a message is only sent if whatever sent it is committed.
+    """
+
+    def send_messages(self, email_messages):
+        """
+        Save the messages to the outbox,
+        returning the number of messages saved.
+        Messages without recipients are skipped, as other backends do.
+        """
+        queued = []
+        for email_message in email_messages:
+            recipients = email_message.recipients()
+            if not recipients:
+                continue
+            encoding = email_message.encoding or settings.DEFAULT_CHARSET
+            try:
+                queued.append(OutboxMessage(
+                    subject=email_message.subject[:254],
+                    from_email=sanitize_address(
+                        email_message.from_email, encoding),
+                    recipients='\n'.join(
+                        sanitize_address(r, encoding) for r in recipients),
+                    message=email_message.message().as_bytes(
+                        linesep='\r\n'),
+                ))
+            except Exception:
+                if not self.fail_silently:
+                    raise
+        OutboxMessage.objects.bulk_create(queued)
+        return len(queued)
@@ -0,0 +1,60 @@
+""" This module contains the command to send the outbox """
+
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from outbox.models import OutboxMessage
+from outbox.sender import send_due_messages
+
+
+class Command(BaseCommand):
+    """
+    Send the emails saved in the outbox (see sender.py),
+    in batches over one connection to the mail server.
+    Runs until stopped, checking for due messages every poll interval,
+    or with --once sends every message that is due and exits,
+    e.g. to run from a scheduler.
+    Failed messages are retried later with a growing delay,
+    messages that keep failing, or are refused, are marked failed.
+    """
+    help = 'Send the emails in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of messages to send over each connection')
+        parser.add_argument(
+            '--rate', type=float, default=settings.OUTBOX_RATE_LIMIT,
+            help='Most messages to send per second, 0 for no limit')
+        parser.add_argument(
+            '--poll-interval', type=float, default=5,
+            help='Seconds to wait when no messages are due')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Send the messages that are due, then exit')
+
+    def handle(self, *args, **options):
+        totals = Counter()
+        try:
+            while True:
+                results = send_due_messages(
+                    batch_size=options['batch_size'], rate=options['rate'])
+                totals.update(results.values())
+                for pk, status in results.items():
+                    if status == OutboxMessage.FAILED:
+                        self.stderr.write(f'Email {pk} failed')
+                if not results:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(
+            'Sent the outbox: ' + ', '.join(
+                f'{totals[status]} {status}'
+                for status in (
+                    OutboxMessage.SENT, OutboxMessage.PENDING,
+                    OutboxMessage.FAILED))))
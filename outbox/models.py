@@ -0,0 +1,59 @@
+""" This module contains the model for the outbox app """
+
+from django.db import models
+from django.utils import timezone
+
+
+class OutboxMessage(models.Model):
+    """
+    An email waiting to be sent.
+
+    Saved by the outbox email backend (see backends.py) in place of sending,
+    so sending mail never holds up a request or the webhook handler.
+    The send_outbox command sends them (see sender.py).
+
+    message is the whole email as it will be sent,
+    from_email and recipients the addresses it is sent from and to,
+    which include any bcc addresses not in the message itself.
+    A message that fails is retried after a growing delay, next_attempt_at,
+    until it has failed OUTBOX_MAX_ATTEMPTS times, or is refused outright,
+    and is marked failed, to be looked at in the admin.
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    class Meta:
+        """ The sender looks for pending messages that are due """
+        indexes = [
+            models.Index(
+                fields=['status', 'next_attempt_at'],
+                name='outbox_message_due'),
+        ]
+
+    subject = models.CharField(max_length=254, blank=True, default='')
+    from_email = models.CharField(max_length=254)
+    recipients = models.TextField()
+    message = models.BinaryField()
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def get_recipients(self):
+        """ Return the recipients as a list """
+        return self.recipients.split('\n')
+
+    def __str__(self):
+        return f'{self.subject} to {self.recipients} ({self.status})'
@@ -0,0 +1,103 @@
+""" This module contains the sending of the outbox """
+
+import email
+import smtplib
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.message import MIMEMixin
+from django.utils import timezone
+
+from boutique_ado.queues import TableQueue
+from .models import OutboxMessage
+
+# Refusals that won't change however many times the message is retried
+PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused,)
+
+# Claimed and retried like webhook events (see boutique_ado/queues.py)
+QUEUE = TableQueue(
+    OutboxMessage, pending=OutboxMessage.PENDING,
+    working=OutboxMessage.SENDING, failed=OutboxMessage.FAILED,
+    settings_prefix='OUTBOX')
+
+
+class StoredMIMEMessage(MIMEMixin, email.message.Message):
+    """ A message parsed back from the outbox, written out as it was """
+
+
+class OutboxEmailMessage(EmailMessage):
+    """
+    A message from the outbox, for any email backend to send.
+    The backend sends the saved message exactly as it was saved,
+    to the saved recipients.
+    """
+
+    def __init__(self, outbox_message, **kwargs):
+        super().__init__(
+            subject=outbox_message.subject,
+            from_email=outbox_message.from_email,
+            to=outbox_message.get_recipients(), **kwargs)
+        self.raw_message = bytes(outbox_message.message)
+
+    def message(self):
+        return email.message_from_bytes(
+            self.raw_message, _class=StoredMIMEMessage)
+
+
+def _send(connection, message):
+    """
+    Send one message over the open connection.
+    After an error the connection is opened again,
+    as the server may well have dropped it.
+    Returns the new status of the message.
+    """
+    try:
+        connection.send_messages([OutboxEmailMessage(message)])
+    except Exception as e:  # pylint: disable=broad-except
+        if not isinstance(e, PERMANENT_ERRORS):
+            connection.close()
+            try:
+                connection.open()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        return QUEUE.fail(
+            message, e, permanent=isinstance(e, PERMANENT_ERRORS))
+    OutboxMessage.objects.filter(pk=message.pk).update(
+        status=OutboxMessage.SENT, locked_at=None, last_error='',
+        sent_at=timezone.now())
+    return OutboxMessage.SENT
+
+
+def send_due_messages(batch_size=100, rate=None):
+    """
+    Claim a batch of due messages and send them
+    over a single connection of OUTBOX_EMAIL_BACKEND,
+    rather than a connection for each message.
+    rate limits the messages sent per second, as mail providers do.
+    Returns the claimed message ids with their new status.
+    """
+    claimed = QUEUE.claim(batch_size)
+    if not claimed:
+        return {}
+    messages = OutboxMessage.objects.filter(pk__in=claimed).order_by('pk')
+    connection = get_connection(
+        settings.OUTBOX_EMAIL_BACKEND, fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:  # pylint: disable=broad-except
+        return {message.pk: QUEUE.fail(message, e) for message in messages}
+
+    results = {}
+    interval = 1 / rate if rate else 0
+    next_send = time.monotonic()
+    try:
+        for message in messages:
+            wait = next_send - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            next_send = time.monotonic() + interval
+            results[message.pk] = _send(connection, message)
+    finally:
+        connection.close()
+    return results
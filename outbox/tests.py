@@ -0,0 +1,212 @@
+""" This module contains the tests for the outbox app """
+
+import socketserver
+import threading
+from datetime import timedelta
+from email import message_from_bytes
+from io import StringIO
+
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .models import OutboxMessage
+from .sender import send_due_messages
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    A stand-in SMTP server on a free local port,
+    just enough of the protocol for smtplib to send mail.
+    Keeps every message it accepts, and counts its connections.
+    Recipients in refuse are refused,
+    and the next temporary_failures messages get a temporary error.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), LocalSMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.refuse = set()
+        self.temporary_failures = 0
+        self.port = self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(
+            target=self.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+    """ Handles one SMTP connection to the stand-in server """
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost ready')
+        sender, recipients = None, []
+        for line in self.rfile:
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip('<>'), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipient = command[8:].strip('<>')
+                if recipient in self.server.refuse:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(recipient)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                if self.server.temporary_failures:
+                    self.server.temporary_failures -= 1
+                    self.reply('451 Try again later')
+                else:
+                    self.server.messages.append(
+                        (sender, recipients, message_from_bytes(data)))
+                    self.reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Not implemented')
+
+
+@override_settings(
+    EMAIL_BACKEND='outbox.backends.OutboxEmailBackend',
+    OUTBOX_EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+    EMAIL_HOST='127.0.0.1', EMAIL_USE_TLS=False, EMAIL_USE_SSL=False,
+    EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_TIMEOUT=5,
+    OUTBOX_MAX_ATTEMPTS=2, OUTBOX_RETRY_DELAY=60,
+    OUTBOX_RETRY_MAX_DELAY=3600, OUTBOX_RATE_LIMIT=0)
+class OutboxTest(TestCase):
+    """
+    Email is saved to the outbox straight away,
+    and send_outbox sends it to a local SMTP server.
+    """
+
+    def setUp(self):
+        self.server = LocalSMTPServer().__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.settings_override = override_settings(EMAIL_PORT=self.server.port)  # noqa
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def _send_mail(self, count=1, **kwargs):
+        for n in range(count):
+            mail.EmailMessage(
+                subject=f'Order {n}', body='Thank you for your order',
+                from_email='shop@example.com', to=[f'ada{n}@example.com'],
+                **kwargs).send()
+
+    def test_backend_saves_without_sending(self):
+        self._send_mail(bcc=['records@example.com'])
+        queued = OutboxMessage.objects.get()
+        self.assertEqual(queued.status, OutboxMessage.PENDING)
+        self.assertEqual(queued.subject, 'Order 0')
+        self.assertEqual(
+            queued.get_recipients(),
+            ['ada0@example.com', 'records@example.com'])
+        self.assertEqual(self.server.connections, 0)
+
+    def test_batch_sent_over_one_connection(self):
+        self._send_mail(count=3)
+        out = StringIO()
+        call_command('send_outbox', '--once', stdout=out)
+        self.assertIn('3 sent', out.getvalue())
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(
+            [(recipients, message['Subject'])
+             for _sender, recipients, message in self.server.messages],
+            [(['ada0@example.com'], 'Order 0'),
+             (['ada1@example.com'], 'Order 1'),
+             (['ada2@example.com'], 'Order 2')])
+        self.assertFalse(OutboxMessage.objects.exclude(
+            status=OutboxMessage.SENT).exists())
+
+    def test_message_sent_as_saved(self):
+        self._send_mail(bcc=['records@example.com'])
+        send_due_messages()
+        sender, recipients, message = self.server.messages[0]
+        self.assertEqual(sender, 'shop@example.com')
+        self.assertEqual(
+            recipients, ['ada0@example.com', 'records@example.com'])
+        self.assertEqual(message['To'], 'ada0@example.com')
+        self.assertIsNone(message['Bcc'])
+        self.assertEqual(
+            message.get_payload().strip(), 'Thank you for your order')
+
+    def test_temporary_failure_is_retried(self):
+        self._send_mail(count=2)
+        self.server.temporary_failures = 1
+        results = send_due_messages()
+        self.assertEqual(
+            sorted(results.values()),
+            [OutboxMessage.PENDING, OutboxMessage.SENT])
+        failed = OutboxMessage.objects.get(status=OutboxMessage.PENDING)
+        self.assertIn('451', failed.last_error)
+        self.assertGreater(failed.next_attempt_at, timezone.now())
+
+        # not due again until the retry delay has passed
+        self.assertEqual(send_due_messages(), {})
+        OutboxMessage.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(
+            list(send_due_messages().values()), [OutboxMessage.SENT])
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_failed_after_max_attempts(self):
+        self._send_mail()
+        self.server.temporary_failures = 2
+        send_due_messages()
+        OutboxMessage.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(
+            list(send_due_messages().values()), [OutboxMessage.FAILED])
+        self.assertEqual(OutboxMessage.objects.get().attempts, 2)
+
+    def test_refused_recipient_fails_straight_away(self):
+        self._send_mail(count=2)
+        self.server.refuse.add('ada0@example.com')
+        results = send_due_messages()
+        self.assertEqual(
+            sorted(results.values()),
+            [OutboxMessage.FAILED, OutboxMessage.SENT])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_server_down_is_retried(self):
+        self._send_mail()
+        with override_settings(EMAIL_PORT=1):
+            results = send_due_messages()
+        self.assertEqual(list(results.values()), [OutboxMessage.PENDING])
+        self.assertEqual(OutboxMessage.objects.get().attempts, 1)
+
+    def test_abandoned_claim_is_claimed_again(self):
+        self._send_mail()
+        OutboxMessage.objects.update(
+            status=OutboxMessage.SENDING, attempts=1,
+            locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(
+            list(send_due_messages().values()), [OutboxMessage.SENT])
+
+    def test_rate_limit(self):
+        self._send_mail(count=3)
+        started = timezone.now()
+        send_due_messages(rate=20)
+        self.assertGreaterEqual(
+            timezone.now() - started, timedelta(seconds=0.1))
+        self.assertEqual(len(self.server.messages), 3)
@@ -1,6 +1,19 @@
+""" This module configures the products app """
+
 from django.apps import AppConfig
 
 
 class ProductsConfig(AppConfig):
+    """ configuration settings for the products app."""
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    def ready(self):
+        """
+        Import the signals module.
+        Every time a product is saved or deleted
+        the search index is updated to match.
+        And every time a product or category changes
+        the catalog version is bumped.
+        """
+        import products.signals  # noqa
@@ -0,0 +1,38 @@
+""" This module contains the catalog version helpers for caching """
+
+import hashlib
+import json
+
+from .models import CatalogVersion
+
+
+def get_catalog_stamp(request):
+    """
+    Return the current catalog version and when it last changed.
+    Looked up once per request and remembered on it,
+    so every cache lookup made while handling a request agrees.
+    """
+    if not hasattr(request, '_catalog_stamp'):
+        request._catalog_stamp = CatalogVersion.stamp()  # pylint: disable=protected-access  # noqa
+    return request._catalog_stamp  # pylint: disable=protected-access
+
+
+def get_catalog_version(request=None):
+    """
+    Return the current catalog version,
+    remembered on the request if there is one.
+    """
+    if request is None:
+        return CatalogVersion.current()
+    return get_catalog_stamp(request)[0]
+
+
+def catalog_cache_key(prefix, version, **params):
+    """
+    Build a cache key from a prefix, the catalog version
+    and any parameters the cached value depends on.
+    The parameters are hashed so the key is always a safe length.
+    """
+    data = json.dumps(params, sort_keys=True, default=str)
+    digest = hashlib.md5(data.encode()).hexdigest()
+    return f'{prefix}:v{version}:{digest}'
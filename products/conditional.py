@@ -0,0 +1,111 @@
+""" This module contains the conditional GET helpers for the products views """
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.contrib import messages
+from django.views.decorators.http import condition
+
+from bag.codec import get_bag
+from bag.contexts import get_bag_fingerprint
+from .catalog import get_catalog_stamp
+from .product_cache import get_products
+
+
+def _get_visitor_state(request):
+    """
+    Return the parts of a page that differ per visitor,
+    or None if the page can't be validated at all.
+
+    The page header shows the bag total and the admin links,
+    and forms carry the csrf token from the visitor's cookie,
+    so all of them go into the ETag.
+    The bag goes in as its fingerprint, which includes the catalog version,
+    so the total changes when any product in the bag is repriced.
+    Pending messages are shown once and then consumed,
+    so a page with messages is always rendered in full.
+    """
+    if len(messages.get_messages(request)):
+        return None
+    user = request.user
+    bag = get_bag(request)
+    return {
+        'user': user.pk,
+        'superuser': user.is_superuser,
+        'bag': get_bag_fingerprint(request) if bag else '',
+        'csrf': request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+    }
+
+
+def _is_anonymous_state(state):
+    """
+    A visitor with no account, bag or cookie sees the same page
+    as everyone else, so only then can Last-Modified be used.
+    """
+    return not (state['user'] or state['bag'] or state['csrf'])
+
+
+def _make_etag(resource, state):
+    """ Hash the resource version and visitor state into an ETag """
+    data = json.dumps([resource, state], sort_keys=True, default=str)
+    return hashlib.md5(data.encode()).hexdigest()
+
+
+def _get_product_stamp(request, product_id):
+    """
+    Return when a product, or the category shown with it, last changed.
+    Read through the product cache, which the view then reuses.
+    """
+    product = get_products(request, [product_id]).get(product_id)
+    if product is None:
+        return None
+    stamps = [product.updated_at]
+    if product.category:
+        stamps.append(product.category.updated_at)
+    return max(stamps)
+
+
+def _product_etag(request, product_id):
+    state = _get_visitor_state(request)
+    updated_at = _get_product_stamp(request, product_id)
+    if state is None or updated_at is None:
+        return None
+    return _make_etag(['product', product_id, updated_at], state)
+
+
+def _product_last_modified(request, product_id):
+    state = _get_visitor_state(request)
+    if state is None or not _is_anonymous_state(state):
+        return None
+    return _get_product_stamp(request, product_id)
+
+
+def _listing_etag(request):
+    """
+    The load more button asks for the same url as JSON with ajax,
+    so whether the request is ajax goes into the ETag too.
+    """
+    state = _get_visitor_state(request)
+    if state is None:
+        return None
+    version, _ = get_catalog_stamp(request)
+    requested_with = request.headers.get('x-requested-with', '')
+    return _make_etag(
+        ['products', version, sorted(request.GET.lists()), requested_with],
+        state)
+
+
+def _listing_last_modified(request):
+    state = _get_visitor_state(request)
+    if state is None or not _is_anonymous_state(state):
+        return None
+    _, updated_at = get_catalog_stamp(request)
+    return updated_at
+
+
+# pylint: disable=invalid-name
+product_condition = condition(
+    etag_func=_product_etag, last_modified_func=_product_last_modified)
+listing_condition = condition(
+    etag_func=_listing_etag, last_modified_func=_listing_last_modified)
@@ -0,0 +1,117 @@
+""" This module contains the facet counts for the products listing """
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, Count, IntegerField, Value, When
+
+from .catalog import catalog_cache_key
+
+# The upper bound of each price bucket, the last bucket has no upper bound
+PRICE_BUCKETS = (25, 50, 100, 250)
+RATING_BUCKETS = (5, 4, 3, 2, 1, 0)
+
+
+def _price_bucket():
+    """ Annotate each product with the index of its price bucket """
+    whens = [
+        When(price__lt=limit, then=Value(index))
+        for index, limit in enumerate(PRICE_BUCKETS)
+    ]
+    return Case(*whens, default=Value(len(PRICE_BUCKETS)),
+                output_field=IntegerField())
+
+
+def _rating_bucket():
+    """
+    Annotate each product with its whole star rating, rounded down.
+    Products without a rating are left as null.
+    """
+    whens = [
+        When(rating__gte=stars, then=Value(stars))
+        for stars in RATING_BUCKETS
+    ]
+    return Case(*whens, default=None, output_field=IntegerField())
+
+
+def _price_label(index):
+    """ A label for a price bucket, such as $25 - $50 """
+    if index == 0:
+        return f'Under ${PRICE_BUCKETS[0]}'
+    if index == len(PRICE_BUCKETS):
+        return f'${PRICE_BUCKETS[-1]} and over'
+    return f'${PRICE_BUCKETS[index - 1]} - ${PRICE_BUCKETS[index]}'
+
+
+def _count_facets(products, category_names):
+    """
+    Count the products in each category, rating and price bucket.
+
+    Done with one GROUP BY over the searched products,
+    by category, rating bucket and price bucket together.
+    The category counts are summed over every row,
+    so they show how many results each category would give.
+    The rating and price counts, and the total,
+    only sum the rows in the selected categories.
+    results is the number of products found, whatever their category.
+    """
+    rows = (
+        products.order_by()
+        .annotate(rating_bucket=_rating_bucket(), price_bucket=_price_bucket())  # noqa
+        .values('category__name', 'category__friendly_name',
+                'rating_bucket', 'price_bucket')
+        .annotate(count=Count('id'))
+    )
+
+    categories = {}
+    ratings = {}
+    prices = {}
+    total = 0
+    results = 0
+    for row in rows:
+        results += row['count']
+        name = row['category__name']
+        if name is not None:
+            category = categories.setdefault(name, {
+                'name': name,
+                'friendly_name': row['category__friendly_name'],
+                'count': 0,
+                'selected': name in category_names,
+            })
+            category['count'] += row['count']
+        if category_names and name not in category_names:
+            continue
+        total += row['count']
+        ratings[row['rating_bucket']] = ratings.get(row['rating_bucket'], 0) + row['count']  # noqa
+        prices[row['price_bucket']] = prices.get(row['price_bucket'], 0) + row['count']  # noqa
+
+    return {
+        'total': total,
+        'results': results,
+        'categories': sorted(
+            categories.values(), key=lambda c: c['friendly_name'] or c['name']),  # noqa
+        'ratings': [
+            {'stars': stars, 'count': ratings[stars]}
+            for stars in RATING_BUCKETS + (None,) if stars in ratings
+        ],
+        'prices': [
+            {'label': _price_label(index), 'count': prices[index]}
+            for index in range(len(PRICE_BUCKETS) + 1) if index in prices
+        ],
+    }
+
+
+def get_facets(products, version, search, category_names):
+    """
+    Return the facet counts for the current search and categories.
+
+    products should already be searched but not filtered by category,
+    so every category in the results gets a count.
+    Cached by the catalog version, the search and the categories.
+    """
+    key = catalog_cache_key(
+        'products:facets', version, search=search, categories=category_names)
+    facets = cache.get(key)
+    if facets is None:
+        facets = _count_facets(products, category_names)
+        cache.set(key, facets, settings.PRODUCTS_CACHE_TIMEOUT)
+    return facets
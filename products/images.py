@@ -0,0 +1,117 @@
+""" This module contains the responsive image derivatives for products """
+
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image
+
+from .models import CatalogVersion, Product
+
+DERIVATIVES_DIR = 'derivatives'
+FORMATS = {
+    'webp': 'WEBP',
+    'jpeg': 'JPEG',
+}
+
+
+def derivative_name(name, width, fmt):
+    """
+    Return the storage name of one derivative of an image.
+    e.g. 'teapot.jpg' at 320 wide as webp is 'derivatives/teapot-320w.webp'
+    """
+    stem = os.path.splitext(name)[0]
+    return f'{DERIVATIVES_DIR}/{stem}-{width}w.{fmt}'
+
+
+def get_widths(image_width):
+    """
+    Return the widths to resize an image to.
+    Every configured width narrower than the image,
+    plus the image's own width so large screens still get the full size.
+    """
+    widths = [w for w in settings.PRODUCT_IMAGE_WIDTHS if w < image_width]
+    return widths + [image_width]
+
+
+def _is_up_to_date(storage, name, widths):
+    """
+    Check every derivative exists and is newer than the original.
+    Storages that can't tell the modified time only check they exist.
+    """
+    names = [derivative_name(name, w, fmt) for w in widths for fmt in FORMATS]
+    if not all(storage.exists(d) for d in names):
+        return False
+    try:
+        modified = storage.get_modified_time(name)
+        return all(storage.get_modified_time(d) >= modified for d in names)
+    except NotImplementedError:
+        return True
+
+
+def _encode(image, width, fmt):
+    """ Resize the image to a width and encode it in a format """
+    height = round(image.height * width / image.width)
+    resized = image.resize((width, height), Image.LANCZOS)
+    if resized.mode not in ('RGB', 'L'):
+        resized = resized.convert('RGB')
+    buffer = BytesIO()
+    resized.save(
+        buffer, FORMATS[fmt], quality=settings.PRODUCT_IMAGE_QUALITY,
+        optimize=True, **({'progressive': True} if fmt == 'jpeg' else {}))
+    return buffer.getvalue()
+
+
+def generate_derivatives(name, storage=None, force=False):
+    """
+    Make the resized webp and jpeg versions of an image in storage.
+    Skips images whose derivatives are already up to date,
+    unless force is given.
+    Returns the widths that were made.
+    """
+    storage = storage or default_storage
+    with storage.open(name) as original:
+        image = Image.open(original)
+        widths = get_widths(image.width)
+        if not force and _is_up_to_date(storage, name, widths):
+            return widths
+        image.load()
+    for width in widths:
+        for fmt in FORMATS:
+            path = derivative_name(name, width, fmt)
+            if storage.exists(path):
+                storage.delete(path)
+            storage.save(path, ContentFile(_encode(image, width, fmt)))
+    return widths
+
+
+def format_widths(widths):
+    """ Return widths in the form stored on Product.image_widths """
+    return ','.join(str(w) for w in widths)
+
+
+def parse_widths(image_widths):
+    """ Return the widths stored on Product.image_widths as integers """
+    return [int(w) for w in image_widths.split(',') if w]
+
+
+# pylint: disable=no-member
+def update_product_images(product_id):
+    """
+    Make the derivatives of a product's image
+    and record their widths on the product.
+    Only updated if the product still has the same image,
+    in case it was changed again in the meantime.
+    updated_at and the catalog version are bumped
+    so cached pages pick up the new images.
+    """
+    product = Product.objects.filter(pk=product_id).only('image').first()
+    if product is None or not product.image:
+        return
+    widths = generate_derivatives(product.image.name)
+    Product.objects.filter(pk=product_id, image=product.image.name).update(
+        image_widths=format_widths(widths), updated_at=timezone.now())
+    CatalogVersion.bump()
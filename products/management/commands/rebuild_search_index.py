@@ -0,0 +1,32 @@
+""" This module contains the command to rebuild the product search index """
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from products.models import Product
+from products.search import get_search_backend
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the product search index from scratch.
+    Useful after a bulk import that bypassed the model signals,
+    or when switching database.
+    The index is cleared and refilled in batches inside one transaction,
+    so searches never see a half built index.
+    """
+    help = 'Rebuild the product search index in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of products inserted per batch')
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        products = Product.objects.only(
+            'id', 'name', 'description').iterator(chunk_size=options['batch_size'])  # noqa
+        with transaction.atomic():
+            count = backend.rebuild(products, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {count} products with {type(backend).__name__}'))
@@ -0,0 +1,75 @@
+""" This module contains the command to make the product image derivatives """
+
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from products.images import format_widths, generate_derivatives
+from products.models import CatalogVersion, Product
+
+
+def _resize(name, force):
+    """
+    Make the derivatives of one image in a worker process.
+    Errors are returned rather than raised,
+    so one broken image doesn't stop the rest.
+    """
+    try:
+        return name, generate_derivatives(name, force=force), None
+    except Exception as e:  # pylint: disable=broad-except
+        return name, None, e
+
+
+class Command(BaseCommand):
+    """
+    Make the resized webp and jpeg versions of every product image
+    (see images.py), for images uploaded before derivatives existed
+    or after changing PRODUCT_IMAGE_WIDTHS.
+    Images are resized in parallel in a pool of processes,
+    images whose derivatives are already up to date are skipped.
+    The widths are then saved on the products in one go.
+    """
+    help = 'Make the resized versions of existing product images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Number of worker processes, defaults to one per CPU')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Remake derivatives even if they are up to date')
+
+    # pylint: disable=no-member
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image=None)
+        names = sorted(set(products.values_list('image', flat=True)))
+        # the workers are forked, they must not share the database connection
+        connections.close_all()
+
+        widths_by_name = {}
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            for name, widths, error in pool.map(
+                    _resize, names, [options['force']] * len(names)):
+                if error:
+                    self.stderr.write(f'Could not resize {name}: {error}')
+                else:
+                    widths_by_name[name] = format_widths(widths)
+
+        to_update = []
+        now = timezone.now()
+        for product in products.only(
+                'id', 'image', 'image_widths', 'updated_at'):
+            widths = widths_by_name.get(product.image.name)
+            if widths is not None and widths != product.image_widths:
+                product.image_widths = widths
+                product.updated_at = now
+                to_update.append(product)
+        Product.objects.bulk_update(
+            to_update, ['image_widths', 'updated_at'], batch_size=500)
+        if to_update:
+            CatalogVersion.bump()
+        self.stdout.write(self.style.SUCCESS(
+            f'Resized {len(widths_by_name)} images, '
+            f'updated {len(to_update)} products'))
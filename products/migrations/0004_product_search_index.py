@@ -0,0 +1,50 @@
+# Generated by Django 3.2.12 on 2026-10-18 09:12
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Create the search index table for the database in use,
+    and fill it from the existing products.
+    See products/search.py for the backends that use it.
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE products_product_fts USING fts5('
+            "name, description, tokenize='porter unicode61')")
+        schema_editor.execute(
+            'INSERT INTO products_product_fts (rowid, name, description) '
+            'SELECT id, name, description FROM products_product')
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE products_product_search ('
+            'product_id bigint PRIMARY KEY, document tsvector NOT NULL)')
+        schema_editor.execute(
+            'CREATE INDEX products_product_search_document_gin '
+            'ON products_product_search USING GIN (document)')
+        schema_editor.execute(
+            'INSERT INTO products_product_search (product_id, document) '
+            "SELECT id, setweight(to_tsvector('english', name), 'A') || "
+            "setweight(to_tsvector('english', description), 'B') "
+            'FROM products_product')
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS products_product_fts')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP TABLE IF EXISTS products_product_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_auto_20220312_2005'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
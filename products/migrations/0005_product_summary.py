@@ -0,0 +1,29 @@
+# Generated by Django 3.2.12 on 2026-10-18 02:53
+
+from django.db import migrations, models
+from django.utils.text import Truncator
+
+
+def fill_summaries(apps, schema_editor):
+    """ Set the summary on the existing products """
+    Product = apps.get_model('products', 'Product')
+    products = list(Product.objects.only('id', 'description'))
+    for product in products:
+        product.summary = Truncator(product.description).chars(120)
+    Product.objects.bulk_update(products, ['summary'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='summary',
+            field=models.CharField(blank=True, default='', editable=False, max_length=120),
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.12 on 2026-10-18 02:54
+
+from django.db import migrations, models
+
+
+def fill_lower_names(apps, schema_editor):
+    """ Set the lower case name on the existing products """
+    Product = apps.get_model('products', 'Product')
+    products = list(Product.objects.only('id', 'name'))
+    for product in products:
+        product.lower_name = product.name.lower()
+    Product.objects.bulk_update(products, ['lower_name'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_product_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='lower_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=254),
+        ),
+        migrations.RunPython(fill_lower_names, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['name'], name='category_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price', 'id'], name='product_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['rating', 'id'], name='product_rating_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['lower_name', 'id'], name='product_lower_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['sku'], name='product_sku_idx'),
+        ),
+    ]
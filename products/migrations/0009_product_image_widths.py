@@ -0,0 +1,18 @@
+# Generated by Django 3.2.12 on 2026-10-18 03:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0008_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='image_widths',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+from django.utils.text import Truncator
+
+
+def fill_derived_fields(apps, schema_editor):
+    """
+    Set the summary and lower case name on products
+    loaded from fixtures before they were set on raw saves
+    """
+    Product = apps.get_model('products', 'Product')
+    products = list(Product.objects.only('id', 'name', 'description'))
+    for product in products:
+        product.lower_name = product.name.lower()
+        product.summary = Truncator(product.description).chars(120)
+    Product.objects.bulk_update(
+        products, ['lower_name', 'summary'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0010_updated_at_default'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_derived_fields, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,11 @@
 """ This module contains the models for the products app """
 
 from django.db import models
+from django.utils import timezone
+from django.utils.text import Truncator
+
+# Length of the summary kept for teaser text on the products grid
+SUMMARY_LENGTH = 120
 
 
 class Category(models.Model):
@@ -10,11 +15,24 @@ class Category(models.Model):
     class Meta:
         """
         Inbuilt method to adjust name in admin panel.
+        The name is indexed for the category filter on the products page.
         """
         verbose_name_plural = "Categories"
+        indexes = [
+            models.Index(fields=['name'], name='category_name_idx'),
+        ]
 
     name = models.CharField(max_length=254)
     friendly_name = models.CharField(max_length=254, null=True, blank=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def save(self, *args, **kwargs):
+        """
+        Override the original save method to set updated_at.
+        Not auto_now, so fixtures and other raw saves get the default.
+        """
+        self.updated_at = timezone.now()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         # pylint: disable=invalid-str-returned
@@ -32,12 +50,41 @@ class Product(models.Model):
     A Model to hold the product info.
     Each product requires a name, description and price.
     Everything else is optional.
+
+    summary is a short version of the description,
+    set automatically when the product is saved, including by loaddata
+    (see set_derived_fields in signals.py).
+    So the products grid never needs to load the full description.
+
+    lower_name is the name in lower case, also set when saved.
+    So sorting by name is case insensitive and can use an index.
+    bulk_create and QuerySet.update skip both, use set_derived_fields.
+
+    image_widths lists the widths the image has been resized to,
+    comma separated, once the derivatives are made (see images.py).
+    Empty until then, so templates fall back to the original image.
     """
+    class Meta:
+        """
+        An index for each sort option on the products page,
+        each with the id as the tie breaker the listing sorts by.
+        Plus the sku the admin is ordered by.
+        """
+        indexes = [
+            models.Index(fields=['price', 'id'], name='product_price_idx'),
+            models.Index(fields=['rating', 'id'], name='product_rating_idx'),
+            models.Index(fields=['lower_name', 'id'], name='product_lower_name_idx'),  # noqa
+            models.Index(fields=['sku'], name='product_sku_idx'),
+        ]
+
     category = models.ForeignKey(
         'Category', null=True, blank=True, on_delete=models.SET_NULL
     )
     sku = models.CharField(max_length=254, null=True, blank=True)
     name = models.CharField(max_length=254)
+    lower_name = models.CharField(
+        max_length=254, blank=True, default='', editable=False
+    )
     description = models.TextField()
     has_sizes = models.BooleanField(default=False, null=True, blank=True)
     price = models.DecimalField(max_digits=6, decimal_places=2)
@@ -46,7 +93,75 @@ class Product(models.Model):
     )
     image_url = models.URLField(max_length=1024, null=True, blank=True)
     image = models.ImageField(null=True, blank=True)
+    image_widths = models.CharField(
+        max_length=64, blank=True, default='', editable=False
+    )
+    summary = models.CharField(
+        max_length=SUMMARY_LENGTH, blank=True, default='', editable=False
+    )
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def set_derived_fields(self):
+        """ Set the summary and lower case name from the product """
+        self.lower_name = self.name.lower()
+        self.summary = Truncator(self.description).chars(SUMMARY_LENGTH)
+
+    def save(self, *args, **kwargs):
+        """
+        Override the original save method to set updated_at,
+        not auto_now so raw saves get the default.
+        """
+        self.updated_at = timezone.now()
+        if not self.image:
+            self.image_widths = ''
+        super().save(*args, **kwargs)
 
     def __str__(self):
         # pylint: disable=invalid-str-returned
         return self.name
+
+
+class CatalogVersion(models.Model):
+    """
+    A single row holding the version number of the whole catalog.
+
+    It is bumped every time a product or category is saved or deleted
+    (see signals.py), however the change is made.
+    Anything cached from the catalog includes the version in its key,
+    so bumping it invalidates every cached entry at once.
+    It lives in the database rather than the cache
+    so every worker process sees the same version.
+    updated_at is when the catalog last changed, for Last-Modified headers.
+    """
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'Catalog version {self.version}'
+
+    @classmethod
+    def current(cls):
+        """
+        Return the current catalog version.
+        """
+        version = cls.objects.filter(pk=1).values_list('version', flat=True).first()  # noqa
+        return version or 0
+
+    @classmethod
+    def stamp(cls):
+        """
+        Return the current catalog version and when it last changed.
+        """
+        stamp = cls.objects.filter(pk=1).values_list('version', 'updated_at').first()  # noqa
+        return stamp or (0, None)
+
+    @classmethod
+    def bump(cls):
+        """
+        Increment the catalog version in the database,
+        creating the row if it doesn't exist yet.
+        """
+        updated = cls.objects.filter(pk=1).update(
+            version=models.F('version') + 1, updated_at=timezone.now())
+        if not updated:
+            cls.objects.get_or_create(pk=1, defaults={'version': 1})
@@ -0,0 +1,162 @@
+""" This module contains the keyset paginator for the products listing """
+
+import base64
+import binascii
+import json
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Q
+
+
+def encode_cursor(value, pk):
+    """
+    Encode the sort value and id of the last product on a page
+    into a url safe string.
+    Decimals are stored as strings so no precision is lost.
+    """
+    if isinstance(value, Decimal):
+        value = str(value)
+    data = json.dumps([value, pk], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor back into its (value, id) pair.
+    Returns None if the cursor is missing or has been tampered with,
+    in which case the listing just starts from the first page.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError, TypeError):
+        return None
+    if not isinstance(pk, int) or isinstance(value, (list, dict)):
+        return None
+    return value, pk
+
+
+def nulls_sort_largest():
+    """
+    Whether the database treats null as larger than any other value.
+    Postgres and Oracle put nulls last when sorting ascending,
+    SQLite and MySQL put them first.
+    The listing sorts with the database default so an index can serve it,
+    the keyset filter just needs to know which end the nulls are at.
+    """
+    return connection.vendor in ('postgresql', 'oracle')
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset by the values of the last row seen,
+    rather than by counting rows with an offset.
+    Each page is a single indexed range scan however deep into the listing,
+    and products added or removed between pages never shift the pages.
+
+    The queryset is ordered by the sort field,
+    with the id as a tie breaker in the same direction,
+    so the order is always stable even when many products share a price.
+    nullable should be set for fields which can be null,
+    like the rating or the category name.
+    """
+
+    def __init__(self, queryset, field, descending=False, nullable=False,
+                 per_page=24):
+        self.field = field
+        self.descending = descending
+        self.nullable = nullable
+        self.per_page = per_page
+        if descending:
+            self.queryset = queryset.order_by(f'-{field}', '-id')
+        else:
+            self.queryset = queryset.order_by(field, 'id')
+
+    def _after(self, value, pk):
+        """
+        Build the filter for every row that comes after (value, pk).
+
+        after is gt when ascending and lt when descending.
+        Nulls come at the end of the scan if they sort largest
+        and the scan is ascending, or vice versa.
+        If the last value seen is null only the remaining nulls
+        (and any values, if the nulls come first) are left.
+        """
+        after = 'lt' if self.descending else 'gt'
+        nulls_at_end = nulls_sort_largest() != self.descending
+        field = self.field
+
+        if value is None:
+            query = Q(**{f'{field}__isnull': True, f'id__{after}': pk})
+            if not nulls_at_end:
+                query |= Q(**{f'{field}__isnull': False})
+            return query
+
+        query = Q(**{f'{field}__{after}': value})
+        query |= Q(**{field: value, f'id__{after}': pk})
+        if self.nullable and nulls_at_end:
+            query |= Q(**{f'{field}__isnull': True})
+        return query
+
+    def page(self, cursor=None):
+        """
+        Return the page of products after the cursor,
+        and the cursor for the page after that.
+        One extra row is fetched to find out if there is a next page
+        without a separate count.
+        """
+        queryset = self.queryset
+        position = self._position(cursor)
+        if position is not None:
+            queryset = queryset.filter(self._after(*position))
+
+        rows = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(rows) > self.per_page:
+            rows = rows[:self.per_page]
+            last = rows[-1]
+            next_cursor = encode_cursor(self._value(last), last.pk)
+        return rows, next_cursor
+
+    def _position(self, cursor):
+        """
+        Decode the cursor into a (value, id) pair for the sort field.
+        Returns None, to start from the first page, for a cursor
+        whose value isn't right for the field, e.g. text for the price.
+        """
+        position = decode_cursor(cursor)
+        if position is None:
+            return None
+        value, pk = position
+        if value is None:
+            return position
+        try:
+            return self._sort_field().to_python(value), pk
+        except (ValidationError, ValueError, TypeError):
+            return None
+
+    def _sort_field(self):
+        """
+        The model field the queryset is sorted on, across relations,
+        or the output field of an annotation such as the search rank.
+        """
+        query = self.queryset.query
+        if self.field in query.annotations:
+            return query.annotations[self.field].output_field
+        model = self.queryset.model
+        *relations, name = self.field.split('__')
+        for relation in relations:
+            model = model._meta.get_field(relation).related_model  # pylint: disable=protected-access  # noqa
+        return model._meta.get_field(name)  # pylint: disable=protected-access
+
+    def _value(self, obj):
+        """ Follow the sort field, across relations, on a product """
+        for attr in self.field.split('__'):
+            if obj is None:
+                return None
+            obj = getattr(obj, attr)
+        return obj
@@ -0,0 +1,144 @@
+""" This module contains the per process cache of product rows """
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.http import Http404
+
+from .catalog import get_catalog_version
+from .models import Product
+
+
+class ProductCache:
+    """
+    A read through cache of products, with their category,
+    kept in each worker process and bounded to a number of products,
+    evicting the least recently used.
+
+    Every lookup passes the catalog version of the current request
+    (see catalog.py), one cheap query shared by the whole request.
+    When a product or category is saved anywhere the version is bumped,
+    and the first request in each worker to see the new version
+    empties that worker's cache. So edits show up on the next request.
+
+    The products are shared between requests and must not be modified.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._products = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self, version):
+        """
+        Empty the cache if the catalog has changed since it was filled.
+        An older version, from a request that started before the change,
+        still reads the newer products, which is harmless.
+        """
+        if self._version is None or version > self._version:
+            if self._products:
+                self.invalidations += 1
+            self._products.clear()
+            self._version = version
+
+    def get_many(self, product_ids, version):
+        """
+        Return a dictionary of the products with the given ids.
+        Products that aren't cached are fetched in one query,
+        any that don't exist are left out.
+        """
+        found = {}
+        with self._lock:
+            self._check_version(version)
+            for product_id in product_ids:
+                product = self._products.get(product_id)
+                if product is not None:
+                    self._products.move_to_end(product_id)
+                    found[product_id] = product
+            self.hits += len(found)
+            missing = [pk for pk in product_ids if pk not in found]
+            self.misses += len(missing)
+        if not missing:
+            return found
+
+        fetched = Product.objects.select_related('category').in_bulk(missing)
+        with self._lock:
+            if self._version is not None and version >= self._version:
+                for product_id, product in fetched.items():
+                    self._products[product_id] = product
+                    self._products.move_to_end(product_id)
+                while len(self._products) > self.max_size:
+                    self._products.popitem(last=False)
+                    self.evictions += 1
+        found.update(fetched)
+        return found
+
+    def get(self, product_id, version):
+        """ Return the product with the given id, or None """
+        return self.get_many([product_id], version).get(product_id)
+
+    def invalidate(self):
+        """
+        Empty the cache straight away in the process that changed
+        the catalog, others empty theirs when they see the new version.
+        """
+        with self._lock:
+            if self._products:
+                self.invalidations += 1
+            self._products.clear()
+            self._version = None
+
+    def clear(self):
+        """ Empty the cache and reset the stats """
+        with self._lock:
+            self._products.clear()
+            self._version = None
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self):
+        """ Return the hit and miss counts and the current size """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._products),
+                'max_size': self.max_size,
+                'version': self._version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+product_cache = ProductCache(settings.PRODUCT_CACHE_SIZE)
+
+
+def get_products(request, product_ids):
+    """
+    Return a dictionary of products by id, read through the product cache
+    at the catalog version of the request.
+    """
+    return product_cache.get_many(
+        list(product_ids), get_catalog_version(request))
+
+
+def get_product_or_404(request, product_id):
+    """
+    Return a product read through the product cache,
+    raising a 404 if the id isn't valid or the product doesn't exist.
+    """
+    try:
+        product_id = int(product_id)
+    except (TypeError, ValueError) as e:
+        raise Http404('Invalid product id') from e
+    product = get_products(request, [product_id]).get(product_id)
+    if product is None:
+        raise Http404('No product matches the given query.')
+    return product
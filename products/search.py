@@ -0,0 +1,230 @@
+""" This module contains the search backends for the products app """
+
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils.module_loading import import_string
+
+# pylint: disable=pointless-string-statement
+"""
+Each backend keeps its own index of the product names and descriptions,
+in a table alongside the products table keyed by the product id.
+The index is created by migration 0004,
+kept up to date from the product save and delete signals (see signals.py)
+and can be rebuilt in bulk with the rebuild_search_index command.
+
+search returns the queryset filtered down to the matching products,
+annotated with a search_rank where 0 is the most relevant.
+The ranked backends return at most PRODUCT_SEARCH_LIMIT of them,
+the most relevant.
+"""
+
+SEARCH_TERMS = re.compile(r'\w+')
+
+
+def _get_terms(query):
+    """ Split the search query into plain word terms, lowercased """
+    return [term.lower() for term in SEARCH_TERMS.findall(query or '')]
+
+
+def _rank_queryset(queryset, ranked_ids):
+    """
+    Filter the queryset down to the ranked product ids.
+    And annotate each product with its position in that list.
+    """
+    if not ranked_ids:
+        return queryset.none().annotate(
+            search_rank=Value(0, output_field=IntegerField()))
+    whens = [When(pk=pk, then=Value(rank)) for rank, pk in enumerate(ranked_ids)]  # noqa
+    return queryset.filter(pk__in=ranked_ids).annotate(
+        search_rank=Case(*whens, output_field=IntegerField()))
+
+
+class BaseSearchBackend:
+    """
+    The default search backend.
+    Matches the query against the name or the description,
+    the same way as the original products view.
+    There is no index to maintain and no ranking,
+    so every match is returned.
+    """
+    limit = None
+
+    def search(self, queryset, query):
+        """ Filter the queryset to the products matching the query """
+        queries = Q(name__icontains=query) | Q(description__icontains=query)
+        return queryset.filter(queries).annotate(
+            search_rank=Value(0, output_field=IntegerField()))
+
+    def is_truncated(self, count):
+        """
+        Whether a search with count results may have been cut off
+        at the limit, so there could be more matches.
+        """
+        return self.limit is not None and count >= self.limit
+
+    def index_product(self, product):
+        """ Add or update a single product in the index """
+
+    def remove_product(self, product_id):
+        """ Remove a single product from the index """
+
+    def rebuild(self, products, batch_size=500):
+        """ Rebuild the whole index from an iterable of products """
+        return 0
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """
+    Searches an FTS5 virtual table.
+    The rowid of the table is the product id.
+    Each term is a prefix match and all terms must match.
+    Results are ranked with bm25, a match in the name
+    counting ten times as much as a match in the description.
+    """
+    table = 'products_product_fts'
+
+    @property
+    def limit(self):
+        return settings.PRODUCT_SEARCH_LIMIT
+
+    def search(self, queryset, query):
+        terms = _get_terms(query)
+        if not terms:
+            return _rank_queryset(queryset, [])
+        match = ' '.join(f'"{term}"*' for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s '
+                f'ORDER BY bm25({self.table}, 10.0, 1.0) LIMIT %s',
+                [match, self.limit])
+            ranked_ids = [row[0] for row in cursor.fetchall()]
+        return _rank_queryset(queryset, ranked_ids)
+
+    def index_product(self, product):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {self.table} WHERE rowid = %s', [product.pk])
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, name, description) '
+                'VALUES (%s, %s, %s)',
+                [product.pk, product.name, product.description])
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {self.table} WHERE rowid = %s', [product_id])
+
+    def rebuild(self, products, batch_size=500):
+        count = 0
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+            batch = []
+            for product in products:
+                batch.append((product.pk, product.name, product.description))
+                if len(batch) >= batch_size:
+                    count += self._insert(cursor, batch)
+                    batch = []
+            count += self._insert(cursor, batch)
+            # merge the index segments written by the bulk insert
+            cursor.execute(
+                f"INSERT INTO {self.table} ({self.table}) VALUES ('optimize')")
+        return count
+
+    def _insert(self, cursor, batch):
+        """ Insert a batch of (id, name, description) rows """
+        if batch:
+            cursor.executemany(
+                f'INSERT INTO {self.table} (rowid, name, description) '
+                'VALUES (%s, %s, %s)', batch)
+        return len(batch)
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    Searches a tsvector column with a GIN index.
+    The name is weighted A and the description B,
+    results are ranked with ts_rank.
+    Each term is a prefix match and all terms must match.
+    """
+    table = 'products_product_search'
+
+    @property
+    def limit(self):
+        return settings.PRODUCT_SEARCH_LIMIT
+    document = (
+        "setweight(to_tsvector('english', %s), 'A') || "
+        "setweight(to_tsvector('english', %s), 'B')"
+    )
+
+    def search(self, queryset, query):
+        terms = _get_terms(query)
+        if not terms:
+            return _rank_queryset(queryset, [])
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT product_id FROM {self.table}, '
+                "to_tsquery('english', %s) query "
+                'WHERE document @@ query '
+                'ORDER BY ts_rank(document, query) DESC, product_id LIMIT %s',
+                [tsquery, self.limit])
+            ranked_ids = [row[0] for row in cursor.fetchall()]
+        return _rank_queryset(queryset, ranked_ids)
+
+    def index_product(self, product):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {self.table} (product_id, document) '
+                f'VALUES (%s, {self.document}) '
+                'ON CONFLICT (product_id) '
+                'DO UPDATE SET document = EXCLUDED.document',
+                [product.pk, product.name, product.description])
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {self.table} WHERE product_id = %s',
+                [product_id])
+
+    def rebuild(self, products, batch_size=500):
+        count = 0
+        with connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {self.table}')
+            batch = []
+            for product in products:
+                batch.append((product.pk, product.name, product.description))
+                if len(batch) >= batch_size:
+                    count += self._insert(cursor, batch)
+                    batch = []
+            count += self._insert(cursor, batch)
+        return count
+
+    def _insert(self, cursor, batch):
+        """ Insert a batch of (id, name, description) rows """
+        if batch:
+            cursor.executemany(
+                f'INSERT INTO {self.table} (product_id, document) '
+                f'VALUES (%s, {self.document})', batch)
+        return len(batch)
+
+
+VENDOR_BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend():
+    """
+    Return the search backend to use.
+    PRODUCT_SEARCH_BACKEND in settings.py can name a backend class,
+    otherwise it is picked from the database in use.
+    SQLite locally, Postgres when DATABASE_URL is set on Heroku.
+    Any other database falls back to the basic backend.
+    """
+    if settings.PRODUCT_SEARCH_BACKEND:
+        return import_string(settings.PRODUCT_SEARCH_BACKEND)()
+    return VENDOR_BACKENDS.get(connection.vendor, BaseSearchBackend)()
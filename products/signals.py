@@ -0,0 +1,75 @@
+""" This module contains signals used in the products app (SEE apps.py) """
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+
+from .images import update_product_images
+from .models import CatalogVersion, Category, Product
+from .product_cache import product_cache
+from .search import get_search_backend
+
+
+@receiver(post_save, sender=Product)
+def index_on_save(sender, instance, **kwargs):
+    """
+    Add or update the product in the search index
+    each time it is saved, through the views, the admin or loaddata.
+    """
+    get_search_backend().index_product(instance)
+
+
+@receiver(pre_save, sender=Product)
+def set_derived_fields(sender, instance, **kwargs):
+    """
+    Set the summary and lower case name each time a product is saved,
+    including raw saves by loaddata, which skip the model's save method.
+    """
+    instance.set_derived_fields()
+
+
+@receiver(pre_save, sender=Product)
+def note_new_image(sender, instance, raw=False, **kwargs):
+    """
+    Note when a new image has been uploaded for the product,
+    through the product form or the admin,
+    before the image field saves it and it becomes committed.
+    The widths of the old image's derivatives no longer apply.
+    """
+    if not raw and instance.image and not instance.image._committed:  # pylint: disable=protected-access  # noqa
+        instance.image_widths = ''
+        instance._image_changed = True  # pylint: disable=protected-access
+
+
+@receiver(post_save, sender=Product)
+def resize_new_image(sender, instance, **kwargs):
+    """
+    Make the resized versions of a newly uploaded image (see images.py),
+    once the product is safely committed.
+    """
+    if getattr(instance, '_image_changed', False):
+        instance._image_changed = False  # pylint: disable=protected-access
+        transaction.on_commit(lambda: update_product_images(instance.pk))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_on_delete(sender, instance, **kwargs):
+    """
+    Remove the product from the search index when it is deleted
+    """
+    get_search_backend().remove_product(instance.pk)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def bump_catalog_version(sender, **kwargs):
+    """
+    Bump the catalog version whenever a product or category changes.
+    Whether through the product views, the admin or loaddata.
+    Invalidating everything cached from the catalog (see catalog.py).
+    This process's product cache is emptied straight away.
+    """
+    CatalogVersion.bump()
+    product_cache.invalidate()
@@ -0,0 +1,25 @@
+""" This module contains the template filters for responsive product images """
+
+from django import template
+from django.core.files.storage import default_storage
+
+from products.images import derivative_name, parse_widths
+
+register = template.Library()
+
+
+@register.filter(name='srcset')
+def srcset(product, fmt='jpeg'):
+    """
+    Returns the srcset of a product's resized images in a format,
+    webp or jpeg, e.g. 'teapot-320w.jpeg 320w, teapot-640w.jpeg 640w'.
+
+    Empty if the derivatives haven't been made yet (see images.py),
+    in which case the browser just uses the img src.
+    The widths come from the product so no storage lookups are needed.
+    """
+    if not product.image:
+        return ''
+    return ', '.join(
+        f'{default_storage.url(derivative_name(product.image.name, width, fmt))} {width}w'  # noqa
+        for width in parse_widths(product.image_widths))
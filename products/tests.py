@@ -1,3 +1,685 @@
-from django.test import TestCase
+""" This module contains the tests for the products app """
 
-# Create your tests here.
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+from io import BytesIO, StringIO
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from .models import CatalogVersion, Category, Product
+from .pagination import KeysetPaginator, decode_cursor, encode_cursor
+from .product_cache import ProductCache, product_cache
+from .search import BaseSearchBackend, get_search_backend
+
+
+# pylint: disable=no-member
+class ProductListingQueryBudgetTest(TestCase):
+    """
+    The products grid must not fall back to a query per product card.
+    A full first page costs one query for the catalog version,
+    one for the page itself, with the categories joined in,
+    and one for the count.
+    Loading more pages over ajax skips the count.
+    Once cached, only the catalog version is looked up.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        categories = [
+            Category.objects.create(name=f'cat_{i}', friendly_name=f'Cat {i}')
+            for i in range(3)
+        ]
+        for i in range(60):
+            Product.objects.create(
+                name=f'Product {i}',
+                description='A long description ' * 50,
+                price=10 + i,
+                rating=i % 5 if i % 7 else None,
+                category=categories[i % 3] if i % 11 else None,
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_first_page_query_budget(self):
+        """ Every sort option renders its first page in three queries """
+        for sort in ('', 'price', 'rating', 'name', 'category'):
+            for direction in ('asc', 'desc'):
+                cache.clear()
+                with self.subTest(sort=sort, direction=direction):
+                    with self.assertNumQueries(3):
+                        response = self.client.get(reverse('products'), {
+                            'sort': sort, 'direction': direction})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertContains(response, '60 Products')
+
+    def test_load_more_query_budget(self):
+        """ The ajax load more fragment skips the count query """
+        response = self.client.get(reverse('products'), {'sort': 'category'})
+        next_page_url = response.context['next_page_url']
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                reverse('products') + next_page_url,
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.json()['html'].count('card-img-top'), 24)
+
+    def test_cached_page_query_budget(self):
+        """ A cached page only looks up the catalog version """
+        self.client.get(reverse('products'), {'sort': 'price'})
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('products'), {'sort': 'price'})  # noqa
+        self.assertContains(response, '60 Products')
+
+    def test_cached_search_query_budget(self):
+        """ A cached search page doesn't run the search again """
+        params = {'q': 'Product 1', 'category': 'cat_1'}
+        self.client.get(reverse('products'), params)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('products'), params)
+        self.assertContains(response, 'Product 1')
+
+    def test_listing_does_not_load_description(self):
+        """ The grid uses the precomputed summary, not the description """
+        response = self.client.get(reverse('products'))
+        for product in response.context['products']:
+            self.assertIn('description', product.get_deferred_fields())
+            self.assertTrue(product.summary)
+
+
+class ProductListingCacheTest(TestCase):
+    """
+    Saving or deleting a product or category must invalidate
+    the cached listing straight away,
+    and the shared cached cards must never include the superuser links.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='kitchen', friendly_name='Kitchen')  # noqa
+        self.product = Product.objects.create(
+            name='Teapot', description='A teapot', price=10,
+            category=self.category)
+
+    def test_product_changes_invalidate_listing(self):
+        url = reverse('products')
+        self.assertContains(self.client.get(url), 'Teapot')
+        self.product.name = 'Kettle'
+        self.product.save()
+        self.assertContains(self.client.get(url), 'Kettle')
+        self.product.delete()
+        self.assertContains(self.client.get(url), '0 Products')
+
+    def test_category_changes_invalidate_listing(self):
+        url = reverse('products')
+        self.assertContains(self.client.get(url), 'Kitchen')
+        self.category.friendly_name = 'Cookware'
+        self.category.save()
+        self.assertContains(self.client.get(url), 'Cookware')
+
+    def test_superuser_links_kept_out_of_shared_cache(self):
+        from django.contrib.auth.models import User  # pylint: disable=import-outside-toplevel  # noqa
+        User.objects.create_superuser('owner', 'owner@example.com', 'password')  # noqa
+        url = reverse('products')
+        edit_url = reverse('edit_product', args=[self.product.id])
+        self.client.login(username='owner', password='password')
+        self.assertContains(self.client.get(url), edit_url)
+        self.client.logout()
+        self.assertNotContains(self.client.get(url), edit_url)
+
+
+class ProductFacetTest(TestCase):
+    """
+    The facet counts come from a single aggregate query.
+    Category counts cover the whole search,
+    rating and price counts only the selected categories.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        kitchen = Category.objects.create(name='kitchen', friendly_name='Kitchen')  # noqa
+        garden = Category.objects.create(name='garden', friendly_name='Garden')
+        for price, rating, category in [
+                (10, 4.5, kitchen), (20, 3, kitchen), (60, None, kitchen),
+                (30, 4.2, garden), (300, 1, garden), (5, 2, None)]:
+            Product.objects.create(
+                name='Pot', description='A pot', price=price, rating=rating,
+                category=category)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_facet_counts(self):
+        from .facets import get_facets  # pylint: disable=import-outside-toplevel  # noqa
+        with self.assertNumQueries(1):
+            facets = get_facets(Product.objects.all(), 0, None, ['kitchen'])
+        self.assertEqual(facets['total'], 3)
+        self.assertEqual(
+            [(c['name'], c['count'], c['selected']) for c in facets['categories']],  # noqa
+            [('garden', 2, False), ('kitchen', 3, True)])
+        self.assertEqual(
+            facets['ratings'],
+            [{'stars': 4, 'count': 1}, {'stars': 3, 'count': 1},
+             {'stars': None, 'count': 1}])
+        self.assertEqual(
+            [p['count'] for p in facets['prices']], [2, 1])
+
+    def test_listing_shows_category_counts(self):
+        response = self.client.get(reverse('products'), {'category': 'garden'})  # noqa
+        self.assertContains(response, '2 Products')
+        self.assertContains(response, 'Garden (2)')
+        self.assertContains(response, 'Kitchen (3)')
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite only')  # noqa
+class ProductSearchTest(TestCase):
+    """
+    Every term must match, as a prefix, in the name or description.
+    The full text backends rank name matches first
+    and return at most PRODUCT_SEARCH_LIMIT results,
+    the page says when there may be more.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        for name, description in [
+                ('Mug', 'A mug to go with the white teapot'),
+                ('Teapot', 'A white teapot'),
+                ('Kettle', 'Boils water')]:
+            Product.objects.create(
+                name=name, description=description, price=10)
+
+    def setUp(self):
+        cache.clear()
+
+    def _search(self, query, backend=None):
+        backend = backend or get_search_backend()
+        return list(
+            backend.search(Product.objects.all(), query)
+            .order_by('search_rank', 'id').values_list('name', flat=True))
+
+    def test_matching(self):
+        self.assertCountEqual(self._search('tea'), ['Mug', 'Teapot'])
+        self.assertCountEqual(self._search('Tea  WHITE'), ['Mug', 'Teapot'])
+        self.assertEqual(self._search('teapot boils'), [])
+        self.assertEqual(self._search('water'), ['Kettle'])
+        self.assertEqual(self._search('!!'), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        kettle = Product.objects.get(name='Kettle')
+        kettle.description = 'Boils water for the teapot'
+        kettle.save()
+        self.assertIn('Kettle', self._search('teapot'))
+        kettle.delete()
+        self.assertEqual(self._search('water'), [])
+
+    def test_name_matches_ranked_first(self):
+        self.assertEqual(self._search('teapot'), ['Teapot', 'Mug'])
+        response = self.client.get(reverse('products'), {'q': 'teapot'})
+        self.assertEqual(
+            [p.name for p in response.context['products']], ['Teapot', 'Mug'])
+
+    @override_settings(
+        PRODUCT_SEARCH_BACKEND='products.search.BaseSearchBackend')
+    def test_fallback_backend(self):
+        backend = get_search_backend()
+        self.assertIsInstance(backend, BaseSearchBackend)
+        self.assertCountEqual(
+            self._search('white teapot', backend), ['Mug', 'Teapot'])
+        self.assertEqual(self._search('teapot boils', backend), [])
+        self.assertFalse(backend.is_truncated(10 ** 6))
+        response = self.client.get(reverse('products'), {'q': 'teapot'})
+        self.assertContains(response, '2 Products')
+        self.assertFalse(response.context['search_truncated'])
+
+    def test_results_limited(self):
+        response = self.client.get(reverse('products'), {'q': 'teapot'})
+        self.assertFalse(response.context['search_truncated'])
+        self.assertNotContains(response, 'most relevant results')
+        with self.settings(PRODUCT_SEARCH_LIMIT=1):
+            self.assertEqual(self._search('teapot'), ['Teapot'])
+            cache.clear()
+            response = self.client.get(reverse('products'), {'q': 'teapot'})
+        self.assertTrue(response.context['search_truncated'])
+        self.assertContains(response, 'Showing the 1 most relevant results')
+
+
+@override_settings(PRODUCTS_PER_PAGE=7)
+class ProductPaginationTest(TestCase):
+    """
+    Following the next page links, first on the page
+    then with the load more fragment, visits every product once
+    in the order of the sort, for every sort in both directions,
+    with and without a search.
+    Shared prices, missing ratings and products without a category
+    must neither repeat nor skip a product at a page boundary.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        kitchen = Category.objects.create(name='kitchen', friendly_name='Kitchen')  # noqa
+        garden = Category.objects.create(name='garden', friendly_name='Garden')
+        for i in range(40):
+            Product.objects.create(
+                name=f'{"Teapot" if i % 3 else "Kettle"} {"ABCDE"[i % 5]}{i}',
+                description='A pot', price=10 + i % 4,
+                rating=i % 5 or None,
+                category=(kitchen, garden, None)[i % 3])
+
+    def setUp(self):
+        cache.clear()
+
+    def _walk(self, params):
+        """
+        Return the ids of every product, page by page,
+        the first from the page and the rest over ajax.
+        """
+        response = self.client.get(reverse('products'), params)
+        ids = [product.id for product in response.context['products']]
+        next_page_url = response.context['next_page_url']
+        while next_page_url:
+            response = self.client.get(
+                reverse('products') + next_page_url,
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            data = response.json()
+            page = [int(pk) for pk in dict.fromkeys(
+                re.findall(r'href="/products/(\d+)/"', data['html']))]
+            self.assertLessEqual(len(page), 7)
+            ids += page
+            next_page_url = data['next_page_url']
+        return ids
+
+    def _expected(self, products, field, descending):
+        """
+        The ids in the order of the sort, with the id as the tie breaker.
+        Nulls sort as the database sorts them.
+        """
+        def value(product):
+            for attr in field.split('__'):
+                product = getattr(product, attr) if product else None
+            return product
+
+        nulls_largest = connection.vendor in ('postgresql', 'oracle')
+        rows = sorted(
+            products, key=lambda p: (
+                (value(p) is None) == nulls_largest,
+                value(p) if value(p) is not None else 0, p.id))
+        if descending:
+            rows.reverse()
+        return [p.id for p in rows]
+
+    def test_every_sort_visits_every_product_once(self):
+        sorts = {
+            '': 'id', 'price': 'price', 'rating': 'rating',
+            'name': 'lower_name', 'category': 'category__name'}
+        for search in (None, 'teapot'):
+            products = Product.objects.select_related('category')
+            if search:
+                products = products.filter(name__istartswith=search)
+            for sort, field in sorts.items():
+                for direction in ('asc', 'desc'):
+                    params = {'sort': sort, 'direction': direction}
+                    if search:
+                        params['q'] = search
+                    with self.subTest(**params):
+                        ids = self._walk(params)
+                        self.assertEqual(len(ids), len(set(ids)))
+                        if sort:
+                            self.assertEqual(ids, self._expected(
+                                products, field, direction == 'desc'))
+                        else:
+                            self.assertCountEqual(
+                                ids, [p.id for p in products])
+
+    def test_search_rank_order(self):
+        """ Without a sort, search results page in the order they rank """
+        ranked = get_search_backend().search(
+            Product.objects.all(), 'teapot').order_by('search_rank', 'id')
+        self.assertEqual(
+            self._walk({'q': 'teapot'}), [p.id for p in ranked])
+
+    def test_cursor(self):
+        self.assertEqual(
+            decode_cursor(encode_cursor(Decimal('10.50'), 3)), ('10.50', 3))
+        for cursor in ('', 'not base64!', encode_cursor(1, 'x'),
+                       encode_cursor([1], 2)):
+            with self.subTest(cursor=cursor):
+                self.assertIsNone(decode_cursor(cursor))
+        # a bad cursor starts again from the first page
+        paginator = KeysetPaginator(Product.objects.all(), 'price', per_page=7)  # noqa
+        self.assertEqual(paginator.page('garbage'), paginator.page())
+
+    def test_wrong_type_cursor_starts_from_first_page(self):
+        cursor = encode_cursor('x', 1)
+        for params in ({}, {'sort': 'price'}, {'q': 'teapot'}):
+            with self.subTest(**params):
+                first = self.client.get(reverse('products'), params)
+                response = self.client.get(
+                    reverse('products'), {**params, 'cursor': cursor})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(
+                    response.context['products'], first.context['products'])
+
+
+class ProductSortIndexTest(TestCase):
+    """
+    Each sort option on the products page must be served by an index,
+    for the first page and for the pages after it.
+    The query the view actually ran is captured and explained,
+    the plan must walk the index for the sort
+    and never sort the products in a temporary b-tree.
+
+    Sorting by category orders by the joined category name,
+    which can't come from an index on the products table,
+    so for that sort only the joins are checked.
+    """
+    sort_indexes = {
+        '': None,  # default order is the primary key
+        'price': 'product_price_idx',
+        'rating': 'product_rating_idx',
+        'name': 'product_lower_name_idx',
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='kitchen', friendly_name='Kitchen')  # noqa
+        for i in range(60):
+            Product.objects.create(
+                name=f'Product {i}', description='Description',
+                price=i, rating=i % 5 or None,
+                category=category if i % 2 else None)
+
+    def setUp(self):
+        cache.clear()
+
+    def _explain_page(self, params):
+        """ Return the query plan of the page query run by the view """
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('products'), params)
+        sql = [
+            q['sql'] for q in queries.captured_queries
+            if 'FROM "products_product"' in q['sql'] and 'LIMIT' in q['sql']
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql[0]}')
+            plan = [row[-1] for row in cursor.fetchall()]
+        return response, plan
+
+    def test_sorts_use_indexes(self):
+        for sort, index in self.sort_indexes.items():
+            for direction in ('asc', 'desc'):
+                params = {'sort': sort, 'direction': direction}
+                response, first_plan = self._explain_page(params)
+                cursor = response.context['next_page_url'].split('cursor=')[1]  # noqa
+                _, next_plan = self._explain_page({**params, 'cursor': cursor})
+                for plan in (first_plan, next_plan):
+                    with self.subTest(sort=sort, direction=direction, plan=plan):  # noqa
+                        self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan)
+                        product_step = plan[0]
+                        if index:
+                            self.assertIn(f'USING INDEX {index}', product_step)  # noqa
+                        else:
+                            self.assertTrue(
+                                product_step == 'SCAN products_product'
+                                or 'INTEGER PRIMARY KEY' in product_step)
+
+    def test_category_sort_joins_use_indexes(self):
+        for direction in ('asc', 'desc'):
+            _, plan = self._explain_page({'sort': 'category', 'direction': direction})  # noqa
+            with self.subTest(direction=direction, plan=plan):
+                self.assertTrue(all(
+                    'USING' in step for step in plan if 'products_' in step))
+
+
+class ProductConditionalGetTest(TestCase):
+    """
+    Unchanged product pages are answered with a 304,
+    but anything shown per visitor must change the ETag.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='kitchen', friendly_name='Kitchen')  # noqa
+        self.product = Product.objects.create(
+            name='Teapot', description='A teapot', price=10,
+            category=self.category)
+        self.detail_url = reverse('product_detail', args=[self.product.id])
+
+    def test_detail_not_modified(self):
+        # the first visit sets the csrf cookie the page's forms use
+        self.client.get(self.detail_url)
+        response = self.client.get(self.detail_url)
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.product.save()
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail_last_modified_for_anonymous_visitors(self):
+        response = self.client.get(self.detail_url)
+        last_modified = response['Last-Modified']
+        self.client.cookies.clear()
+        response = self.client.get(
+            self.detail_url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_bag_changes_etag(self):
+        self.client.get(self.detail_url)
+        etag = self.client.get(self.detail_url)['ETag']
+        self.client.post(
+            reverse('add_to_bag', args=[self.product.id]),
+            {'quantity': 1, 'redirect_url': '/'})
+        # the first page after adding shows the success message
+        response = self.client.get(self.detail_url)
+        self.assertFalse(response.has_header('ETag'))
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertFalse(response.has_header('Last-Modified'))
+
+    def test_repriced_bag_product_changes_etag(self):
+        mug = Product.objects.create(
+            name='Mug', description='A mug', price=8, category=self.category)
+        self.client.post(
+            reverse('add_to_bag', args=[mug.id]),
+            {'quantity': 1, 'redirect_url': '/'})
+        # the first page after adding shows the success message
+        self.client.get(self.detail_url)
+        etag = self.client.get(self.detail_url)['ETag']
+        mug.price = 9
+        mug.save()
+        response = self.client.get(self.detail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<span class="bag-grand-total">9.90')
+
+    def test_listing_not_modified(self):
+        url = reverse('products')
+        etag = self.client.get(url, {'sort': 'price'})['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                url, {'sort': 'price'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            url, {'sort': 'rating'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.category.save()
+        response = self.client.get(
+            url, {'sort': 'price'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_listing_json_has_its_own_etag(self):
+        url = reverse('products')
+        response = self.client.get(url)
+        self.assertIn('X-Requested-With', response['Vary'])
+        response = self.client.get(
+            url, HTTP_IF_NONE_MATCH=response['ETag'],
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn('X-Requested-With', response['Vary'])
+        response = self.client.get(
+            url, HTTP_IF_NONE_MATCH=response['ETag'],
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('X-Requested-With', response['Vary'])
+
+
+class ProductImageDerivativeTest(TestCase):
+    """
+    Uploading a product image makes its resized webp and jpeg versions,
+    which the templates offer in a srcset.
+    The backfill command makes them for existing images,
+    skipping those already up to date.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, PRODUCT_IMAGE_WIDTHS=(320, 640))
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def _image(self, name='teapot.jpg', width=800):
+        buffer = BytesIO()
+        Image.new('RGB', (width, width // 2), 'teal').save(buffer, 'JPEG')
+        return SimpleUploadedFile(name, buffer.getvalue(), 'image/jpeg')
+
+    def _derivatives(self):
+        return sorted(os.listdir(os.path.join(self.media_root, 'derivatives')))
+
+    def test_upload_makes_derivatives(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(
+                name='Teapot', description='A teapot', price=10,
+                image=self._image())
+        product.refresh_from_db()
+        self.assertEqual(product.image_widths, '320,640,800')
+        self.assertEqual(self._derivatives(), [
+            f'teapot-{w}w.{fmt}' for w in (320, 640, 800)
+            for fmt in ('jpeg', 'webp')])
+        with Image.open(default_storage.open('derivatives/teapot-320w.webp')) as image:  # noqa
+            self.assertEqual((image.format, image.size), ('WEBP', (320, 160)))
+
+        response = self.client.get(reverse('product_detail', args=[product.id]))  # noqa
+        self.assertContains(response, '/media/derivatives/teapot-640w.webp 640w')  # noqa
+        self.assertContains(response, '/media/derivatives/teapot-800w.jpeg 800w')  # noqa
+
+    def test_missing_derivatives_fall_back_to_original(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            product = Product.objects.create(
+                name='Teapot', description='A teapot', price=10,
+                image=self._image())
+        response = self.client.get(reverse('product_detail', args=[product.id]))  # noqa
+        self.assertNotContains(response, 'srcset')
+        self.assertContains(response, 'src="/media/teapot.jpg"')
+
+    def test_backfill_skips_up_to_date_images(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            product = Product.objects.create(
+                name='Teapot', description='A teapot', price=10,
+                image=self._image(width=500))
+        call_command('resize_product_images', workers=1, stdout=StringIO())
+        product.refresh_from_db()
+        self.assertEqual(product.image_widths, '320,500')
+        path = os.path.join(self.media_root, 'derivatives', 'teapot-320w.jpeg')  # noqa
+        modified = os.path.getmtime(path)
+        call_command('resize_product_images', workers=1, stdout=StringIO())
+        self.assertEqual(os.path.getmtime(path), modified)
+
+
+class ProductCacheTest(TestCase):
+    """
+    The product cache evicts the least recently used products,
+    and is emptied whenever the catalog version moves on,
+    including when the change was made by another process.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = [
+            Product.objects.create(name=f'Mug {i}', description='A mug', price=5)  # noqa
+            for i in range(4)
+        ]
+
+    def setUp(self):
+        product_cache.clear()
+
+    def test_lru_eviction_and_stats(self):
+        cache_ = ProductCache(max_size=2)
+        a, b, c = (p.pk for p in self.products[:3])
+        with self.assertNumQueries(1):
+            cache_.get_many([a, b], version=1)
+        with self.assertNumQueries(0):
+            cache_.get(a, version=1)  # a is now the most recently used
+        with self.assertNumQueries(1):
+            cache_.get(c, version=1)  # evicts b
+        with self.assertNumQueries(1):
+            cache_.get_many([a, b, c], version=1)
+        stats = cache_.stats()
+        self.assertEqual(
+            (stats['hits'], stats['misses'], stats['evictions'], stats['size']),  # noqa
+            (3, 4, 2, 2))
+        self.assertIsNone(cache_.get(999, version=1))
+
+    def test_new_version_invalidates(self):
+        cache_ = ProductCache(max_size=10)
+        product = self.products[0]
+        cache_.get(product.pk, version=1)
+        # another worker changes the price, only bumping the version
+        Product.objects.filter(pk=product.pk).update(price=7)
+        self.assertEqual(cache_.get(product.pk, version=1).price, 5)
+        self.assertEqual(cache_.get(product.pk, version=2).price, 7)
+        self.assertEqual(cache_.stats()['invalidations'], 1)
+
+    def test_views_read_through_cache(self):
+        product = self.products[0]
+        url = reverse('product_detail', args=[product.pk])
+        self.client.get(url)
+        self.client.cookies.clear()
+        with self.assertNumQueries(1):  # the catalog version
+            response = self.client.get(url)
+        self.assertContains(response, '$5.00')
+        # a price change made elsewhere shows on the next request
+        Product.objects.filter(pk=product.pk).update(price=9)
+        CatalogVersion.bump()
+        self.assertContains(self.client.get(url), '$9.00')
+
+
+class ProductFixtureTest(TestCase):
+    """ The shipped fixtures load into the current models """
+
+    def test_fixtures_load(self):
+        call_command('loaddata', 'categories', 'products', verbosity=0)
+        self.assertTrue(Category.objects.exists())
+        self.assertEqual(
+            Product.objects.count(), Product.objects.filter(
+                updated_at__isnull=False,
+                category__updated_at__isnull=False).count())
+
+    def test_fixtures_get_summary_and_lower_name(self):
+        call_command('loaddata', 'categories', 'products', verbosity=0)
+        self.assertFalse(
+            Product.objects.filter(lower_name='').exists()
+            or Product.objects.filter(summary='').exists())
+        product = Product.objects.get(pk=1)
+        self.assertEqual(product.lower_name, product.name.lower())
+        self.assertTrue(product.description.startswith(
+            product.summary.rstrip('…')))
@@ -1,20 +1,107 @@
 """ This module containts the views for the products app. """
 
+import functools
+
 from django.shortcuts import render, redirect, reverse, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
-from django.db.models.functions import Lower
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.template.loader import render_to_string
+from django.utils.functional import SimpleLazyObject
+from django.utils.safestring import mark_safe
+from django.views.decorators.cache import cache_control
+from django.views.decorators.vary import vary_on_headers
 from .models import Product, Category
 from .forms import ProductForm
+from .catalog import catalog_cache_key, get_catalog_version
+from .conditional import listing_condition, product_condition
+from .facets import get_facets
+from .pagination import KeysetPaginator
+from .product_cache import get_product_or_404
+from .search import get_search_backend
+
+# The sort options offered in products.html and the field each sorts on
+SORT_FIELDS = {
+    'price': 'price',
+    'rating': 'rating',
+    'name': 'lower_name',
+    'category': 'category__name',
+}
+NULLABLE_SORT_FIELDS = ('rating', 'category__name')
+
+# The only columns the product cards in product_cards.html use.
+# The category is joined in the same query rather than one query per card.
+LISTING_FIELDS = (
+    'id', 'name', 'lower_name', 'summary', 'price', 'rating',
+    'image', 'image_widths',
+    'category', 'category__name', 'category__friendly_name',
+)
+
+
+def _get_listing(products, version, params):
+    """
+    Return one page of the listing, from the cache if possible.
+
+    The cache key is the catalog version and the normalized parameters,
+    so a change to any product or category starts a new set of entries.
+    The entry holds the products on the page, the cursor for the next page
+    and the product cards rendered as html.
+    The cards are rendered without the superuser edit and delete links,
+    so the same entry can be shared by every visitor.
+    products are only filtered by category, and searched, on a cache miss.
+    """
+    key = catalog_cache_key('products:listing', version, **params)
+    listing = cache.get(key)
+    if listing is None:
+        if params['categories']:
+            products = products.filter(
+                category__name__in=params['categories'])
+        sortkey = params['sortkey']
+        paginator = KeysetPaginator(
+            products, sortkey,
+            descending=params['descending'],
+            nullable=sortkey in NULLABLE_SORT_FIELDS,
+            per_page=settings.PRODUCTS_PER_PAGE,
+        )
+        page, next_cursor = paginator.page(params['cursor'])
+        listing = {
+            'products': page,
+            'next_cursor': next_cursor,
+            'cards_html': render_to_string(
+                'products/includes/product_cards.html',
+                {'products': page, 'MEDIA_URL': settings.MEDIA_URL}),
+        }
+        cache.set(key, listing, settings.PRODUCTS_CACHE_TIMEOUT)
+    return listing
+
+
+def _get_current_categories(facets, category_names):
+    """
+    Return the selected categories, for the buttons at the top of the page.
+    Taken from the category facets where possible,
+    only a selected category with no results needs to be looked up.
+    """
+    current = [c for c in facets['categories'] if c['selected']]
+    missing = set(category_names) - {c['name'] for c in current}
+    if missing:
+        current += Category.objects.filter(name__in=missing).values('name', 'friendly_name')  # noqa
+    return current
 
 
 # pylint: disable=no-member
+@cache_control(private=True, no_cache=True)
+@vary_on_headers('X-Requested-With')
+@listing_condition
 def all_products(request):
     """
     A view to show all products.
     Also shows sorting and search queries.
 
+    The products are loaded with their category joined in,
+    and only the columns in LISTING_FIELDS that the product cards use.
+
     Searching
 
     q is the name of the text  input on the form.
@@ -22,13 +109,15 @@ def all_products(request):
     to attach an error message to the request.
     Then redirect back to the products url.
 
-    Set's a variable equal to a Q object. Where the name contains the query.
-    Or the description contains the query.
-    The pipe here is what generates the or statement.
-    And the i in front of contains makes the queries case insensitive.
-
-    The filter method is then called on these queries and returned in
-    the products variable.
+    The query is passed to the search backend (see search.py).
+    Which filters the products down to the ones matching the query
+    using the full text index for the database in use.
+    The search is lazy, only run when the listing or facets aren't cached.
+    Ranked backends return only the most relevant PRODUCT_SEARCH_LIMIT,
+    search_truncated tells the template when there may be more.
+    Each result is annotated with a search rank,
+    if no other sorting has been chosen the results are ordered by it.
+    So the most relevant products come first.
 
     The query is added to the context as search term.
     set as none at the top of this view to ensure we don't get an error
@@ -36,42 +125,63 @@ def all_products(request):
 
     Filtering Via Category
 
-    Start with it as none at the top of the view.
+    Start with it as an empty list at the top of the view.
     And then check whether it exists in requests.get.
     If it does, split it into a list at the commas in the template url.
     Then use that list to filter the current query set of all products
-    down to only products whose category name is in the list.
-
-    filter all categories down to the ones whose name is in the list.
-    converting the list of strings of category names passed through the URL
-    into a list of actual category objects,
-    so that we can access all their fields in the template.
-    That list of category objects is called current_categories.
+    down to only products whose category name is in the list,
+    when the page isn't cached (see _get_listing).
+
+    Before filtering, the facet counts are taken (see facets.py).
+    The number of results in each category, rating and price bucket,
+    all from one cached aggregate query.
+    The total of the selected categories is the 'N Products' header.
+    The selected categories are picked out of the category facets,
+    so that we can access their friendly names in the template.
+    That list of categories is called current_categories.
     return  to the context so we can use it in the template.
 
     Sorting Products
     Add both sort and direction equal to none at the top.
     in order to return the template properly when we're not using any sorting.
 
-    Start by  checking whether sort is in request.get.
+    Start by  checking whether sort is in request.get,
+    and is one of the options in SORT_FIELDS.
     In order to allow case-insensitive sorting on the name field,
-    first annotate all the products with a new field.
-    Check whether the sort key is equal to name.
-    And if it is will set it to lower_name,
-    which is the field created with the annotation.
-    To do the annotation.
-    products equals products.annotate lower_name equals lower name.
-    Then use the lower function on the original name field.
+    the name sorts on the lower_name field stored on each product.
+    Which is indexed, along with the price and rating (see models.py).
     The reason for copying the sort parameter into the variable sortkey.
     Is to preserve the original field we want it to sort on name.
     But we have the actual field we're going to sort on,
     lower_name in the sort key variable.
 
     If it is then check whether the direction is there.
-    check whether it's descending,
-    If so add a minus in front of the sort key using string formatting.
-
-    In order to actually sort the products use the order_by model method.
+    The paginator sorts descending if the direction is desc.
+
+    Paging
+    Rather than rendering every product at once
+    the products are handed to the keyset paginator (see pagination.py),
+    which orders them by the sort key with the id as a tie breaker.
+    And returns a page of them along with a cursor for the next page.
+    The cursor is added to the current url for the load more link.
+    When the load more button asks for the next page with ajax
+    only the product cards and the next cursor are returned as JSON.
+    The total for the header is a separate cached count query.
+
+    Caching
+    Each page of the listing is cached (see _get_listing),
+    keyed by the catalog version and the normalized search, categories,
+    sort and cursor. So most browsing never reaches the products table.
+    Saving or deleting any product or category bumps the catalog version,
+    so edits show up straight away.
+
+    Conditional GET
+    The page is sent with an ETag from the catalog version,
+    the query string and the visitor's own state (see conditional.py),
+    so a browser revalidating an unchanged page gets a 304 back
+    without the view running at all.
+    The JSON for the load more button comes from the same url,
+    so it has its own ETag and responses vary on X-Requested-With.
 
     Then return the current sorting methodology to the template.
     Since both the sort and the direction variables are stored
@@ -81,38 +191,25 @@ def all_products(request):
     If there is no sorting.
     """
 
-    products = Product.objects.all()
+    products = Product.objects.select_related('category').only(*LISTING_FIELDS)  # noqa
     query = None
-    categories = None
+    search = None
+    search_truncated = False
+    category_names = []
     sort = None
     direction = None
+    sortkey = 'id'
 
     if request.GET:
-        if 'sort' in request.GET:
-            # sets both equal to sort and sortkey
-            sortkey = request.GET['sort']
-            sort = sortkey
-            if sortkey == 'name':
-                sortkey = 'lower_name'
-                products = products.annotate(lower_name=Lower('name'))
-            if sortkey == 'category':
-                sortkey = 'category__name'
-            if 'direction' in request.GET:
-                direction = request.GET['direction']
-                if direction == 'desc':
-                    sortkey = f'-{sortkey}'
-            products = products.order_by(sortkey)
-
+        if 'sort' in request.GET and request.GET['sort'] in SORT_FIELDS:
+            # sort is kept for the template, sortkey is the field used
+            sort = request.GET['sort']
+            sortkey = SORT_FIELDS[sort]
             if 'direction' in request.GET:
                 direction = request.GET['direction']
-                if direction == 'desc':
-                    sortkey = f'-{sortkey}'
-            products = products.order_by(sortkey)
 
         if 'category' in request.GET:
-            categories = request.GET['category'].split(',')
-            products = products.filter(category__name__in=categories)
-            categories = Category.objects.filter(name__in=categories)
+            category_names = sorted(set(request.GET['category'].split(',')))
 
         if 'q' in request.GET:
             query = request.GET['q']
@@ -120,25 +217,83 @@ def all_products(request):
                 messages.error(request, "You didn't enter any search criteria!")  # noqa
                 return redirect(reverse('products'))
 
-            queries = Q(name__icontains=query) | Q(description__icontains=query)  # noqa
-            products = products.filter(queries)
+            # normalized so the same search always shares a cache entry
+            search = ' '.join(query.lower().split())
+            backend = get_search_backend()
+            products = SimpleLazyObject(functools.partial(
+                backend.search, products, search))
+            if not sort:
+                sortkey = 'search_rank'
+
+    version = get_catalog_version(request)
+    # counted before the category filter so every category gets a count
+    facets = get_facets(products, version, search, category_names)
+    if search:
+        search_truncated = backend.is_truncated(facets['results'])
+    listing = _get_listing(products, version, {
+        'search': search,
+        'categories': category_names,
+        'sortkey': sortkey,
+        'descending': direction == 'desc',
+        'cursor': request.GET.get('cursor'),
+    })
+
+    # superusers get the cards rendered live, with the edit and delete links
+    show_admin_links = request.user.is_superuser
+    cards_html = None if show_admin_links else mark_safe(listing['cards_html'])  # noqa
+
+    next_page_url = None
+    if listing['next_cursor']:
+        params = request.GET.copy()
+        params['cursor'] = listing['next_cursor']
+        next_page_url = f'?{params.urlencode()}'
+
+    # load more button, only the next set of product cards is needed
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        if cards_html is None:
+            cards_html = render_to_string(
+                'products/includes/product_cards.html',
+                {'products': listing['products'], 'show_admin_links': True},
+                request=request)
+        return JsonResponse({
+            'html': cards_html,
+            'next_cursor': listing['next_cursor'],
+            'next_page_url': next_page_url,
+        })
+
+    current_categories = None
+    if category_names:
+        current_categories = _get_current_categories(facets, category_names)
 
     current_sorting = f'{sort}_{direction}'
 
     context = {
-        'products': products,
+        'products': listing['products'],
+        'cards_html': cards_html,
+        'show_admin_links': show_admin_links,
+        'product_total': facets['total'],
+        'facets': facets,
+        'next_page_url': next_page_url,
         'search_term': query,
-        'current_categories': categories,
+        'search_truncated': search_truncated,
+        'current_categories': current_categories,
         'current_sorting': current_sorting,
     }
 
     return render(request, 'products/products.html', context)
 
 
+@cache_control(private=True, no_cache=True)
+@product_condition
 def product_detail(request, product_id):
-    """ A view to show individual product details """
+    """
+    A view to show individual product details.
+    Sent with an ETag and Last-Modified from the product's updated_at
+    (see conditional.py), so unchanged pages are answered with a 304.
+    The product is read through the product cache (see product_cache.py).
+    """
 
-    product = get_object_or_404(Product, pk=product_id)
+    product = get_product_or_404(request, product_id)
 
     context = {
         'product': product,
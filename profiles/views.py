@@ -18,7 +18,8 @@ def profile(request):
     Populate it with the user's current profile information.
     And return it to the template
     use the profile and the related name on the order model.
-    To get the users orders and return those to the template
+    To get the users orders and return those to the template,
+    newest first, read in order from the order_profile_date index.
 
     the post handler for the profile view:
     if the request method is post.
@@ -39,7 +40,7 @@ def profile(request):
             messages.error(request, 'Update failed. Please ensure the form is valid.')  # noqa
     else:  # return the form data back to the view if form not valid
         form = UserProfileForm(instance=profile)
-    orders = profile.orders.all()
+    orders = profile.orders.order_by('-date')
 
     template = 'profiles/profile.html'
     context = {